@@ -98,6 +98,18 @@ DATABASES = {
     }
 }
 
+# Use the MySQL service of docker-compose instead when MYSQL_HOST is set
+if os.environ.get('MYSQL_HOST'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.mysql',
+        'NAME': os.environ.get('MYSQL_DATABASE', 'livetweets'),
+        'USER': os.environ.get('MYSQL_USER', 'user'),
+        'PASSWORD': os.environ.get('MYSQL_PASSWORD', 'password'),
+        'HOST': os.environ['MYSQL_HOST'],
+        'PORT': os.environ.get('MYSQL_PORT', '3306'),
+        'OPTIONS': {'charset': 'utf8mb4'},
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -168,4 +180,94 @@ CHANNEL_LAYERS = {
             "hosts": [('redis', 6379)],
         },
     },
-}
\ No newline at end of file
+}
+
+# Tweet ingestion (interface.ingest)
+# Max tweets waiting to be stored before the stream waits, max tweets per bulk insert, and max seconds between flushes
+LIVETWEETS_INGEST_QUEUE_SIZE = int(os.environ.get('LIVETWEETS_INGEST_QUEUE_SIZE', 10000))
+LIVETWEETS_INGEST_BATCH_SIZE = int(os.environ.get('LIVETWEETS_INGEST_BATCH_SIZE', 200))
+LIVETWEETS_INGEST_FLUSH_INTERVAL = float(os.environ.get('LIVETWEETS_INGEST_FLUSH_INTERVAL', 0.5))
+
+# Seconds between writes of the in-process hashtag, mention and context counts (interface.counters)
+LIVETWEETS_COUNTER_FLUSH_INTERVAL = float(os.environ.get('LIVETWEETS_COUNTER_FLUSH_INTERVAL', 5))
+
+# Broadcasting of the most popular hashtags, mentions and contexts (interface.broadcast)
+# Max sends per second, whether to send only the changed ranks, and max seconds between full sends
+LIVETWEETS_HMC_MAX_RATE = float(os.environ.get('LIVETWEETS_HMC_MAX_RATE', 2))
+LIVETWEETS_HMC_DELTAS = os.environ.get('LIVETWEETS_HMC_DELTAS', 'true').lower() == 'true'
+LIVETWEETS_HMC_KEYFRAME_INTERVAL = float(os.environ.get('LIVETWEETS_HMC_KEYFRAME_INTERVAL', 10))
+
+# Max seconds the parsed terms of the active stream rules are cached (interface.rules)
+LIVETWEETS_RULES_CACHE_TTL = float(os.environ.get('LIVETWEETS_RULES_CACHE_TTL', 60))
+
+# Max users and media remembered per process as stored, to skip writing them again unchanged (interface.ingest)
+LIVETWEETS_INCLUDES_CACHE_SIZE = int(os.environ.get('LIVETWEETS_INCLUDES_CACHE_SIZE', 10000))
+
+# Archive of the raw stream payloads (interface.archive). Disabled unless LIVETWEETS_ARCHIVE_DIR is set
+# Segment size and age before rotating, max payloads per compressed block, and max seconds before a block is written
+LIVETWEETS_ARCHIVE_DIR = os.environ.get('LIVETWEETS_ARCHIVE_DIR')
+LIVETWEETS_ARCHIVE_SEGMENT_BYTES = int(os.environ.get('LIVETWEETS_ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))
+LIVETWEETS_ARCHIVE_SEGMENT_SECONDS = float(os.environ.get('LIVETWEETS_ARCHIVE_SEGMENT_SECONDS', 3600))
+LIVETWEETS_ARCHIVE_BLOCK_SIZE = int(os.environ.get('LIVETWEETS_ARCHIVE_BLOCK_SIZE', 500))
+LIVETWEETS_ARCHIVE_FLUSH_INTERVAL = float(os.environ.get('LIVETWEETS_ARCHIVE_FLUSH_INTERVAL', 5))
+
+# Engagement tracking (interface.tracking). Seconds between updates, and seconds the tracker lease is held
+# without renewing before another worker takes over
+LIVETWEETS_ENGAGEMENT_INTERVAL = float(os.environ.get('LIVETWEETS_ENGAGEMENT_INTERVAL', 30))
+LIVETWEETS_TRACKER_LEASE_TTL = float(os.environ.get('LIVETWEETS_TRACKER_LEASE_TTL', 90))
+
+# Max sessions with connected dashboards per worker (interface.consumers). Dashboards opening a new session past it are
+# turned away, so arbitrary session names cannot pile up trackers and channel groups
+LIVETWEETS_MAX_SESSIONS = int(os.environ.get('LIVETWEETS_MAX_SESSIONS', 100))
+
+# Twitter API client pool of the engagement tracker (interface.clients). Max connections, and seconds an idle
+# connection is kept open. Keep it above LIVETWEETS_ENGAGEMENT_INTERVAL so connections survive between updates
+LIVETWEETS_API_POOL_SIZE = int(os.environ.get('LIVETWEETS_API_POOL_SIZE', 4))
+LIVETWEETS_API_KEEPALIVE = float(os.environ.get('LIVETWEETS_API_KEEPALIVE', 75))
+
+# Engagement history kept in memory of the tracked tweets (interface.velocity). Engagement updates kept, which must
+# reach back further than the longest window and cover LIVETWEETS_TRACKER_FLAT_POLLS polls of the tweets polled
+# every LIVETWEETS_TRACKER_COLD_EVERY updates, and the comma separated windows in seconds sent to the consumers
+LIVETWEETS_VELOCITY_CAPACITY = int(os.environ.get('LIVETWEETS_VELOCITY_CAPACITY', 32))
+LIVETWEETS_VELOCITY_WINDOWS = os.environ.get('LIVETWEETS_VELOCITY_WINDOWS', '30,60,180')
+
+# Choice of the tweets to poll for engagement (interface.priority). get_tweets requests of 100 ids per update, max
+# candidate tweets, share of the ids for the hottest tweets polled every update, updates between polls of the
+# others, polls without engagement before a tweet is evicted, and how fast the score of a tweet drops with age
+LIVETWEETS_TRACKER_REQUEST_BUDGET = int(os.environ.get('LIVETWEETS_TRACKER_REQUEST_BUDGET', 3))
+LIVETWEETS_TRACKER_CANDIDATES = int(os.environ.get('LIVETWEETS_TRACKER_CANDIDATES', 2000))
+LIVETWEETS_TRACKER_HOT_SHARE = float(os.environ.get('LIVETWEETS_TRACKER_HOT_SHARE', 0.5))
+LIVETWEETS_TRACKER_COLD_EVERY = int(os.environ.get('LIVETWEETS_TRACKER_COLD_EVERY', 4))
+LIVETWEETS_TRACKER_FLAT_POLLS = int(os.environ.get('LIVETWEETS_TRACKER_FLAT_POLLS', 6))
+LIVETWEETS_TRACKER_GRAVITY = float(os.environ.get('LIVETWEETS_TRACKER_GRAVITY', 1.5))
+
+# Retention of the stored data (interface.retention). Seconds between runs, max rows per delete, and seconds per
+# rollup bucket of the raw metrics (0 deletes them without a rollup). The ttls are in seconds, 0 keeps a table
+# forever. Keep the metrics ttl above LIVETWEETS_VELOCITY_CAPACITY * LIVETWEETS_ENGAGEMENT_INTERVAL, the history the
+# engagement tracker warms up from
+LIVETWEETS_RETENTION_INTERVAL = float(os.environ.get('LIVETWEETS_RETENTION_INTERVAL', 300))
+LIVETWEETS_RETENTION_CHUNK_SIZE = int(os.environ.get('LIVETWEETS_RETENTION_CHUNK_SIZE', 1000))
+LIVETWEETS_RETENTION_ROLLUP_BUCKET = int(os.environ.get('LIVETWEETS_RETENTION_ROLLUP_BUCKET', 300))
+LIVETWEETS_RETENTION_METRICS_TTL = int(os.environ.get('LIVETWEETS_RETENTION_METRICS_TTL', 30 * 60))
+LIVETWEETS_RETENTION_ROLLUP_TTL = int(os.environ.get('LIVETWEETS_RETENTION_ROLLUP_TTL', 7 * 24 * 3600))
+LIVETWEETS_RETENTION_TRACKED_TTL = int(os.environ.get('LIVETWEETS_RETENTION_TRACKED_TTL', 24 * 3600))
+LIVETWEETS_RETENTION_TWEET_TTL = int(os.environ.get('LIVETWEETS_RETENTION_TWEET_TTL', 7 * 24 * 3600))
+
+# Rate limit of the Twitter API tweet lookup (interface.budget), used until the API reports it in its responses:
+# requests per window, and seconds per window. LIVETWEETS_API_URL sends the API requests to another base URL, such as
+# the fake API of the fake_twitter_api command
+LIVETWEETS_API_RATE_LIMIT = int(os.environ.get('LIVETWEETS_API_RATE_LIMIT', 300))
+LIVETWEETS_API_RATE_WINDOW = int(os.environ.get('LIVETWEETS_API_RATE_WINDOW', 900))
+LIVETWEETS_API_URL = os.environ.get('LIVETWEETS_API_URL')
+
+# Max messages waiting to be sent to each websocket client (interface.outbox). When a client reads too slowly, tweets
+# are dropped oldest first and only the latest hmc and tweetmetrics are kept, status and rule messages always go out
+LIVETWEETS_OUTBOX_CAPACITY = int(os.environ.get('LIVETWEETS_OUTBOX_CAPACITY', 100))
+
+# State of each session sent to the dashboards as they connect (interface.snapshot). Tweets kept per session, and the
+# Redis database shared by the workers. Without it each worker keeps the state of the broadcasts it sent in memory.
+# Seconds to connect to Redis and to wait for its replies, and max seconds the tweets are buffered before they are sent
+LIVETWEETS_SNAPSHOT_TWEETS = int(os.environ.get('LIVETWEETS_SNAPSHOT_TWEETS', 10))
+LIVETWEETS_SNAPSHOT_REDIS_URL = os.environ.get('LIVETWEETS_SNAPSHOT_REDIS_URL', '')
+LIVETWEETS_SNAPSHOT_REDIS_TIMEOUT = float(os.environ.get('LIVETWEETS_SNAPSHOT_REDIS_TIMEOUT', 1))
+LIVETWEETS_SNAPSHOT_FLUSH_INTERVAL = float(os.environ.get('LIVETWEETS_SNAPSHOT_FLUSH_INTERVAL', 0.5))
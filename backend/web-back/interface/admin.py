@@ -4,6 +4,7 @@ from .models import *
 
 admin.site.register(Tweet)
 admin.site.register(TweetMetrics)
+admin.site.register(TweetMetricsRollup)
 admin.site.register(ReferencedTweet)
 admin.site.register(User)
 admin.site.register(UserMetrics)
@@ -15,5 +16,6 @@ admin.site.register(Mention)
 admin.site.register(ContextEntity)
 admin.site.register(ContextDomain)
 admin.site.register(TrackedTweet)
+admin.site.register(TrackerLease)
 
 # Register your models here.
@@ -0,0 +1,247 @@
+import asyncio
+import gzip
+import json
+import mmap
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from tweepy.utils import parse_datetime
+
+
+""" Archive of the raw stream payloads, in rotating compressed NDJSON segments with a time and tweet id index """
+def payload_key(line):
+    """
+    :param line: A raw payload line
+    :return: The created_at of the tweet as a POSIX timestamp and the tweet id, or (None, None) if it has no tweet
+    """
+    data = json.loads(line).get('data')
+    if not data:
+        return None, None
+    created_at = data.get('created_at')
+    return (parse_datetime(created_at).timestamp() if created_at else None), int(data['id'])
+
+
+class StreamArchive:
+    def __init__(self, directory, segment_bytes=None, segment_seconds=None, block_size=None, flush_interval=None):
+        """
+        Appends raw payloads to NDJSON segment files. The payloads are written in blocks, each compressed as its own
+        gzip member, so a segment is a normal .ndjson.gz file and any block can be decompressed on its own.
+        Next to each segment, an .idx file holds one JSON line per block with its offset and length in the segment,
+        and the range of tweet created_at timestamps and tweet ids in it.
+        Compression and writing happen in a single background thread, so appending never blocks the event loop.
+        The thread is started with the first block, and ended by close(), when the stream stops.
+        :param directory: The directory to write the segments to
+        :param segment_bytes: Size after which a new segment is started. Defaults to LIVETWEETS_ARCHIVE_SEGMENT_BYTES
+        :param segment_seconds: Age after which a new segment is started.
+        Defaults to LIVETWEETS_ARCHIVE_SEGMENT_SECONDS
+        :param block_size: Max payloads per block. Defaults to LIVETWEETS_ARCHIVE_BLOCK_SIZE
+        :param flush_interval: Max seconds a payload waits before its block is written.
+        Defaults to LIVETWEETS_ARCHIVE_FLUSH_INTERVAL
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes or settings.LIVETWEETS_ARCHIVE_SEGMENT_BYTES
+        self.segment_seconds = segment_seconds or settings.LIVETWEETS_ARCHIVE_SEGMENT_SECONDS
+        self.block_size = block_size or settings.LIVETWEETS_ARCHIVE_BLOCK_SIZE
+        self.flush_interval = flush_interval or settings.LIVETWEETS_ARCHIVE_FLUSH_INTERVAL
+        self.executor = None
+        self.buffer = list()
+        self.timer = None
+        self.pending = set()
+        self.segment = None
+        self.segment_started = None
+        self.segment_size = 0
+
+    def append(self, line):
+        """
+        Adds a raw payload to the current block. The block is handed to the writer thread when it is full, or when
+        the flush interval has passed since its first payload.
+        :param line: The raw payload, as bytes or str
+        """
+        if isinstance(line, str):
+            line = line.encode()
+        line = line.strip()
+        if not line:
+            return
+        self.buffer.append(line)
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Hands the current block to the writer thread.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+        lines, self.buffer = self.buffer, list()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stream-archive')
+        future = asyncio.get_event_loop().run_in_executor(self.executor, self.write_block, lines)
+        self.pending.add(future)
+        future.add_done_callback(self.block_written)
+
+    def block_written(self, future):
+        """
+        Prints the error of a block that could not be written.
+        """
+        self.pending.discard(future)
+        if future.exception() is not None:
+            print(f'Failed to archive stream payloads: {future.exception()!r}')
+
+    def open_segment(self):
+        """
+        Starts a new segment if there is none, or if the current one is too large or too old.
+        The segments are named after their start time, the host and the process id, and created exclusively, so
+        archives of other workers writing to the same directory never append to the same segment.
+        Runs in the writer thread.
+        :return: The path of the segment to write to
+        """
+        now = time.time()
+        if (self.segment is None or self.segment_size >= self.segment_bytes
+                or now - self.segment_started >= self.segment_seconds):
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{time.strftime('stream-%Y%m%dT%H%M%S', time.gmtime(now))}-{socket.gethostname()}-{os.getpid()}"
+            n = 1
+            while True:
+                path = os.path.join(self.directory, f'{name}-{n:03d}.ndjson.gz')
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    n += 1
+            self.segment = path
+            self.segment_started = now
+            self.segment_size = 0
+        return self.segment
+
+    def write_block(self, lines):
+        """
+        Compresses a block of payloads as one gzip member, appends it to the segment, and appends its entry to the
+        index. Runs in the writer thread.
+        :param lines: list of raw payloads as bytes
+        """
+        times = list()
+        ids = list()
+        for line in lines:
+            timestamp, tweetid = payload_key(line)
+            if timestamp is not None:
+                times.append(timestamp)
+            if tweetid is not None:
+                ids.append(tweetid)
+        block = gzip.compress(b'\n'.join(lines) + b'\n')
+        path = self.open_segment()
+        with open(path, 'ab') as file:
+            file.write(block)
+        entry = {
+            'offset': self.segment_size,
+            'length': len(block),
+            'count': len(lines),
+            'start': min(times) if times else None,
+            'end': max(times) if times else None,
+            'first_id': min(ids) if ids else None,
+            'last_id': max(ids) if ids else None,
+        }
+        with open(f'{path}.idx', 'a') as index:
+            index.write(json.dumps(entry) + '\n')
+        self.segment_size += len(block)
+
+    async def drain(self):
+        """
+        Writes the current block and waits for the writer thread to finish the blocks handed to it.
+        """
+        self.flush()
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+
+    async def close(self):
+        """
+        Writes the blocks still waiting, and shuts down the writer thread. It is started again if more payloads
+        are appended.
+        """
+        await self.drain()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def read_index(directory):
+    """
+    Reads the block indexes of all the segments in the archive.
+    :param directory: The archive directory
+    :return: Generator of (segment path, index entry) tuples, in segment order
+    """
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.ndjson.gz.idx'):
+            continue
+        with open(os.path.join(directory, name)) as index:
+            for line in index:
+                if line.strip():
+                    yield os.path.join(directory, name[:-len('.idx')]), json.loads(line)
+
+
+def read_blocks(blocks):
+    """
+    Decompresses blocks by seeking to them in the memory mapped segments, without decompressing the rest.
+    :param blocks: Iterable of (segment path, index entry) tuples
+    :return: Generator of raw payload lines
+    """
+    path = file = mapped = None
+    try:
+        for segment, entry in blocks:
+            if segment != path:
+                if mapped is not None:
+                    mapped.close()
+                    file.close()
+                path = segment
+                file = open(segment, 'rb')
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            data = gzip.decompress(mapped[entry['offset']:entry['offset'] + entry['length']])
+            for line in data.splitlines():
+                if line:
+                    yield line
+    finally:
+        if mapped is not None:
+            mapped.close()
+            file.close()
+
+
+def read_range(directory, start=None, end=None):
+    """
+    Reads the archived payloads of the tweets created within a time range.
+    Only the blocks whose index overlaps the range are decompressed.
+    :param directory: The archive directory
+    :param start: Optional datetime, the start of the range
+    :param end: Optional datetime, the end of the range
+    :return: Generator of raw payload lines
+    """
+    start = start.timestamp() if start is not None else float('-inf')
+    end = end.timestamp() if end is not None else float('inf')
+    blocks = [(segment, entry) for segment, entry in read_index(directory)
+              if entry['start'] is not None and entry['start'] <= end and entry['end'] >= start]
+    for line in read_blocks(blocks):
+        timestamp, _ = payload_key(line)
+        if timestamp is not None and start <= timestamp <= end:
+            yield line
+
+
+def read_tweet(directory, tweetid):
+    """
+    Finds the archived payload of a tweet. Only the blocks whose tweet id range holds the id are decompressed.
+    :param directory: The archive directory
+    :param tweetid: The tweet id
+    :return: The raw payload line, or None if it is not archived
+    """
+    tweetid = int(tweetid)
+    blocks = [(segment, entry) for segment, entry in read_index(directory)
+              if entry['first_id'] is not None and entry['first_id'] <= tweetid <= entry['last_id']]
+    for line in read_blocks(blocks):
+        if payload_key(line)[1] == tweetid:
+            return line
+    return None
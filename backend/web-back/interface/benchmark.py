@@ -0,0 +1,315 @@
+import asyncio
+import bisect
+import itertools
+import json
+import math
+import random
+import resource
+import time
+from datetime import datetime, timedelta, timezone
+
+import msgpack
+from asgiref.sync import sync_to_async
+from django.db import connection
+from .protocol import frame_event
+
+
+""" Synthetic filtered stream payloads and the ingestion benchmark """
+class Zipf:
+    def __init__(self, rng, size, exponent=1.1):
+        """
+        Draws ranks 0..size-1 with probability proportional to 1 / (rank + 1) ** exponent.
+        :param rng: random.Random instance
+        :param size: The number of ranks
+        :param exponent: The skew of the distribution
+        """
+        self.rng = rng
+        self.cumulative = list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(size)))
+
+    def draw(self):
+        return bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+class SyntheticStream:
+    def __init__(self, seed=0, rate=100, hashtags=5000, users=50000, domains=20, entities=300):
+        """
+        Generates payloads shaped like the ones from the filtered stream with the fields and expansions requested by
+        the consumer. Hashtags, mentions, authors and context entities are drawn from Zipf distributions, so a few
+        are very common and most are rare, as in a real stream.
+        :param seed: Seed of the random generator, the same seed gives the same payloads
+        :param rate: Tweets per second, used for the created_at times
+        :param hashtags: The number of distinct hashtags
+        :param users: The number of distinct users, both authors and mentions
+        :param domains: The number of distinct context domains
+        :param entities: The number of distinct context entities
+        """
+        self.rng = random.Random(seed)
+        self.rate = rate
+        self.hashtags = Zipf(self.rng, hashtags)
+        self.users = Zipf(self.rng, users)
+        self.entities = Zipf(self.rng, entities)
+        self.domains = domains
+        self.start = datetime(2022, 7, 17, 10, 0, tzinfo=timezone.utc)
+        self.n = 0
+
+    def user(self, rank):
+        return {
+            'id': str(10 ** 9 + rank),
+            'name': f'User {rank}',
+            'username': f'user{rank}',
+            'created_at': '2015-01-01T00:00:00.000Z',
+            'description': f'Synthetic user {rank}',
+            'protected': False,
+            'verified': rank < 100,
+        }
+
+    def payload(self):
+        """
+        :return: The next payload, as a dictionary
+        """
+        rng = self.rng
+        self.n += 1
+        tweetid = str(1550000000000000000 + self.n)
+        created_at = self.start + timedelta(seconds=self.n / self.rate)
+        author = self.users.draw()
+        tags = [f'tag{self.hashtags.draw()}' for _ in range(rng.choice([0, 1, 1, 2, 3]))]
+        mentioned = [self.users.draw() for _ in range(rng.choice([0, 0, 1, 1, 2]))]
+        contexts = list()
+        for _ in range(rng.choice([0, 1, 2, 3, 4])):
+            entity = self.entities.draw()
+            domain = entity % self.domains
+            contexts.append({
+                'domain': {'id': str(10 + domain), 'name': f'Domain {domain}'},
+                'entity': {'id': str(10 ** 15 + entity), 'name': f'Entity {entity}'},
+            })
+        text = ' '.join([f'Synthetic tweet {self.n}'] + [f'#{tag}' for tag in tags] +
+                        [f'@user{rank}' for rank in mentioned])
+        data = {
+            'id': tweetid,
+            'text': text,
+            'edit_history_tweet_ids': [tweetid],
+            'author_id': str(10 ** 9 + author),
+            'conversation_id': tweetid,
+            'created_at': created_at.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            'lang': 'en',
+            'possibly_sensitive': False,
+            'reply_settings': 'everyone',
+            'source': 'Synthetic',
+            'entities': {
+                'hashtags': [{'start': 0, 'end': 0, 'tag': tag} for tag in tags],
+                'mentions': [{'start': 0, 'end': 0, 'username': f'user{rank}', 'id': str(10 ** 9 + rank)}
+                             for rank in mentioned],
+            },
+        }
+        if contexts:
+            data['context_annotations'] = contexts
+        includes = {'users': [self.user(author)] + [self.user(rank) for rank in mentioned]}
+        if rng.random() < 0.2:
+            includes['media'] = [{'media_key': f'3_{tweetid}_{i}', 'type': 'photo',
+                                  'url': f'https://pbs.twimg.com/media/{tweetid}_{i}.jpg', 'height': 1080,
+                                  'width': 1920} for i in range(rng.choice([1, 1, 2]))]
+            data['attachments'] = {'media_keys': [media['media_key'] for media in includes['media']]}
+        return {'data': data, 'includes': includes, 'matching_rules': [{'id': '1', 'tag': 'benchmark'}]}
+
+    def lines(self, n):
+        """
+        :param n: The number of payloads
+        :return: list of n payloads as raw NDJSON lines
+        """
+        return [json.dumps(self.payload()).encode() for _ in range(n)]
+
+
+class QueryCounter:
+    def __init__(self):
+        """
+        Counts the queries run on a database connection. Used as an execute wrapper.
+        """
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def install_query_counter(counter):
+    """
+    Adds the query counter to the connection of the calling thread. Called through sync_to_async, as the ORM
+    helpers of the stream all run in the same thread.
+    """
+    connection.execute_wrappers.append(counter)
+
+
+def remove_query_counter(counter):
+    connection.execute_wrappers.remove(counter)
+
+
+def percentile(values, p):
+    """
+    :return: The p-th percentile of the values, by the nearest rank
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+async def run_ingest_benchmark(stream, lines):
+    """
+    Feeds the payloads into the stream's on_data method, the path taken by live payloads, and waits for everything
+    to be stored.
+    :param stream: The LiveStream to feed
+    :param lines: list of raw payload lines
+    :return: Dictionary of the measurements
+    """
+    counter = QueryCounter()
+    await sync_to_async(install_query_counter)(counter)
+    latencies = list()
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    try:
+        for line in lines:
+            before = time.perf_counter()
+            await stream.on_data(line)
+            latencies.append(time.perf_counter() - before)
+        await stream.ingest.stop()
+        await stream.hmc.stop()
+        if stream.archive is not None:
+            await stream.archive.close()
+        seconds = loop.time() - start
+    finally:
+        await sync_to_async(remove_query_counter)(counter)
+    return {
+        'tweets': len(lines),
+        'seconds': round(seconds, 3),
+        'tweets_per_second': round(len(lines) / seconds, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+        },
+        'queries': counter.queries,
+        'queries_per_tweet': round(counter.queries / len(lines), 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# Metric path, and whether higher is better
+COMPARED_METRICS = [
+    (('tweets_per_second',), True),
+    (('latency_ms', 'p50'), False),
+    (('latency_ms', 'p99'), False),
+    (('queries_per_tweet',), False),
+    (('peak_rss_mb',), False),
+]
+
+
+def compare_results(baseline, result, tolerance):
+    """
+    Compares a benchmark result to a baseline result.
+    :param baseline: The baseline result dictionary
+    :param result: The new result dictionary
+    :param tolerance: The relative change allowed before a metric counts as a regression, e.g. 0.1 for 10 %
+    :return: list of (metric name, baseline value, new value, relative change, regressed) tuples
+    """
+    rows = list()
+    for path, higher_is_better in COMPARED_METRICS:
+        old, new = baseline, result
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        rows.append(('.'.join(path), old, new, change, regressed))
+    return rows
+
+
+""" Fan-out of the group broadcasts to the consumers """
+def synthetic_broadcasts(seed=0, tracked=100):
+    """
+    Builds an hmc and a tweetmetrics message for the websocket clients, the size of what a busy stream sends.
+    :param seed: Seed of the random counts and names
+    :param tracked: The number of tweets in the metrics
+    :return: list of the messages
+    """
+    rng = random.Random(seed)
+    hmc = {
+        'type': 'hmc',
+        'hashtags': [{'hashtag': f'hashtag{rank}', 'count': rng.randint(1, 5000)} for rank in range(10)],
+        'mentions': [{'mention': f'user{rank}', 'count': rng.randint(1, 5000)} for rank in range(10)],
+        'contexts': [{'name': f'Context entity {rank}', 'id': f'{rng.randint(10, 99)}.{rng.randint(10 ** 17, 10 ** 18)}',
+                      'count': rng.randint(1, 5000)} for rank in range(10)],
+    }
+    ids = [str(rng.randint(10 ** 18, 2 * 10 ** 18)) for _ in range(tracked)]
+    tweetmetrics = {
+        'type': 'tweetmetrics',
+        'results': {window: [{'id': tweetid, 'count': rng.randint(1, 500)} for tweetid in ids[:5]]
+                    for window in ('30', '60', '180')},
+        'MT_data': [{'id': tweetid, 'name': f'user{rng.randint(0, 50000)}', 'Retweet_count': rng.randint(0, 10 ** 4),
+                     'Like_count': rng.randint(0, 10 ** 5), 'Quote_count': rng.randint(0, 10 ** 3),
+                     'Reply_count': rng.randint(0, 10 ** 3)} for tweetid in ids],
+    }
+    return [hmc, tweetmetrics]
+
+
+def channel_layer_copy(event):
+    """
+    :return: The event after a trip through the channel layer, serialized and deserialized with MessagePack as
+    channels_redis does for every consumer it is delivered to
+    """
+    return msgpack.unpackb(msgpack.packb(event, use_bin_type=True), raw=False)
+
+
+async def run_broadcast_benchmark(consumer_class, subscribers, messages, rounds, protocol=None):
+    """
+    Delivers the messages to a number of consumers, whose websocket sends are discarded, and measures the CPU time
+    per broadcast until the outboxes of the consumers are empty, both with the frames encoded once per worker and
+    protocol and with every consumer encoding the message itself, as the consumers did before the frames were shared.
+    :param consumer_class: The consumer class, TweetConsumer
+    :param subscribers: The number of consumers
+    :param messages: list of messages for the websocket clients, see synthetic_broadcasts
+    :param rounds: The number of times each message is broadcast
+    :param protocol: The subprotocol of the consumers, None for JSON
+    :return: Dictionary of the measurements
+    """
+    sent = list()
+
+    async def send(text_data=None, bytes_data=None):
+        sent.append(len(text_data or bytes_data))
+
+    consumers = list()
+    for _ in range(subscribers):
+        consumer = consumer_class()
+        consumer.group = 'benchmark'
+        consumer.protocol = protocol
+        consumer.send = send
+        consumers.append(consumer)
+
+    start = time.process_time()
+    for _ in range(rounds):
+        for message in messages:
+            for consumer in consumers:
+                await consumer.send_message(channel_layer_copy(message))
+            await asyncio.sleep(0)
+    per_consumer = (time.process_time() - start) / (rounds * len(messages))
+
+    sent.clear()
+    start = time.process_time()
+    for _ in range(rounds):
+        for message in messages:
+            # A full hmc message is numbered, for the consumers to apply the deltas after it to
+            event = frame_event(message, seq=1) if message['type'] == 'hmc' else frame_event(message)
+            for consumer in consumers:
+                await getattr(consumer, message['type'])(channel_layer_copy(event))
+            await asyncio.sleep(0)
+    frames = (time.process_time() - start) / (rounds * len(messages))
+    for consumer in consumers:
+        consumer.outbox.stop()
+
+    return {
+        'subscribers': subscribers,
+        'per_consumer_encoding_ms': round(per_consumer * 1000, 3),
+        'shared_frames_ms': round(frames * 1000, 3),
+        'speedup': round(per_consumer / frames, 2) if frames else None,
+        'bytes_per_frame': round(sum(sent) / len(sent)) if sent else 0,
+    }
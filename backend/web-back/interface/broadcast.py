@@ -0,0 +1,183 @@
+import asyncio
+import uuid
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .protocol import event_message, frame_event
+from .snapshot import get_state_cache
+
+
+HMC_LISTS = ('hashtags', 'mentions', 'contexts')
+
+""" The channel group of the hmc lists. They are counted over the tweets of all sessions, so every dashboard joins it.
+Only the worker holding the filtered stream counts the tweets and sends them, see interface.streaming """
+HMC_GROUP = 'hmc'
+
+
+""" Coalesced, rate limited broadcasting of the most popular hashtags, mentions and contexts """
+class HmcBroadcaster:
+    def __init__(self, source, group=HMC_GROUP, max_rate=None, deltas=None, keyframe_interval=None, refresh=None):
+        """
+        Sets up the broadcaster. Updates are requested with notify(), and sent to the channel group at most
+        max_rate times per second. Requests arriving while a send is due are coalesced into that send.
+        Every message carries the id of the broadcaster as its 'sender', so the deltas of one broadcaster are never
+        applied to the lists of another one sending to the same group, e.g. after another worker took over the stream.
+        :param source: Function returning the hashtag, mention and context lists. Called through sync_to_async
+        :param group: The channel group to send to. Defaults to the hmc group every consumer joins
+        :param max_rate: Max sends per second. Defaults to LIVETWEETS_HMC_MAX_RATE
+        :param deltas: Send only the changed ranks between full updates. Defaults to LIVETWEETS_HMC_DELTAS
+        :param keyframe_interval: Max seconds between full updates when sending deltas.
+        Defaults to LIVETWEETS_HMC_KEYFRAME_INTERVAL
+        :param refresh: Optional function called through sync_to_async before the lists are read, at most once per
+        keyframe interval, e.g. to read the counts from the database again
+        """
+        self.source = source
+        self.group = group
+        self.max_rate = max_rate or settings.LIVETWEETS_HMC_MAX_RATE
+        self.deltas = settings.LIVETWEETS_HMC_DELTAS if deltas is None else deltas
+        self.keyframe_interval = keyframe_interval or settings.LIVETWEETS_HMC_KEYFRAME_INTERVAL
+        self.dirty = False
+        self.task = None
+        self.last = None
+        self.last_sent = None
+        self.last_keyframe = None
+        self.refresh = refresh
+        self.last_refresh = None
+        self.seq = 0
+        self.sender = uuid.uuid4().hex[:8]
+
+    def notify(self):
+        """
+        Requests an update. Starts the sending task if it is not already waiting to send.
+        """
+        self.dirty = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        """
+        Sends updates as long as new ones are requested, waiting between sends to keep under the max rate.
+        """
+        loop = asyncio.get_event_loop()
+        while self.dirty:
+            if self.last_sent is not None:
+                wait = self.last_sent + 1 / self.max_rate - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.dirty = False
+            self.last_sent = loop.time()
+            try:
+                await self.send()
+            except Exception as e:
+                print(f'Failed to send hmc: {e!r}')
+
+    def build_event(self, lists, now):
+        """
+        Builds the message for the channel group. Returns None if nothing changed since the last message.
+        A full message holds the three lists in the packed message for the websocket clients, see
+        interface.protocol.frame_event. A delta message holds [rank, item] pairs for the ranks that changed,
+        and the new length of each list. It applies to the message with seq equal to its 'base'.
+        :param lists: Dictionary of 'hashtags', 'mentions' and 'contexts' lists
+        :param now: The current loop time
+        :return: The message, or None
+        """
+        if lists == self.last:
+            return None
+        self.seq += 1
+        keyframe_due = self.last_keyframe is None or now - self.last_keyframe >= self.keyframe_interval
+        if not self.deltas or self.last is None or keyframe_due:
+            self.last_keyframe = now
+            event = frame_event({"type": "hmc", **lists}, seq=self.seq, sender=self.sender)
+        else:
+            event = {"type": "hmc", "seq": self.seq, "sender": self.sender, "base": self.seq - 1, "delta": True,
+                     "lengths": dict()}
+            for name in HMC_LISTS:
+                old = self.last[name]
+                event[name] = [[rank, item] for rank, item in enumerate(lists[name])
+                               if rank >= len(old) or old[rank] != item]
+                event["lengths"][name] = len(lists[name])
+        self.last = lists
+        return event
+
+    async def send(self):
+        """
+        Gets the current lists, after refreshing them if it is due, and sends them, or the ranks that changed, to the
+        channel group, and stores them in the state cache for the dashboards that connect later, whatever their
+        session, with their seq and sender so the consumers of these dashboards can apply the deltas that follow.
+        Nothing is sent if the lists are unchanged.
+        """
+        now = asyncio.get_event_loop().time()
+        refresh_due = self.last_refresh is None or now - self.last_refresh >= self.keyframe_interval
+        if self.refresh is not None and refresh_due:
+            self.last_refresh = now
+            await sync_to_async(self.refresh)()
+        hashtags, mentions, contexts = await sync_to_async(self.source)()
+        lists = {"hashtags": hashtags, "mentions": mentions, "contexts": contexts}
+        event = self.build_event(lists, now)
+        if event is None:
+            return
+        channel_layer = get_channel_layer()
+        await channel_layer.group_send(self.group, event)
+        await get_state_cache().set_hmc({"type": "hmc", "seq": self.seq, "sender": self.sender, **lists})
+
+    async def stop(self):
+        """
+        Waits for a requested update to be sent.
+        """
+        if self.task is not None and not self.task.done():
+            await self.task
+
+
+def apply_hmc_event(state, event):
+    """
+    Applies an hmc message from the channel group to the lists last received.
+    :param state: Dictionary with the last lists, their 'seq' and 'sender', or None if nothing is received yet
+    :param event: The hmc message
+    :return: The new state, or None if the message is a delta that does not apply to the state
+    """
+    if not event.get('delta'):
+        return hmc_state(dict(event_message(event), seq=event.get('seq'), sender=event.get('sender')))
+    if state is None or state['sender'] != event.get('sender') or state['seq'] != event['base']:
+        return None
+    new = {'seq': event['seq'], 'sender': event.get('sender')}
+    for name in HMC_LISTS:
+        items = state[name][:event['lengths'][name]]
+        for rank, item in event[name]:
+            if rank < len(items):
+                items[rank] = item
+            else:
+                items.append(item)
+        new[name] = items
+    return new
+
+
+def hmc_state(message):
+    """
+    :param message: A full hmc message with its 'seq' and 'sender', e.g. the one of the snapshot
+    :return: The state of the lists in the message, to apply the deltas that follow it to
+    """
+    state = {name: list(message[name]) for name in HMC_LISTS}
+    state['seq'] = message.get('seq')
+    state['sender'] = message.get('sender')
+    return state
+
+
+def hmc_message(state):
+    """
+    :param state: The state returned by apply_hmc_event or hmc_state
+    :return: The hmc message of the lists, as the websocket clients get it
+    """
+    message = {'type': 'hmc'}
+    message.update((name, state[name]) for name in HMC_LISTS)
+    return message
+
+
+def hmc_event(state):
+    """
+    Builds the event of the lists rebuilt from a delta message, keyed by their sender and seq, so the consumers of
+    this worker that rebuilt the same lists share their frames, see interface.protocol.event_frame.
+    :param state: The state returned by apply_hmc_event
+    :return: The event
+    """
+    return {'type': 'hmc', 'key': f"hmc:{state['sender']}:{state['seq']}", 'message': hmc_message(state)}
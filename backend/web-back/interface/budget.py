@@ -0,0 +1,94 @@
+import time
+
+from django.conf import settings
+
+
+""" Spreading of the Twitter API request allowance over the engagement updates """
+class RequestBudget:
+    def __init__(self, limit=None, window=None, burst=None):
+        """
+        A token bucket of API requests. Tokens refill at the rate the API allows, and each request takes one.
+        Until the API has told us its limits, the rate is the configured limit per window. Once a response carries
+        the x-rate-limit headers, the requests remaining in the window are spread evenly over the time left until it
+        resets, so the allowance lasts for every engagement update of the window instead of running out early and
+        stalling the tracker until the reset. A 429 response empties the bucket until the reset.
+        :param limit: Requests per window. Defaults to LIVETWEETS_API_RATE_LIMIT
+        :param window: Seconds per window. Defaults to LIVETWEETS_API_RATE_WINDOW
+        :param burst: Max tokens saved up, the most requests one update can make.
+        Defaults to twice LIVETWEETS_TRACKER_REQUEST_BUDGET, as each poll may need a lookup of the referenced tweets
+        """
+        self.limit = limit or settings.LIVETWEETS_API_RATE_LIMIT
+        self.window = window or settings.LIVETWEETS_API_RATE_WINDOW
+        self.burst = burst or 2 * settings.LIVETWEETS_TRACKER_REQUEST_BUDGET
+        self.rate = self.limit / self.window
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.remaining = None
+        self.reset = None
+        self.throttled = 0
+
+    def refill(self, now):
+        """
+        Adds the tokens earned since the last refill, and goes back to the configured rate once the window has reset.
+        """
+        if self.reset is not None and now >= self.reset:
+            self.remaining = None
+            self.reset = None
+            self.rate = self.limit / self.window
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def observe(self, status, headers, now=None):
+        """
+        Takes in the rate limit headers of an API response.
+        :param status: The HTTP status of the response
+        :param headers: The response headers
+        :param now: Optional POSIX timestamp, defaults to the current time
+        """
+        now = now or time.time()
+        try:
+            limit = int(headers['x-rate-limit-limit'])
+            remaining = int(headers['x-rate-limit-remaining'])
+            reset = int(headers['x-rate-limit-reset'])
+        except (KeyError, ValueError):
+            return
+        self.refill(now)
+        if status == 429:
+            self.throttled += 1
+            remaining = 0
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.rate = remaining / max(1.0, reset - now)
+        self.tokens = min(self.tokens, remaining)
+
+    def allowance(self, now=None):
+        """
+        :return: The number of requests that can be made now
+        """
+        self.refill(now or time.time())
+        return int(self.tokens)
+
+    def take(self, now=None):
+        """
+        Takes a token for a request.
+        :return: True if the request can be made
+        """
+        self.refill(now or time.time())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def stats(self):
+        """
+        :return: Dictionary of the tokens left, the refill rate per minute, the requests left in the window according
+        to the API, the seconds until it resets, and the number of 429 responses
+        """
+        return {
+            'tokens': round(self.tokens, 2),
+            'per_minute': round(self.rate * 60, 2),
+            'remaining': self.remaining,
+            'reset_in': round(self.reset - time.time()) if self.reset is not None else None,
+            'throttled': self.throttled,
+        }
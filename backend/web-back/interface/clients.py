@@ -0,0 +1,106 @@
+import aiohttp
+from django.conf import settings
+from tweepy.asynchronous import AsyncClient
+
+
+class RedirectedSession:
+    def __init__(self, session, api_url):
+        """
+        Stands in for the aiohttp session of an AsyncClient, and sends its requests to another base URL.
+        AsyncClient always builds its URLs on https://api.twitter.com.
+        :param session: The aiohttp ClientSession
+        :param api_url: The base URL to send the requests to
+        """
+        self.session = session
+        self.api_url = api_url.rstrip('/')
+
+    @property
+    def closed(self):
+        return self.session.closed
+
+    def request(self, method, url, **kwargs):
+        url = str(url)
+        if url.startswith('https://api.twitter.com'):
+            url = self.api_url + url[len('https://api.twitter.com'):]
+        return self.session.request(method, url, **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+
+""" Long-lived Twitter API client with a pooled, keep-alive HTTP session """
+class ClientPool:
+    def __init__(self, bearer_token, limit=None, keepalive_timeout=None, budget=None, api_url=None):
+        """
+        Holds one AsyncClient and the aiohttp session it sends its requests through, so connections to the API
+        are kept open and reused between engagement updates instead of being set up again for every request.
+        Counts the connections created and reused, to confirm the reuse.
+        :param bearer_token: Twitter API 2.0 Bearer Token.
+        :param limit: Max simultaneous connections. Defaults to LIVETWEETS_API_POOL_SIZE
+        :param keepalive_timeout: Seconds an idle connection is kept open. Defaults to LIVETWEETS_API_KEEPALIVE
+        :param budget: Optional RequestBudget, given the rate limit headers of the tweet lookup responses
+        :param api_url: Optional base URL the requests are sent to instead of https://api.twitter.com, e.g. a fake
+        API. Defaults to LIVETWEETS_API_URL
+        """
+        self.bearer_token = bearer_token
+        self.limit = limit or settings.LIVETWEETS_API_POOL_SIZE
+        self.keepalive_timeout = keepalive_timeout or settings.LIVETWEETS_API_KEEPALIVE
+        self.budget = budget
+        self.api_url = api_url or settings.LIVETWEETS_API_URL
+        self.session = None
+        self.client = None
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    async def on_request_start(self, session, context, params):
+        self.requests += 1
+
+    async def on_request_end(self, session, context, params):
+        if self.budget is not None and params.url.path.startswith('/2/tweets'):
+            self.budget.observe(params.response.status, params.response.headers)
+
+    async def on_connection_create_end(self, session, context, params):
+        self.connections_created += 1
+
+    async def on_connection_reuseconn(self, session, context, params):
+        self.connections_reused += 1
+
+    def get(self):
+        """
+        Gets the client, opening the session on first use or after the pool was closed.
+        Must be called from the event loop the client is used on.
+        :return: The AsyncClient
+        """
+        if self.session is None or self.session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self.on_request_start)
+            trace.on_request_end.append(self.on_request_end)
+            trace.on_connection_create_end.append(self.on_connection_create_end)
+            trace.on_connection_reuseconn.append(self.on_connection_reuseconn)
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+            self.client = AsyncClient(self.bearer_token)
+            self.client.session = RedirectedSession(self.session, self.api_url) if self.api_url else self.session
+        return self.client
+
+    def stats(self):
+        """
+        :return: Dictionary of the requests sent, connections created and reused, and the share of reused ones
+        """
+        connections = self.connections_created + self.connections_reused
+        return {
+            'requests': self.requests,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'reuse_ratio': round(self.connections_reused / connections, 3) if connections else None,
+        }
+
+    async def close(self):
+        """
+        Closes the session and its connections. The next get() opens a new one.
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.client = None
@@ -1,18 +1,72 @@
-import asyncio
 from cgi import test
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async
+from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
 from os import environ
-from tweepy import TweepyException, StreamRule
-from .models import StreamRules, Tweet
-from .livetweets import LiveStream, EngagementTracker, set_rules_to_inactive
+from tweepy import StreamRule
+from .models import StreamRules
+from .livetweets import LiveStream, EngagementTracker
+from .broadcast import HMC_GROUP, apply_hmc_event, hmc_event, hmc_message, hmc_state
+from .rules import RULES_GROUP, invalidate_tracked_terms, session_tag, split_tag
+from .streaming import STREAM_GROUP, StreamService
+from .tracking import TrackerService
+from .retention import RetentionWorker
+from .snapshot import get_state_cache
+from .outbox import Outbox
+from .protocol import MSGPACK_PROTOCOL, choose_protocol, encode_frame, event_frame, event_message
 from random import randint
 from asyncio import sleep
 
 
 TWITTER_BEARER_TOKEN = environ['TWITTER_BEARER_TOKEN']
 
+""" The engagement tracking of each session with consumers in this worker, shared by them and elected across workers """
+TRACKERS = dict()
+
+""" The pruning of old data, run by one worker at a time """
+RETENTION = RetentionWorker()
+
+""" The filtered stream shared by all sessions, connected by one worker at a time """
+STREAM_SERVICE = StreamService(lambda: LiveStream(bearer_token=TWITTER_BEARER_TOKEN), lambda: TRACKERS.keys())
+
+def get_tracker_service(group):
+    """
+    Gets the engagement tracking of a session in this worker, created on first use.
+    :param group: The channel group of the session
+    :return: The TrackerService of the session
+    """
+    if group not in TRACKERS:
+        TRACKERS[group] = TrackerService(lambda: EngagementTracker(TWITTER_BEARER_TOKEN, group=group), group=group)
+    return TRACKERS[group]
+
+
+async def release_tracker_service(group, channel_name):
+    """
+    Unsubscribes a consumer from the engagement tracking of its session, and forgets the tracking of the session in
+    this worker once its last consumer is gone.
+    :param group: The channel group of the session
+    :param channel_name: The channel name of the consumer
+    """
+    service = TRACKERS.get(group)
+    if service is None:
+        return
+    await service.unsubscribe(channel_name)
+    if not service.subscribers and TRACKERS.get(group) is service:
+        del TRACKERS[group]
+
+
+def session_group(scope):
+    """
+    :param scope: The scope of the websocket connection
+    :return: The channel group of the session given in the URL, or the 'tweet' group if none is given
+    """
+    session = scope['url_route']['kwargs'].get('session')
+    return f'tweet.{session}' if session else 'tweet'
+
+
 """ Helper functions for sync_to_async """
 def get_dupe_rule_ids(tag):
     """
@@ -25,17 +79,6 @@ def get_dupe_rule_ids(tag):
     return ids
 
 
-def get_tweet_time(tweetid):
-    """
-    Takes a tweetid and returns the time the tweet was created
-    :param tweetid: A tweetid as a string
-    :return: The 'created_at' attribute of the tweet
-    """
-    tweet = Tweet.objects.get(pk=tweetid)
-    time = tweet.created_at
-    return time
-
-
 """ The consumer class for our Websocket"""
 class TweetConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
@@ -48,16 +91,75 @@ class TweetConsumer(AsyncWebsocketConsumer):
         super().__init__(*args, **kwargs)
         self.STREAM = None
         self.session = None
-        self.engagement_tracker = EngagementTracker(TWITTER_BEARER_TOKEN)
+        self.group = None
+        self.engagement = None
+        self.hmc_state = None
+        self.protocol = None
+        self.outbox = Outbox(lambda frame: self.send(**frame), name='Consumer outbox')
 
     async def connect(self):
         """
-        Currently only connects to the 'tweet' group. For multiple concurrent connections, the consumer
-        should receive a group through the URL request, and connect to that instead.
-        Accept any incoming connection.
+        Connects to the channel group of the session given in the URL (ws/tweets/<session>), or to the 'tweet' group
+        if none is given, so each dashboard only receives the tweets, metrics and rules of its own session. Also joins
+        the rules group, which tells every worker when the stored rules change, the hmc group: the popular
+        hashtags, mentions and contexts are counted over all the sessions, so they are sent once to every dashboard,
+        and the stream group, with the status of the filtered stream shared by the sessions.
+        Accept any incoming connection, subscribe to the shared engagement tracking of the session, and start the
+        retention and filtered stream loops of this worker if they are not running yet. A new session is refused when
+        this worker already has LIVETWEETS_MAX_SESSIONS sessions with connected dashboards.
+        The framing of the messages we send is chosen from the subprotocols the client asks for: 'livetweets.msgpack'
+        gets binary MessagePack frames with short keys, 'livetweets.json' or none gets JSON text frames.
+        Messages are sent through the outbox of the consumer, so a slow client does not hold up our handlers.
+        The first message is the snapshot of the session from the state cache: its rules, latest hmc lists, latest
+        tweet metrics and last tweets, so the dashboard is drawn right away without reading the database. The hmc
+        lists of the snapshot are also where the deltas broadcast after it are applied.
+        """
+        group = session_group(self.scope)
+        if group not in TRACKERS and len(TRACKERS) >= settings.LIVETWEETS_MAX_SESSIONS:
+            print(f'Refused {group}: {len(TRACKERS)} sessions already open')
+            await self.close()
+            return
+        self.group = group
+        self.engagement = get_tracker_service(self.group)
+        self.engagement.subscribe(self.channel_name)
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.channel_layer.group_add(RULES_GROUP, self.channel_name)
+        await self.channel_layer.group_add(HMC_GROUP, self.channel_name)
+        await self.channel_layer.group_add(STREAM_GROUP, self.channel_name)
+        RETENTION.start()
+        STREAM_SERVICE.start()
+        self.protocol = choose_protocol(self.scope)
+        await self.accept(subprotocol=self.protocol)
+        snapshot = await get_state_cache().snapshot(self.group)
+        if snapshot['hmc'] is not None:
+            self.hmc_state = hmc_state(snapshot['hmc'])
+            snapshot['hmc'] = hmc_message(self.hmc_state)
+        await self.send_message(snapshot)
+
+    async def send_message(self, message):
+        """
+        Queues a message in the outbox, in the framing chosen when the connection was set up.
+        :param message: Dictionary with a 'type'
+        """
+        self.queue_frame(message['type'], encode_frame(message, self.protocol))
+
+    async def send_event(self, event):
+        """
+        Queues the message of a broadcast in the outbox, encoded once for all the consumers of this worker that speak
+        the protocol of this connection.
+        :param event: The event, see interface.protocol.frame_event
+        """
+        self.queue_frame(event['type'], event_frame(event, self.protocol))
+
+    def queue_frame(self, kind, frame):
+        """
+        :param kind: The type of the message
+        :param frame: The encoded message, sent as a binary frame for the binary protocol, else as a text frame
         """
-        await self.channel_layer.group_add('tweet', self.channel_name)
-        await self.accept()
+        if self.protocol == MSGPACK_PROTOCOL:
+            self.outbox.put(kind, {'bytes_data': frame})
+        else:
+            self.outbox.put(kind, {'text_data': frame})
 
     async def receive(self, text_data=None, bytes_data=None):
         """
@@ -65,17 +167,22 @@ class TweetConsumer(AsyncWebsocketConsumer):
         The tasks are referred to in the 'task' attribute.
         We are currently handling the following tasks:
 
-        'loadstream': Initiates the LiveStream instance runs the class' 'update_rules_from_twitter' method,
+        'loadstream': Gets the LiveStream of this worker, runs the class' 'update_rules_from_twitter' method,
         and sends the message "Stream initiated" back to the websocket.
 
-        'startstream': Establishes the connection to twitter, and starts receiving tweets.
+        'startstream': Marks the session as streaming, so the worker holding the filtered stream connects to twitter
+        if it is not connected yet, and sends the tweets matching the rules of the session to its group.
 
-        'stopstream': Stops the streaming connection to twitter. Also stops the engagement tracking loop.
+        'stopstream': Marks the session as not streaming, so its tweets are no longer sent, and the connection to
+        twitter is closed when no session is streaming. Also stops the engagement tracking of the session, in every
+        worker, so another worker does not take over the lease this one gives up.
 
-        'rulelist': Reads the 'rules' attribute of the message, checks the database for duplicate rules, deletes any
-        duplicate rules from twitter, and finally adds the new rules to the stream.
+        'rulelist': Reads the 'rules' attribute of the message, tags them with the session, checks the database for
+        duplicate rules of the session, deletes any duplicate rules from twitter, and finally adds the new rules to
+        the stream.
 
-        'deleterules': Deletes any rules from twitter, and sets them to "inactive" in the database.
+        'deleterules': Deletes the rules of the session from twitter, and sets them to "inactive" in the database.
+        The rules are shared by all the sessions, so the rules of the other sessions are left as they are.
 
         :param text_data: The text_data from the websocket
         :param bytes_data: The bytes_data from the websocket
@@ -85,171 +192,186 @@ class TweetConsumer(AsyncWebsocketConsumer):
         data = json.loads(text_data)
         if data['type'] == 'loadstream':
             if self.STREAM is not None:
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'status',
-                    'stream': 'Stream already initiated'}))
+                    'stream': 'Stream already initiated'})
                 return
-            self.STREAM = LiveStream(bearer_token=TWITTER_BEARER_TOKEN)
-            await self.STREAM.update_rules_from_twitter()
-            await self.send(text_data=json.dumps({
+            self.STREAM = STREAM_SERVICE.get_stream()
+            await self.STREAM.update_rules_from_twitter([self.group])
+            await self.send_message({
                 'type': 'status',
-                'stream': 'Stream initiated'}))
+                'stream': 'Stream initiated'})
         if data['type'] == 'startstream':
             if self.STREAM is None:
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'status',
-                    'stream': 'No active stream'}))
+                    'stream': 'No active stream'})
                 return
-            try:
-                res = self.STREAM.filter(
-                    tweet_fields=['id', 'text', 'attachments', 'author_id', 'context_annotations', 'conversation_id',
-                                  'created_at', 'entities', 'geo', 'in_reply_to_user_id', 'lang', 'possibly_sensitive',
-                                  'public_metrics', 'referenced_tweets', 'reply_settings', 'source', 'withheld'],
-                    expansions=['entities.mentions.username', 'geo.place_id', 'author_id', 'attachments.media_keys'],
-                    place_fields=['contained_within', 'country', 'country_code', 'full_name', 'name', 'place_type'],
-                    media_fields=['url', 'preview_image_url'])
-                print(res)
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': 'Stream connecting'}))
-            except TweepyException:
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': f'{TweepyException}'}))
+            await self.set_streaming(True)
+            await self.send_message({
+                'type': 'status',
+                'stream': 'Stream connecting'})
 
         if data['type'] == 'stopstream':
             if self.STREAM is None:
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'status',
-                    'stream': 'No active stream'}))
+                    'stream': 'No active stream'})
                 return
-            self.STREAM.disconnect()
-            await self.send(
-                text_data=json.dumps({'type': 'status', 'stream': 'Disconnect signal sent'}))
-            self.engagement_tracker.tracking = False
+            await self.set_streaming(False)
+            await self.send_message({'type': 'status', 'stream': 'Disconnect signal sent'})
+            await self.channel_layer.group_send(self.group, {'type': 'tracking.stop'})
 
         if data['type'] == 'rulelist':
             if self.STREAM is None:
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'status',
-                    'stream': 'No active stream'}))
+                    'stream': 'No active stream'})
                 return
             rulelist = list()
             dupes = list()
 
             for rule in data['rules']:
                 if rule['value']:
+                    tag = session_tag(self.group, rule['tag'])
                     r = StreamRule(
                         value=rule['value'],
-                        tag=rule['tag'],
+                        tag=tag,
                     )
-                    ids = await sync_to_async(get_dupe_rule_ids)(rule['tag'])
+                    ids = await sync_to_async(get_dupe_rule_ids)(tag)
                     for id in ids:
                         dupes.append(id)
                     rulelist.append(r)
             if dupes:
                 await self.STREAM.delete_rules(dupes)
             await self.STREAM.add_rules(rulelist)
-            await self.STREAM.update_rules_from_twitter()
+            await self.STREAM.update_rules_from_twitter([self.group])
 
         if data['type'] == 'deleterules':
             if self.STREAM is None:
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'status',
-                    'stream': 'No active stream'}))
+                    'stream': 'No active stream'})
                 return
             ids = list()
             rules = await self.STREAM.get_rules()
-            if rules[0] is not None:
-                for rule in rules[0]:
+            for rule in rules[0] or []:
+                if split_tag(rule.tag)[0] == self.group:
                     ids.append(rule.id)
+            if ids:
                 await self.STREAM.delete_rules(ids)
-                rules = await self.STREAM.get_rules()
-            if rules.data is None:
-                await self.send(text_data=json.dumps({
+            rules = await self.STREAM.update_rules_from_twitter([self.group])
+            if not rules[self.group]:
+                await self.send_message({
                     'type': 'rulestatus',
-                    'stream': 'No rules stored in stream'}))
-                await sync_to_async(set_rules_to_inactive)()
+                    'stream': 'No rules stored in stream'})
+
+    async def set_streaming(self, streaming):
+        """
+        Marks the session as streaming or not in the state cache, and tells the filtered stream loop of every worker
+        to pick up the change right away.
+        :param streaming: True if the session is streaming
+        """
+        await get_state_cache().set_streaming(self.group, streaming)
+        await self.channel_layer.group_send(STREAM_GROUP, {'type': 'stream.changed'})
 
     async def disconnect(self, code):
         """
         Recieved upon a connection dropping from the websocket.
-        In that case we stop the engagement tracking, disconnect the stream, and unsubscribe from the 'tweet'
-        channel.
+        In that case we unsubscribe from the engagement tracking, which stops and is dropped when no consumer of the
+        session is left in this worker, in which case the filtered stream loop checks if this worker still needs the
+        stream. Then we unsubscribe from the session, rules, hmc and stream channels, and stop the outbox, printing
+        what it dropped for the client if anything.
         :param code: The disconnection code received from the websocket
         """
-        self.engagement_tracker.tracking = False
-        if self.STREAM is not None:
-            self.STREAM.disconnect()
-        await self.channel_layer.group_discard('tweet', self.channel_name)
+        self.outbox.stop()
+        if self.outbox.dropped:
+            print(f'Outbox of {self.channel_name}: {self.outbox.stats()}')
+        if self.engagement is not None:
+            await release_tracker_service(self.group, self.channel_name)
+            if self.group not in TRACKERS:
+                STREAM_SERVICE.refresh()
+        if self.group is not None:
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+            await self.channel_layer.group_discard(RULES_GROUP, self.channel_name)
+            await self.channel_layer.group_discard(HMC_GROUP, self.channel_name)
+            await self.channel_layer.group_discard(STREAM_GROUP, self.channel_name)
 
     async def tweet(self, event):
         """
         Upon receiving a tweet over the group_channel sends the tweet ID, the matching filter(s)
-        to the consumers, and starts the engagement tracking if its not already running.
+        to the consumers, and starts the shared engagement tracking of this worker if its not already running.
+        The tracking starts from the created_at of the tweet sent along in the event, or from now if it has none, as
+        the tweet is stored by the ingestion pipeline after it is broadcast and may not be in the database yet.
 
         TODO: Expand this, along with the associated part of the LiveStream on_response method to send the tweet
-        TODO: data needed to draw the tweet, as well as the created_at parameter for the engagement_update function
+        TODO: data needed to draw the tweet
 
         :param event: The message received over the group channel.
         """
-        print('Tweet: ', event)
-        await self.send(text_data=json.dumps({
-            'type': event['type'],
-            'id': event['id'],
-            'filters': event['filters']
-        }))
-        if not self.engagement_tracker.tracking:
-            self.engagement_tracker.tracking = True
-            a = asyncio.get_event_loop()
-            starttime = await sync_to_async(get_tweet_time)(event['id'])
-            a.create_task(self.engagement_tracker.periodic_update(30, self.engagement_tracker.engagement_update,
-                                                                  starttime=starttime))
+        print('Tweet: ', event['id'])
+        await self.send_event(event)
+        if not self.engagement.tracking:
+            created_at = event.get('created_at')
+            starttime = datetime.fromisoformat(created_at) if created_at else timezone.now()
+            self.engagement.start(starttime)
 
     async def status(self, event):
         """
         When receiving a status message, forward it over the websocket
         :param event: The message received over the group channel.
         """
-        print('Status: ', event)
-        await self.send(text_data=json.dumps({
-            'type': event['type'],
-            'stream': event['message']
-        }))
+        print('Status: ', event_message(event))
+        await self.send_event(event)
 
     async def rule(self, event):
         """
         When receiving a rule over the group channel, forward it over the websocket
         :param event: The message received over the group channel.
         """
-        await self.send(text_data=json.dumps({
-            'type': event['type'],
-            'id': event['id'],
-            'filter': event['filters'],
-            'tag': event['tag']
-        }))
+        await self.send_event(event)
+
+    async def rules_changed(self, event):
+        """
+        When the stored rules are changed by any worker, drop the cached terms of the rules in this worker.
+        :param event: The message received over the group channel.
+        """
+        invalidate_tracked_terms()
 
     async def hmc(self, event):
         """
-        When receiving hashtags mentions and contexts, forward them over the websocket.
+        When receiving hashtags mentions and contexts over the hmc group, forward them over the websocket.
+        The message may only hold the ranks that changed since the previous one. In that case it is applied to the
+        lists last received, and the full lists are forwarded, encoded once for all the consumers of this worker.
+        Deltas that do not follow the lists we have are skipped until the next full message.
+        :param event: The message received over the group channel.
+        """
+        state = apply_hmc_event(self.hmc_state, event)
+        if state is None:
+            return
+        self.hmc_state = state
+        await self.send_event(hmc_event(state) if event.get('delta') else event)
+
+    async def stream_changed(self, event):
+        """
+        When a session starts or stops streaming, in any worker, run a tick of the filtered stream loop of this
+        worker, so the stream is connected, disconnected or sends to the new sessions right away.
+        :param event: The message received over the group channel.
+        """
+        STREAM_SERVICE.refresh()
+
+    async def tracking_stop(self, event):
+        """
+        When the stream of the session is stopped by any consumer, stop the engagement tracking of this worker.
+        Every worker with consumers of the session gets this, so none of them takes over the lease.
         :param event: The message received over the group channel.
         """
-        await self.send(text_data=json.dumps({
-            'type': event['type'],
-            'hashtags': event['hashtags'],
-            'mentions': event['mentions'],
-            'contexts': event['contexts']
-        }))
+        await self.engagement.stop()
 
     async def tweetmetrics(self, event):
         """
         When receiving tweet metrics, forward them over the websocket.
         :param event: The message received over the group channel.
         """
-        await self.send(text_data=json.dumps({
-            'type': event['type'],
-            'results': event['results'],
-            'MT_data': event['MT_data'],
-            
-        }))
+        await self.send_event(event)
 
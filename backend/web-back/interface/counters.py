@@ -0,0 +1,244 @@
+import asyncio
+import threading
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from .leaderboard import Leaderboard
+from .models import Hashtag, Mention, ContextEntity
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def get_entity_keys(tweet):
+    """
+    Picks the hashtags, mentions and context annotations out of a tweet.
+    :param tweet: A Tweepy Tweet object
+    :return: list of hashtags, list of mentions and list of (domain, entity) dictionaries. Hashtags and mentions
+    are listed once per occurrence, as this is what the counts are based on.
+    """
+    hashtags = list()
+    mentions = list()
+    entities = tweet.entities or dict()
+    for hashtag in entities.get('hashtags', []):
+        hashtags.append(hashtag['tag'])
+    for mention in entities.get('mentions', []):
+        mentions.append(mention['username'])
+    contexts = list(tweet.context_annotations or [])
+    return hashtags, mentions, contexts
+
+
+def ensure_entities(model, field, keys, defaults=None):
+    """
+    Makes sure a row exists for every key, without touching the counts of existing rows.
+    Runs one select for the keys on the unique index, and one bulk insert for the missing ones that ignores rows
+    created by another worker in the meantime, followed by a select of their keys.
+    :param model: Hashtag, Mention, ContextEntity or ContextDomain
+    :param field: The name of the field identifying the entity
+    :param keys: Iterable of keys
+    :param defaults: Optional dictionary of key -> extra field values for newly created rows
+    :return: Dictionary of key -> primary key
+    """
+    keys = set(keys)
+    if not keys:
+        return dict()
+    defaults = defaults or dict()
+    pks = dict()
+    for pk, key in model.objects.filter(**{f'{field}__in': list(keys)}).values_list('pk', field):
+        pks[key] = pk
+    missing = [key for key in keys if key not in pks]
+    if missing:
+        model.objects.bulk_create([model(**{field: key}, **defaults.get(key, dict())) for key in missing],
+                                  ignore_conflicts=True)
+        for pk, key in model.objects.filter(**{f'{field}__in': missing}).values_list('pk', field):
+            pks[key] = pk
+    return pks
+
+
+""" In-process counting of hashtags, mentions and contexts, written to the database periodically """
+class EntityCounter:
+    def __init__(self, model, field):
+        """
+        Keeps the counted occurrences of one kind of entity that are not yet written to the database.
+        'pending' holds the deltas counted since the last flush, 'flushing' holds the deltas being written.
+        'leaderboard' holds the total counts, loaded from the database on first use and incremented along with
+        the deltas, so the most popular entities can be read without querying the database.
+        :param model: Hashtag, Mention or ContextEntity
+        :param field: The name of the field identifying the entity
+        """
+        self.model = model
+        self.field = field
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = Counter()
+        self.flushing = Counter()
+        self.leaderboard = Leaderboard()
+        self.loaded = False
+
+    def add(self, keys, labels=None):
+        """
+        Counts one occurrence of each key.
+        :param keys: Iterable of keys, repeated once per occurrence
+        :param labels: Optional dictionary of key -> display data for the leaderboard
+        """
+        keys = Counter(keys)
+        labels = labels or dict()
+        with self.lock:
+            self.pending.update(keys)
+            for key, delta in keys.items():
+                self.leaderboard.increment(key, delta, labels.get(key))
+
+    def rows(self):
+        """
+        :return: The stored (key, count, label) of every entity
+        """
+        return ((key, count, None) for key, count in self.model.objects.values_list(self.field, 'count'))
+
+    def load(self):
+        """
+        Loads the leaderboard from the database, adding the deltas not yet written.
+        Holds the flush lock, so no deltas are written between reading the rows and reading the deltas.
+        """
+        with self.flush_lock:
+            counts = dict()
+            labels = dict()
+            for key, count, label in self.rows():
+                counts[key] = count
+                if label is not None:
+                    labels[key] = label
+            with self.lock:
+                for key, delta in (self.pending + self.flushing).items():
+                    counts[key] = counts.get(key, 0) + delta
+                labels.update(self.leaderboard.labels)
+                self.leaderboard.reset(counts, labels)
+                self.loaded = True
+
+    def top(self, n=10, exclude=()):
+        """
+        Gets the most counted entities from the leaderboard, loading it first if needed.
+        :param n: The number of entities to return
+        :param exclude: Keys to leave out, e.g. the ones already tracked by a rule
+        :return: list of (key, count, label) tuples, highest count first
+        """
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            return [(key, count, self.leaderboard.labels.get(key)) for key, count in self.leaderboard.top(n, exclude)]
+
+    def deltas(self):
+        """
+        :return: Counter of key -> occurrences not yet written to the database
+        """
+        with self.lock:
+            return self.pending + self.flushing
+
+    def flush(self):
+        """
+        Writes the pending deltas to the database. Rows missing for a key are inserted, and the counts are
+        incremented in the database with one update per distinct delta, so concurrent writers never lose updates.
+        If the write fails, the deltas are put back to be written on the next flush.
+        :return: The number of keys written
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                self.flushing, self.pending = self.pending, Counter()
+                deltas = self.flushing
+            try:
+                increments = dict()
+                for key, delta in deltas.items():
+                    increments.setdefault(delta, list()).append(key)
+                with transaction.atomic():
+                    ensure_entities(self.model, self.field, deltas)
+                    for delta, keys in increments.items():
+                        self.model.objects.filter(**{f'{self.field}__in': keys}).update(count=F('count') + delta)
+            except Exception:
+                with self.lock:
+                    self.pending.update(deltas)
+                raise
+            finally:
+                with self.lock:
+                    self.flushing = Counter()
+            return len(deltas)
+
+
+class ContextCounter(EntityCounter):
+    def rows(self):
+        """
+        :return: The stored (ent_id, count, label) of every context entity, labelled with its domain
+        """
+        entities = ContextEntity.objects.values_list('ent_id', 'count', 'name', 'domain__dom_id', 'domain__name')
+        for ent_id, count, name, dom_id, dom_name in entities:
+            yield ent_id, count, context_label(dom_id, dom_name, ent_id, name)
+
+
+def context_label(dom_id, dom_name, ent_id, ent_name):
+    """
+    :return: The display name and id of a context entity, as sent to the dashboard
+    """
+    return {'name': f'{dom_name}: {ent_name}', 'id': f'{dom_id}.{ent_id}'}
+
+
+class EntityCounters:
+    def __init__(self, flush_interval=None):
+        """
+        The counters for hashtags, mentions and context entities of this process, and the task flushing them.
+        :param flush_interval: Seconds between flushes. Defaults to LIVETWEETS_COUNTER_FLUSH_INTERVAL
+        """
+        self.hashtags = EntityCounter(Hashtag, 'hashtag')
+        self.mentions = EntityCounter(Mention, 'mention')
+        self.contexts = ContextCounter(ContextEntity, 'ent_id')
+        self.flush_interval = flush_interval
+        self.task = None
+
+    def count(self, tweets):
+        """
+        Counts the hashtags, mentions and contexts of a batch of stored tweets, and starts the flusher task
+        if it is not already running.
+        :param tweets: list of Tweepy Tweet objects
+        """
+        for tweet in tweets:
+            hashtags, mentions, contexts = get_entity_keys(tweet)
+            self.hashtags.add(hashtags)
+            self.mentions.add(mentions)
+            self.contexts.add((context['entity']['id'] for context in contexts), labels={
+                context['entity']['id']: context_label(context['domain']['id'], context['domain']['name'],
+                                                       context['entity']['id'], context['entity']['name'])
+                for context in contexts
+            })
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def flush(self):
+        """
+        Writes the pending deltas of all the counters to the database.
+        """
+        for counter in (self.hashtags, self.mentions, self.contexts):
+            counter.flush()
+
+    def reload(self):
+        """
+        Writes the pending deltas, and loads the leaderboards from the database again, so they hold the counts
+        written by the other workers.
+        """
+        self.flush()
+        for counter in (self.hashtags, self.mentions, self.contexts):
+            counter.load()
+
+    async def run(self):
+        """
+        The flusher loop. Flushes the counters every flush interval. Errors are printed, and the deltas are kept
+        for the next flush.
+        """
+        interval = self.flush_interval or settings.LIVETWEETS_COUNTER_FLUSH_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await sync_to_async(self.flush)()
+            except Exception as e:
+                print(f'Failed to flush entity counts: {e!r}')
+
+
+entity_counters = EntityCounters()
@@ -0,0 +1,79 @@
+import time
+import zlib
+
+from aiohttp import web
+
+
+""" Local stand-in for the Twitter API tweet lookup, with rate limits, for testing the engagement tracker """
+class FakeTwitterAPI:
+    def __init__(self, limit=300, window=900, start=None):
+        """
+        Serves GET /2/tweets like the Twitter API: every id is found, with public_metrics that grow over time at a
+        rate derived from the id, and the author is included when the author_id expansion is asked for.
+        Each response carries the x-rate-limit-limit, -remaining and -reset headers, and requests beyond the limit
+        of the window get a 429 response until it resets.
+        :param limit: Requests per window
+        :param window: Seconds per window
+        :param start: Optional POSIX timestamp the metrics start growing from, defaults to now
+        """
+        self.limit = limit
+        self.window = window
+        self.start = start or time.time()
+        self.reset = int(time.time() + window)
+        self.remaining = limit
+        self.requests = 0
+
+    def rate_limit_headers(self):
+        return {
+            'x-rate-limit-limit': str(self.limit),
+            'x-rate-limit-remaining': str(self.remaining),
+            'x-rate-limit-reset': str(self.reset),
+        }
+
+    def tweet(self, tweetid, now):
+        """
+        :return: The tweet data of an id, the same for the same id and time
+        """
+        seed = zlib.crc32(tweetid.encode())
+        per_minute = seed % 50
+        total = int((now - self.start) / 60 * per_minute)
+        return {
+            'id': tweetid,
+            'text': f'Fake tweet {tweetid}',
+            'edit_history_tweet_ids': [tweetid],
+            'author_id': str(seed % 1000),
+            'public_metrics': {
+                'retweet_count': total // 4,
+                'reply_count': total // 8,
+                'like_count': total // 2,
+                'quote_count': total // 8,
+            },
+        }
+
+    async def get_tweets(self, request):
+        now = time.time()
+        if now >= self.reset:
+            self.reset = int(now + self.window)
+            self.remaining = self.limit
+        self.requests += 1
+        if self.remaining <= 0:
+            return web.json_response({'title': 'Too Many Requests', 'detail': 'Too Many Requests',
+                                      'type': 'about:blank', 'status': 429},
+                                     status=429, headers=self.rate_limit_headers())
+        self.remaining -= 1
+        ids = [tweetid for tweetid in request.query.get('ids', '').split(',') if tweetid]
+        data = [self.tweet(tweetid, now) for tweetid in ids[:100]]
+        body = {'data': data}
+        if 'author_id' in request.query.get('expansions', '').split(','):
+            authors = dict.fromkeys(tweet['author_id'] for tweet in data)
+            body['includes'] = {'users': [{'id': author, 'name': f'User {author}', 'username': f'user{author}'}
+                                          for author in authors]}
+        return web.json_response(body, headers=self.rate_limit_headers())
+
+    def app(self):
+        """
+        :return: The aiohttp web Application serving the API
+        """
+        app = web.Application()
+        app.router.add_get('/2/tweets', self.get_tweets)
+        return app
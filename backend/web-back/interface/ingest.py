@@ -0,0 +1,352 @@
+import asyncio
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from .models import *
+from .counters import entity_counters, ensure_entities, get_entity_keys
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def add_tweets_to_db(tweets, groups=None):
+    """
+    Takes a batch of tweets and stores them with bulk inserts. Every tweet not stored yet is added as a Tweet, and
+    a TrackedTweet is added for every group the tweet is not tracked for yet, so storing the same tweets again
+    changes nothing.
+    The Hashtags, Mentions and Contexts of the new tweets are stored once per distinct entity if they are new, and
+    the links between the tweets and the entities are written to the through tables in one insert per table.
+    The counts of the entities are kept by the EntityCounters in interface.counters.
+    :param tweets: list of Tweepy Tweet objects
+    :param groups: Dictionary of tweet id -> channel groups of the sessions the tweet is tracked for.
+    Defaults to the 'tweet' group for every tweet
+    :return: list of the tweets that were not stored yet, the ones whose entities are to be counted
+    """
+    tweets = list({str(tweet.id): tweet for tweet in tweets}.values())
+    ids = [str(tweet.id) for tweet in tweets]
+    if groups is None:
+        groups = {tweetid: ['tweet'] for tweetid in ids}
+    with transaction.atomic():
+        stored = set(Tweet.objects.filter(id__in=ids).values_list('id', flat=True))
+        tracked = set(TrackedTweet.objects.filter(tweetid_id__in=ids).values_list('tweetid_id', 'group'))
+        new = [tweet for tweet in tweets if str(tweet.id) not in stored]
+        store_tweets(new, [(tweet, group) for tweet in tweets for group in sorted(set(groups.get(str(tweet.id), ())))
+                           if (str(tweet.id), group) not in tracked])
+    return new
+
+
+def store_tweets(tweets, untracked):
+    """
+    Inserts the new tweets and their entities, and the TrackedTweets of the tweets not tracked for their groups yet.
+    Called by add_tweets_to_db within its transaction.
+    :param tweets: list of Tweepy Tweet objects not stored yet
+    :param untracked: list of (Tweepy Tweet object, channel group) tuples not tracked yet
+    """
+    domains = dict()
+    entities = dict()
+    tweet_keys = dict()
+    for tweet in tweets:
+        hashtags, mentions, contexts = get_entity_keys(tweet)
+        for context in contexts:
+            domains[context['domain']['id']] = {'name': context['domain']['name']}
+            entities[context['entity']['id']] = context
+        tweet_keys[str(tweet.id)] = (set(hashtags), set(mentions), {c['entity']['id'] for c in contexts})
+
+    Tweet.objects.bulk_create([
+        Tweet(
+            id=str(tweet.id),
+            text=tweet.text,
+            author_id=str(tweet.author_id),
+            conversation_id=str(tweet.conversation_id),
+            created_at=tweet.created_at,
+            in_reply_to_user_id=str(tweet.in_reply_to_user_id),
+            lang=tweet.lang,
+            possibly_sensitive=tweet.possibly_sensitive,
+            reply_settings=tweet.reply_settings,
+            source=tweet.source,
+        ) for tweet in tweets
+    ], ignore_conflicts=True)
+    TrackedTweet.objects.bulk_create([
+        TrackedTweet(
+            tweetid_id=str(tweet.id),
+            created_at=tweet.created_at,
+            metrics_per_update=0,
+            group=group
+        ) for tweet, group in untracked
+    ])
+
+    domain_pks = ensure_entities(ContextDomain, 'dom_id', domains, defaults=domains)
+    hashtag_pks = ensure_entities(Hashtag, 'hashtag', {tag for keys in tweet_keys.values() for tag in keys[0]})
+    mention_pks = ensure_entities(Mention, 'mention', {name for keys in tweet_keys.values() for name in keys[1]})
+    context_pks = ensure_entities(ContextEntity, 'ent_id', entities, defaults={
+        ent_id: {
+            'name': context['entity']['name'],
+            'domain_id': domain_pks.get(context['domain']['id'])
+        } for ent_id, context in entities.items()
+    })
+
+    hashtag_rows = list()
+    mention_rows = list()
+    context_rows = list()
+    for tweetid, (hashtags, mentions, contexts) in tweet_keys.items():
+        hashtag_rows += [Tweet.hashtags.through(tweet_id=tweetid, hashtag_id=hashtag_pks[tag])
+                         for tag in hashtags]
+        mention_rows += [Tweet.mentions.through(tweet_id=tweetid, mention_id=mention_pks[name])
+                         for name in mentions]
+        context_rows += [Tweet.context.through(tweet_id=tweetid, contextentity_id=context_pks[ent_id])
+                         for ent_id in contexts]
+    Tweet.hashtags.through.objects.bulk_create(hashtag_rows, ignore_conflicts=True)
+    Tweet.mentions.through.objects.bulk_create(mention_rows, ignore_conflicts=True)
+    Tweet.context.through.objects.bulk_create(context_rows, ignore_conflicts=True)
+
+
+USER_FIELDS = ['name', 'username', 'created_at', 'description', 'location', 'pinned_tweet_id', 'profile_image_url',
+               'protected', 'url', 'verified']
+MEDIA_FIELDS = ['type', 'url', 'duration_ms', 'height', 'preview_image_url', 'width', 'alt_text']
+
+
+def add_includes_to_db(users, media):
+    """
+    Stores users and media from the includes of the stream. Rows that exist are updated with one bulk update,
+    and the rest are added with one bulk insert.
+    Media are matched on their media_key, as the Media table uses its own primary key.
+    :param users: Dictionary of user id -> dictionary of USER_FIELDS values
+    :param media: Dictionary of media_key -> dictionary of MEDIA_FIELDS values
+    """
+    with transaction.atomic():
+        if users:
+            stored = set(User.objects.filter(id__in=list(users)).values_list('id', flat=True))
+            User.objects.bulk_update([User(id=id, **users[id]) for id in stored], USER_FIELDS)
+            User.objects.bulk_create([User(id=id, **fields) for id, fields in users.items() if id not in stored],
+                                     ignore_conflicts=True)
+        if media:
+            stored = dict(Media.objects.filter(media_key__in=list(media)).values_list('media_key', 'id'))
+            Media.objects.bulk_update([Media(id=id, media_key=key, **media[key]) for key, id in stored.items()],
+                                      MEDIA_FIELDS)
+            Media.objects.bulk_create([Media(media_key=key, **fields) for key, fields in media.items()
+                                       if key not in stored])
+
+
+def store_batch(tweets, groups, users, media):
+    """
+    Stores a batch of tweets and includes, to be called in one sync_to_async thread hop.
+    :param tweets: list of Tweepy Tweet objects
+    :param groups: Dictionary of tweet id -> channel groups of the sessions the tweet is tracked for
+    :param users: Dictionary of user id -> dictionary of USER_FIELDS values
+    :param media: Dictionary of media_key -> dictionary of MEDIA_FIELDS values
+    :return: list of the tweets that were not stored yet
+    """
+    new = add_tweets_to_db(tweets, groups) if tweets else list()
+    if users or media:
+        add_includes_to_db(users, media)
+    return new
+
+
+class RecentlyStored:
+    def __init__(self, size):
+        """
+        A bounded LRU of recently stored keys and a hash of the values they were stored with, used to skip writing
+        users and media that have not changed.
+        :param size: Max keys to remember
+        """
+        self.size = size
+        self.hashes = OrderedDict()
+
+    def changed(self, key, digest):
+        """
+        :return: True if the key is not stored with these values as far as we remember
+        """
+        if self.hashes.get(key) != digest:
+            return True
+        self.hashes.move_to_end(key)
+        return False
+
+    def add(self, key, digest):
+        """
+        Remembers that the key is stored with the values of the hash, forgetting the least recently used keys.
+        """
+        self.hashes[key] = digest
+        self.hashes.move_to_end(key)
+        while len(self.hashes) > self.size:
+            self.hashes.popitem(last=False)
+
+
+_recent_users = None
+_recent_media = None
+
+
+def recently_stored():
+    """
+    :return: The LRUs of recently stored users and media of this process, created on first use
+    """
+    global _recent_users, _recent_media
+    if _recent_users is None:
+        _recent_users = RecentlyStored(settings.LIVETWEETS_INCLUDES_CACHE_SIZE)
+        _recent_media = RecentlyStored(settings.LIVETWEETS_INCLUDES_CACHE_SIZE)
+    return _recent_users, _recent_media
+
+
+def changed_includes(batch):
+    """
+    Picks the users and media of a batch that are not stored with the same values already.
+    Duplicates within the batch are merged, keeping the last.
+    :param batch: list of (tweet, includes, groups) tuples
+    :return: Dictionary of user id -> values, dictionary of media_key -> values and a list of (LRU, key, hash)
+    to remember once the batch is stored
+    """
+    recent_users, recent_media = recently_stored()
+    users = dict()
+    media = dict()
+    for _, includes, _ in batch:
+        if not includes:
+            continue
+        for user in includes.get('users', []):
+            users[str(user.id)] = {field: getattr(user, field) for field in USER_FIELDS}
+        for m in includes.get('media', []):
+            media[m.media_key] = {field: getattr(m, field) for field in MEDIA_FIELDS}
+    remember = list()
+    for recent, items in ((recent_users, users), (recent_media, media)):
+        for key in list(items):
+            digest = hash(tuple(items[key][field] for field in sorted(items[key])))
+            if recent.changed(key, digest):
+                remember.append((recent, key, digest))
+            else:
+                del items[key]
+    return users, media, remember
+
+
+""" Write-behind ingestion of tweets received by the LiveStream """
+class IngestPipeline:
+    def __init__(self, on_flush=None, queue_size=None, batch_size=None, flush_interval=None):
+        """
+        Sets up the pipeline. The queue and the flusher task are created on the first put, so that they belong
+        to the event loop the stream is running on.
+        :param on_flush: Optional coroutine function called with each batch after it has been stored
+        :param queue_size: Max tweets waiting to be stored before put() blocks. Defaults to LIVETWEETS_INGEST_QUEUE_SIZE
+        :param batch_size: Max tweets stored per flush. Defaults to LIVETWEETS_INGEST_BATCH_SIZE
+        :param flush_interval: Max seconds a tweet waits before its batch is flushed.
+        Defaults to LIVETWEETS_INGEST_FLUSH_INTERVAL
+        """
+        self.on_flush = on_flush
+        self.queue_size = queue_size or settings.LIVETWEETS_INGEST_QUEUE_SIZE
+        self.batch_size = batch_size or settings.LIVETWEETS_INGEST_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.LIVETWEETS_INGEST_FLUSH_INTERVAL
+        self.queue = None
+        self.task = None
+        self.dropped = 0
+
+    def start(self):
+        """
+        Creates the queue and starts the flusher task if it is not already running.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def put(self, tweet, includes=None, groups=('tweet',)):
+        """
+        Adds a tweet and the includes of its response to the queue. If the queue is full this waits for the flusher
+        to catch up.
+        :param tweet: A Tweepy Tweet object, or None if the response has no tweet
+        :param includes: The includes dictionary of the response, with 'users' and 'media'
+        :param groups: The channel groups of the sessions the tweet is tracked for
+        """
+        self.start()
+        await self.queue.put((tweet, includes, groups))
+
+    async def run(self):
+        """
+        The flusher loop. Waits for a tweet, then keeps collecting tweets until the batch is full or the flush
+        interval has passed, and stores the batch. A None in the queue flushes what is collected and ends the loop.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+            if stopping:
+                return
+
+    async def flush(self, batch):
+        """
+        Stores a batch of tweets, and the users and media that changed, in one thread hop. Then adds the hashtags,
+        mentions and contexts of the tweets that were not stored yet to the entity counters, and hands them to the
+        on_flush callback.
+        A failed batch is tried once more, and then stored one tweet at a time, so one bad row or a short outage of
+        the database only loses the tweets that fail on their own. These are printed and counted in 'dropped', and
+        errors are not raised, so the flusher keeps going.
+        :param batch: list of (tweet, includes, groups) tuples
+        """
+        tweets = [tweet for tweet, _, _ in batch if tweet is not None]
+        groups = dict()
+        for tweet, _, tweet_groups in batch:
+            if tweet is not None:
+                groups.setdefault(str(tweet.id), set()).update(tweet_groups)
+        users, media, remember = changed_includes(batch)
+        try:
+            new = await self.store(tweets, groups, users, media)
+        except Exception:
+            new = await self.store_each(tweets, groups, users, media)
+            remember = list()
+        for recent, key, digest in remember:
+            recent.add(key, digest)
+        if not new:
+            return
+        entity_counters.count(new)
+        if self.on_flush is not None:
+            await self.on_flush(new)
+
+    async def store(self, tweets, groups, users, media):
+        """
+        Stores a batch, retrying once if it fails.
+        :return: list of the tweets that were not stored yet
+        """
+        try:
+            return await sync_to_async(store_batch)(tweets, groups, users, media)
+        except Exception as e:
+            print(f'Failed to store {len(tweets)} tweets, retrying: {e!r}')
+        return await sync_to_async(store_batch)(tweets, groups, users, media)
+
+    async def store_each(self, tweets, groups, users, media):
+        """
+        Stores the includes and the tweets of a failed batch one at a time, printing and counting the ones that fail.
+        :return: list of the tweets that were not stored yet
+        """
+        new = list()
+        try:
+            await sync_to_async(store_batch)(list(), dict(), users, media)
+        except Exception as e:
+            print(f'Failed to store the includes of {len(users)} users and {len(media)} media: {e!r}')
+        for tweet in tweets:
+            try:
+                new += await sync_to_async(store_batch)([tweet], groups, dict(), dict())
+            except Exception as e:
+                self.dropped += 1
+                print(f'Dropped tweet {tweet.id}, {self.dropped} dropped so far: {e!r}')
+        return new
+
+    async def stop(self):
+        """
+        Flushes the tweets still in the queue, stops the flusher task and writes out the pending entity counts.
+        """
+        if self.task is not None and not self.task.done():
+            await self.queue.put(None)
+            await self.task
+        await sync_to_async(entity_counters.flush)()
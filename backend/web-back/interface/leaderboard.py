@@ -0,0 +1,77 @@
+import heapq
+
+
+""" Incrementally maintained ranking of the most counted keys """
+class Leaderboard:
+    def __init__(self):
+        """
+        Keeps the current count of every key, and a max-heap of (count, key) entries.
+        Increments push a new entry instead of moving the old one, so an increment is O(log n). Entries that no longer
+        match the current count are dropped when they reach the top, and the heap is rebuilt once more than half of
+        it is outdated.
+        'labels' holds optional display data for the keys, e.g. the names of context entities.
+        """
+        self.counts = dict()
+        self.labels = dict()
+        self.heap = list()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def increment(self, key, delta=1, label=None):
+        """
+        Adds delta to the count of key.
+        :param key: The key to count
+        :param delta: Occurrences to add, ignored unless positive
+        :param label: Optional display data for the key
+        """
+        if label is not None:
+            self.labels[key] = label
+        if delta <= 0:
+            return
+        count = self.counts.get(key, 0) + delta
+        self.counts[key] = count
+        heapq.heappush(self.heap, (-count, key))
+        if len(self.heap) > 2 * len(self.counts) + 64:
+            self.compact()
+
+    def reset(self, counts, labels=None):
+        """
+        Replaces the counts of the leaderboard.
+        :param counts: Dictionary of key -> count
+        :param labels: Optional dictionary of key -> display data
+        """
+        self.counts = dict(counts)
+        self.labels = dict(labels or dict())
+        self.compact()
+
+    def compact(self):
+        """
+        Rebuilds the heap from the current counts, dropping the outdated entries.
+        """
+        self.heap = [(-count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def top(self, n=10, exclude=()):
+        """
+        Gets the n keys with the highest counts, skipping the excluded keys.
+        Only the entries above the n-th result are looked at, and the valid ones are put back afterwards.
+        :param n: The number of keys to return
+        :param exclude: Keys to leave out of the result
+        :return: list of (key, count) tuples, highest count first
+        """
+        result = list()
+        valid = list()
+        seen = set()
+        while self.heap and len(result) < n:
+            entry = heapq.heappop(self.heap)
+            count, key = -entry[0], entry[1]
+            if key in seen or self.counts.get(key) != count:
+                continue
+            seen.add(key)
+            valid.append(entry)
+            if key not in exclude:
+                result.append((key, count))
+        for entry in valid:
+            heapq.heappush(self.heap, entry)
+        return result
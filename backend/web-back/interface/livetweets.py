@@ -1,15 +1,27 @@
-import asyncio
 import math
 from random import randint, random
 
-from tweepy.asynchronous import AsyncClient, AsyncStreamingClient
+from tweepy import TooManyRequests
+from tweepy.asynchronous import AsyncStreamingClient
 from .models import *
+from .ingest import IngestPipeline
+from .counters import entity_counters
+from .broadcast import HmcBroadcaster
+from .archive import StreamArchive
+from .budget import RequestBudget
+from .clients import ClientPool
+from .velocity import VelocityEngine
+from .periodic import Periodic
+from .protocol import frame_event
+from .snapshot import get_state_cache
+from .priority import PriorityScheduler, get_tracking_candidates, set_metrics_per_update
+from .rules import broadcast_rules_changed, get_tracked_terms, invalidate_tracked_terms, split_tag
+from .streaming import STREAM_GROUP
 from asgiref.sync import sync_to_async
 from channels.layers import get_channel_layer
+from django.conf import settings
 from django.utils import timezone
-from collections import defaultdict
 from datetime import timedelta
-import tweepy
 import requests
 import json
 
@@ -17,272 +29,181 @@ import json
 """ Helper functions for Django ORM - to be fed into sync_to_async in async loops """
 def set_rules_to_inactive():
     """
-    Sets the "active" attribute of all the StreamRules objects to False.
+    Sets the "active" attribute of all the StreamRules objects to False, and drops the cached terms of the rules
+    in this worker. The other workers are told by broadcast_rules_changed.
     """
     StreamRules.objects.filter(active=True).update(active=False)
+    invalidate_tracked_terms()
 
 
-def add_tweet_to_db(tweet):
+def update_metrics(timestamp, tweets):
     """
-    Takes a tweet, creates a Tweet object of it. Also adds it as a TrackedTweet.
-    Also stores the Hashtags, Mentions and Contexts of the tweet or increments the ones stored.
-    :param tweet:
+    Takes in the tweets checked for engagement, and stores a snapshot of their metrics to the database in one
+    bulk insert. The metrics refer to the tweets by id, so the tweets themselves are not loaded.
+    :param timestamp: The timestamp of when the tweets were checked
+    :param tweets: list of Tweepy Tweet objects with public_metrics
     """
-    tw = Tweet.objects.create(
-                id=str(tweet.id),
-                text=tweet.text,
-                author_id=str(tweet.author_id),
-                conversation_id=str(tweet.conversation_id),
-                created_at=tweet.created_at,
-                in_reply_to_user_id=str(tweet.in_reply_to_user_id),
-                lang=tweet.lang,
-                possibly_sensitive=tweet.possibly_sensitive,
-                reply_settings=tweet.reply_settings,
-                source=tweet.source,
-                #referenced_tweets= tweet.referenced_tweets,
-            )
-    TrackedTweet.objects.create(
-        tweetid=tw,
-        created_at=tweet.created_at,
-        metrics_per_update=0
-    )
-    if tweet['entities']:
-        if 'hashtags' in tweet['entities']:
-            for hashtag in tweet['entities']['hashtags']:
-                tag = hashtag['tag']
-                h = None
-                try:
-                    h = Hashtag.objects.get(hashtag=tag)
-                    h.count += 1
-                    h.save()
-                except Hashtag.DoesNotExist:
-                    h = Hashtag.objects.create(
-                        hashtag=tag,
-                        count=1
-                    )
-                except Hashtag.MultipleObjectsReturned:
-                    print('Multiple hashtags found')
-                tw.hashtags.add(h)
-
-        if 'mentions' in tweet['entities']:
-            for mention in tweet['entities']['mentions']:
-                name = mention['username']
-                m = None
-                try:
-                    m = Mention.objects.get(mention=name)
-                    m.count += 1
-                    m.save()
-                except Mention.DoesNotExist:
-                    m = Mention.objects.create(
-                        mention=name,
-                        count=1
-                    )
-                except Mention.MultipleObjectsReturned:
-                    print('Multiple mentions found')
-                tw.mentions.add(m)
-
-    if 'context_annotations' in tweet:
-        for context in tweet['context_annotations']:
-            d = None
-            try:
-                d = ContextDomain.objects.get(dom_id=context['domain']['id'])
-            except ContextDomain.DoesNotExist:
-                d = ContextDomain(
-                        dom_id=context['domain']['id'],
-                        name=context['domain']['name']
-                    )
-                d.save()
-            except ContextDomain.MultipleObjectsReturned:
-                print('Multiple Domains returned')
-            try:
-                e = ContextEntity.objects.get(ent_id=context['entity']['id'])
-                e.count += 1
-                e.save()
-            except ContextEntity.DoesNotExist:
-                e = ContextEntity(
-                    name=context['entity']['name'],
-                    ent_id=context['entity']['id'],
-                    domain=d,
-                    count=1
-                    )
-                e.save()
-            tw.context.add(e)
-
-
-def update_metrics(tweetid, timestamp, retweet_count, reply_count, like_count, quote_count):
-    """
-    Takes in the tweetid, timestamp and engagements of a tweet and stores it to the database
-    :param tweetid: The tweetid of the tweet to store
-    :param timestamp: The timestamp of when the tweet was checked
-    :param retweet_count: The amount of retweets at the time of checking
-    :param reply_count: The amount of replies at the time of checking
-    :param like_count: The amount of likes at the time of checking
-    :param quote_count: The amount of quotes at the time of checking
-    """
-    TweetMetrics.objects.create(
-        tweetid=Tweet.objects.get(id=tweetid),
-        time=timestamp,
-        retweet_count=retweet_count,
-        reply_count=reply_count,
-        like_count=like_count,
-        quote_count=quote_count,
-        
-        
-        
-    )
-
-
-def get_tracked_tweets(starttime):
-    """
-    Gets the tweets to check for engagement.
-    Currently only gets the 100 most recent tweets.
-
-    TODO: More advanced filtering of the tweets to track:
-    TODO: Get tweet count, remove (old) unliked tweets and tweets with too low likes/update
-    TODO: (likes/update should probably look at more instances than just one update and rank by age)
-
-    :param starttime: Datetime object of when the tracking was started
-    :return: The IDs of the tweets to check the engagement of.
-    """
-    tweets = TrackedTweet.objects.filter(created_at__gte=starttime).order_by("-created_at")[:99]
-    ids = list(tweets.values_list('tweetid', flat=True))
-    return ids
+    TweetMetrics.objects.bulk_create([
+        TweetMetrics(
+            tweetid_id=str(tweet.id),
+            time=timestamp,
+            retweet_count=tweet.public_metrics['retweet_count'],
+            reply_count=tweet.public_metrics['reply_count'],
+            like_count=tweet.public_metrics['like_count'],
+            quote_count=tweet.public_metrics['quote_count'],
+        ) for tweet in tweets
+    ])
 
 
 def get_10_popular_h_m_c():
     """
-    Gets the 10 most popular hashtags, mentions and contexts stored in the database, that is not already being tracked
-    with a filter.
+    Gets the 10 most popular hashtags, mentions and contexts, that is not already being tracked with a filter.
+    The counts are read from the leaderboards of the entity counters, which include the counts not yet written to
+    the database, and the tracked terms from the cache in interface.rules. Both are global, not per session, so the
+    lists are the same for every dashboard and are sent to the hmc group they all join. The tweets of all sessions
+    come from the one filtered stream, so the worker holding it counts them all and is the only one sending them.
     :return: list of hashtags, list of mentions, dictionary of contexts and the occurrence of contexts.
     """
-    hashtags = list(Hashtag.objects.order_by("-count").values('hashtag', 'count'))
-    mentions = Mention.objects.order_by("-count").values('mention', 'count')
-    rules = StreamRules.objects.filter(active=True)
-    ruletext = ''
-    for rule in rules.values('value'):
-        ruletext += ' ' + rule['value']
-    htracked = [part[1:] for part in ruletext.replace('(', '').replace(')', '').split() if part.startswith('#')]
-    mtracked = [part[1:] for part in ruletext.replace('(', '').replace(')', '').split() if part.startswith('@')]
-    ctracked = [part[8:] for part in ruletext.replace('(', '').replace(')', '').split() if part.startswith('context:')]
-    htags = [tag for tag in hashtags if tag['hashtag'] not in htracked]
-    mnames = [name for name in mentions if name['mention'] not in mtracked]
-    cents = ContextEntity.objects.order_by("-count")
-    contexts = []
-    for context in cents:
-        c = dict()
-        c['name'] = f'{context.domain.name}: {context.name}'
-        c['id'] = f'{context.domain.dom_id}.{context.ent_id}'
-        c['count'] = context.count
-        contexts.append(c)
-    conts = [cont for cont in contexts if cont['id'] not in ctracked]
-    return htags[:10], mnames[:10], conts[:10]
+    terms = get_tracked_terms()
+    htags = [{'hashtag': tag, 'count': count} for tag, count, _ in entity_counters.hashtags.top(10, terms.hashtags)]
+    mnames = [{'mention': name, 'count': count} for name, count, _ in entity_counters.mentions.top(10, terms.mentions)]
+    conts = [{'name': label['name'], 'id': label['id'], 'count': count}
+             for _, count, label in entity_counters.contexts.top(10, terms.contexts)]
+    return htags, mnames, conts
 
 
 """ The Filtered Stream class, an instance of Tweepy's asynchronous streaming client """
 class LiveStream(AsyncStreamingClient):
+    def __init__(self, bearer_token, **kwargs):
+        """
+        In addition to the Tweepy client, the stream gets an ingestion pipeline that stores the received tweets
+        in batches, and a broadcaster sending the hashtags, mentions and contexts to the hmc group after the batches
+        are stored. Before each full hmc message the counts are read from the database again, so a worker taking
+        over the stream starts from the counts of the worker before it.
+        The stream is shared by all the sessions, see interface.streaming.StreamService. Each tweet is sent to the
+        channel groups of the rules it matched, if they are in 'sessions', and the status of the stream to the
+        stream group every consumer joins.
+        If LIVETWEETS_ARCHIVE_DIR is set, every raw payload is also appended to the stream archive there.
+        :param bearer_token: Twitter API 2.0 Bearer Token.
+        :param kwargs: Keyword arguments for the AsyncStreamingClient
+        """
+        super().__init__(bearer_token, **kwargs)
+        self.sessions = None
+        self.ingest = IngestPipeline(on_flush=self.send_hmc)
+        self.hmc = HmcBroadcaster(get_10_popular_h_m_c, refresh=entity_counters.reload)
+        self.archive = StreamArchive(settings.LIVETWEETS_ARCHIVE_DIR) if settings.LIVETWEETS_ARCHIVE_DIR else None
 
-    async def update_rules_from_twitter(self):
+    def start(self):
+        """
+        Connects to the filtered stream, with the fields and expansions we store.
+        :return: The task of the stream
+        """
+        return self.filter(
+            tweet_fields=['id', 'text', 'attachments', 'author_id', 'context_annotations', 'conversation_id',
+                          'created_at', 'entities', 'geo', 'in_reply_to_user_id', 'lang', 'possibly_sensitive',
+                          'public_metrics', 'referenced_tweets', 'reply_settings', 'source', 'withheld'],
+            expansions=['entities.mentions.username', 'geo.place_id', 'author_id', 'attachments.media_keys'],
+            place_fields=['contained_within', 'country', 'country_code', 'full_name', 'name', 'place_type'],
+            media_fields=['url', 'preview_image_url'])
+
+    async def update_rules_from_twitter(self, groups=()):
         """
         Gets the rules from twitter, sets existing rules to inactive, adds the rules received from twitter
-        to the database, and sends them to the channel group, to be forwarded by the consumer.
+        to the database, and sends each rule to the channel group of its session, with the tag it has in the
+        session, to be forwarded by the consumer.
+        Finally the rules of each session are stored in the state cache for the dashboards that connect later, and
+        the cached terms of the rules are invalidated in all workers.
+        :param groups: The channel groups whose rules are stored in the state cache even if they have none left
+        :return: Dictionary of channel group -> list of the rule messages of the session
         """
         rules = await self.get_rules()
         print('Rules: ', rules)
         channel_layer = get_channel_layer()
         await sync_to_async(set_rules_to_inactive)()
+        messages = {group: list() for group in groups}
         try:
             for rule in rules[0]:
+                group, tag = split_tag(rule.tag)
                 rule = StreamRules(
                     id=rule.id,
                     value=rule.value,
                     tag=rule.tag,
                     active=True
                 )
-                await channel_layer.group_send(
-                    'tweet',
-                    {
-                        "type": "rule",
-                        "id": str(rule.id),
-                        "filters": str(rule.value),
-                        "tag": str(rule.tag)
-                    }
-                )
+                message = {
+                    "type": "rule",
+                    "id": str(rule.id),
+                    "filter": str(rule.value),
+                    "tag": str(tag)
+                }
+                await channel_layer.group_send(group, frame_event(message))
+                messages.setdefault(group, list()).append(message)
                 await sync_to_async(rule.save)()
         except TypeError:
             pass
+        for group, rules in messages.items():
+            await get_state_cache().set_rules(group, rules)
+        await broadcast_rules_changed()
+        return messages
+
+    async def on_data(self, raw_data):
+        """
+        Appends the raw payload to the stream archive, if enabled, before Tweepy parses it and calls on_response.
+        The archive only buffers the payload here, the writing happens in its own thread.
+        :param raw_data: The raw data from the stream
+        """
+        if self.archive is not None:
+            self.archive.append(raw_data)
+        await super().on_data(raw_data)
 
     async def on_response(self, response):
         """
         Method for handling the data received from twitter:
         In case of tweet (response.data):
-            Send the tweetid to the channel group (to be handled by the consumer)
-            Add the tweet to the database
-            Get the most popular hashtags mentions and contexts from the database
-            Send the hashtags, mentions and contexts to the channel group.
+            Send the tweetid to the channel group of each streaming session with a matching rule (to be handled by
+            the consumer), along with the tags the rules have in the session
+            Add the tweet to the ingestion queue, to be stored in the next batch and tracked for these sessions. The
+            most popular hashtags, mentions and contexts are sent to the hmc group once the batch is stored
+            (see send_hmc).
 
             TODO: Also send the Username, UserID, Tweet text, creation time and any other fields needed to manually
             TODO: create a tweet in a frontend.
 
         Generally all tweets will also include the user. If they have media content this will be included in the
-        "includes" along with the user. This method goes on to add any media and the user to the database.
+        "includes" along with the user. These are queued along with the tweet, and stored in the same batch unless
+        they are stored unchanged already.
 
         :param response: The response object from Tweepy
         """
+        groups = dict()
         if response.data:
             tweet = response.data
-            matching_rules = response.matching_rules
+            for rule in response.matching_rules:
+                group, tag = split_tag(rule.tag)
+                if self.sessions is None or group in self.sessions:
+                    groups.setdefault(group, list()).append(tag)
             channel_layer = get_channel_layer()
-            await channel_layer.group_send(
-                'tweet',
-                {
+            created_at = tweet.created_at.isoformat() if tweet.created_at else None
+            for group, tags in groups.items():
+                message = {
                     "type": "tweet",
                     "id": str(tweet.id),
-                    "filters": ', '.join([rule.tag for rule in matching_rules])
-                }
-            )
-            await sync_to_async(add_tweet_to_db)(tweet)
-            hashtags, mentions, contexts = await sync_to_async(get_10_popular_h_m_c)()
-            await channel_layer.group_send(
-                'tweet',
-                {
-                    "type": "hmc",
-                    "hashtags": hashtags,
-                    "mentions": mentions,
-                    "contexts": contexts
+                    "filters": ', '.join(tags)
                 }
-            )
-
-        if response.includes:
-            includes = response.includes
-            if 'media' in includes.keys():
-                for media in includes['media']:
-                    m = Media(
-                        media_key=media.media_key,
-                        type=media.type,
-                        url=media.url,
-                        duration_ms=media.duration_ms,
-                        height=media.height,
-                        preview_image_url=media.preview_image_url,
-                        width=media.width,
-                        alt_text=media.alt_text
-                    )
-                    await sync_to_async(m.save)()
-            if 'users' in includes.keys():
-                for user in includes['users']:
-                    u = User(
-                        id=user.id,
-                        name=user.name,
-                        username=user.username,
-                        created_at=user.created_at,
-                        description=user.description,
-                        location=user.location,
-                        pinned_tweet_id=user.pinned_tweet_id,
-                        profile_image_url=user.profile_image_url,
-                        protected=user.protected,
-                        url=user.url,
-                        verified=user.verified
-                    )
-                    await sync_to_async(u.save)()
+                await channel_layer.group_send(group, frame_event(message, id=str(tweet.id), created_at=created_at))
+                await get_state_cache().add_tweet(group, message)
+
+        if response.data or response.includes:
+            await self.ingest.put(response.data, response.includes, list(groups))
+
+    async def send_hmc(self, batch):
+        """
+        Called by the ingestion pipeline after a batch of tweets is stored.
+        Requests an update of the most popular hashtags mentions and contexts from the broadcaster, which sends
+        them to the hmc group at a limited rate.
+        :param batch: The tweets that were stored
+        """
+        self.hmc.notify()
 
     async def on_errors(self, errors):
         """
@@ -293,248 +214,230 @@ class LiveStream(AsyncStreamingClient):
 
     async def on_closed(self, resp):
         """
-        If we lose the streaming connection, we send a message to the group channel to be handled by the consumer.
+        If we lose the streaming connection, we send a message to the stream group to be handled by the consumers.
         :param resp: response (aiohttp.ClientResponse) – The response from Twitter
         """
         channel_layer = get_channel_layer()
         await channel_layer.group_send(
-            'tweet',
-            {
+            STREAM_GROUP,
+            frame_event({
                 "type": "status",
-                "message": "Stream connection closed by Twitter"
-            }
+                "stream": "Stream connection closed by Twitter"
+            })
         )
 
     async def on_connect(self):
         """
-        Upon connecting to Twitter, we send a message to the group channel to be handled by the consumer.
+        Upon connecting to Twitter, we send a message to the stream group to be handled by the consumers.
         """
         channel_layer = get_channel_layer()
         print('Connected to Twitter')
         await channel_layer.group_send(
-            'tweet',
-            {
+            STREAM_GROUP,
+            frame_event({
                 "type": "status",
-                "message": "Streaming"
-            }
+                "stream": "Streaming"
+            })
         )
 
     async def on_connection_error(self):
         """
-        If we cannot connect, we send a message to the group channel to be handled by the consumer.
+        If we cannot connect, we send a message to the stream group to be handled by the consumers.
         """
         channel_layer = get_channel_layer()
         await channel_layer.group_send(
-            'tweet',
-            {
+            STREAM_GROUP,
+            frame_event({
                 "type": "status",
-                "message": "Stream connection has errored or timed out"
-            }
+                "stream": "Stream connection has errored or timed out"
+            })
         )
 
     async def on_disconnect(self):
         """
-        Upon disconnecting, we send a message to the group channel to be handled by the consumer.
+        Upon disconnecting, we store the tweets still waiting in the ingestion queue and the archive, and send a
+        message to the stream group to be handled by the consumers.
         """
+        await self.ingest.stop()
+        await self.hmc.stop()
+        if self.archive is not None:
+            await self.archive.close()
         channel_layer = get_channel_layer()
         await channel_layer.group_send(
-            'tweet',
-            {
+            STREAM_GROUP,
+            frame_event({
                 "type": "status",
-                "message": "Stream disconnected"
-            }
+                "stream": "Stream disconnected"
+            })
         )
 
     async def on_request_error(self, status_code):
         """
-        Upon receiving a non-200 HTTP status code, we send a message to the group channel to be handled by the consumer.
+        Upon receiving a non-200 HTTP status code, we send a message to the stream group to be handled by the consumers.
         This message contains the status code received
         :param status_code: The HTTP status code encountered
         """
         channel_layer = get_channel_layer()
         await channel_layer.group_send(
-            'tweet',
-            {
+            STREAM_GROUP,
+            frame_event({
                 "type": "status",
-                "message": f'Stream encountered HTTP Error: {status_code}'
-            }
+                "stream": f'Stream encountered HTTP Error: {status_code}'
+            })
         )
 
 
 class EngagementTracker:
-    def __init__(self, bearer_token):
+    def __init__(self, bearer_token, group='tweet'):
         """
         Upon initiating the engagement tracker, store the bearer token and set its tracking status to False.
+        The tracker owns a client pool, so the API connections are reused between updates, a velocity engine
+        holding the recent engagement of the tracked tweets in memory, the scheduler picking the tweets to poll, and
+        the request budget that keeps the polling within the rate limits of the API.
         :param bearer_token: Twitter API 2.0 Bearer Token.
+        :param group: The channel group of the session, whose tweets are tracked and which the metrics are sent to
         """
         self.tracking = False
         self.bearer_token = bearer_token
+        self.group = group
+        self.budget = RequestBudget()
+        self.clients = ClientPool(bearer_token, budget=self.budget)
+        self.velocity = VelocityEngine()
+        self.scheduler = PriorityScheduler(self.velocity)
+        self.schedule = None
 
     async def engagement_update(self, starttime):
         """
         Method to handle each update of the metrics.
 
-        Each time it is called, it collects the tweets to track from the database, initiates the Tweepy Client,
-        gets the tweets from the Twitter API, along with their public_metrics. It then sends the metrics, tweetid and
-        a timestamp of the current time to the update_metrics function.
+        Each time it is called, it collects the candidate tweets from the database and lets the scheduler pick the
+        ones to poll, gets the Tweepy Client from the client pool, and gets the tweets from the Twitter API in batches
+        of 100, along with their public_metrics. It then sends the tweets and a timestamp of the current time to the
+        update_metrics function, which stores them in one bulk insert. Tweets that stopped gaining engagement are
+        evicted, and the engagement per update of the others is stored as their metrics_per_update.
 
-        Following this it collects metrics statistics from the database through the get_tweet_metrics function
-        before sending these metrics to the group channel to be handled by the consumer.
+        The requests are taken from the request budget. Half of the allowance of the update goes to polling, so the
+        scheduler only picks the highest priority tweets when the budget is tight, and the rest to the lookup of the
+        referenced tweets. When the allowance is used up, or the API answers with a 429, the update carries on with
+        what it has instead of waiting for the rate limit to reset.
+
+        The snapshot is also added to the velocity engine, which computes the engagement gained by the tweets within
+        each interval from the snapshots it holds in memory, before these metrics are sent to the group channel to be
+        handled by the consumer. The database is only read on the first update, to warm the engine up. Nothing is
+        sent when no metrics could be fetched, so the dashboards and the snapshot keep the last ones.
 
         :param starttime: Datetime object of when the tracking was started.
         """
-        tweetids = await sync_to_async(get_tracked_tweets)(starttime)
-        client = AsyncClient(self.bearer_token)
-        tweets = await client.get_tweets(tweetids, tweet_fields=['public_metrics','referenced_tweets'])
+        candidates = await sync_to_async(get_tracking_candidates)(starttime, self.scheduler.candidates,
+                                                                  self.group)
+        if not self.velocity.loaded:
+            history = timedelta(seconds=self.velocity.capacity * settings.LIVETWEETS_ENGAGEMENT_INTERVAL)
+            await sync_to_async(self.velocity.load)([tweetid for tweetid, _ in candidates], timezone.now() - history)
+        allowance = self.budget.allowance()
+        if allowance < 1:
+            print(f'Engagement update skipped, waiting for API budget: {self.budget.stats()}')
+            return
+        tweetids = self.scheduler.select(candidates, requests=max(1, allowance // 2))
+        client = self.clients.get()
+        tweets = list()
+        for i in range(0, len(tweetids), self.scheduler.batch_size):
+            if not self.budget.take():
+                break
+            try:
+                response = await client.get_tweets(tweetids[i:i + self.scheduler.batch_size],
+                                                   tweet_fields=['public_metrics','referenced_tweets'])
+            except TooManyRequests:
+                break
+            tweets.extend(response.data or [])
         
         timestamp = timezone.now()
-        print(f"Engagement updated at {timestamp.strftime('%X')}")
+        print(f"Engagement updated at {timestamp.strftime('%X')} for {len(tweets)} tweets, "
+              f"API connections: {self.clients.stats()}, API budget: {self.budget.stats()}, "
+              f"timing: {self.schedule.stats() if self.schedule is not None else None}")
                    
-        for tweet in tweets[0]:                                         # Probably inefficient
-            await sync_to_async(update_metrics)(
-
-                tweetid=tweet.id,
-                timestamp=timestamp,
-                retweet_count=tweet.data['public_metrics']['retweet_count'],
-                reply_count=tweet.data['public_metrics']['reply_count'],
-                like_count=tweet.data['public_metrics']['like_count'],
-                quote_count=tweet.data['public_metrics']['quote_count'],
-                #referenced_tweets=tweet.data['referenced_tweets'],
-                
-            )
-        results = await sync_to_async(get_tweet_metrics)(timestamp, tweetids)
-        MT_data = await sync_to_async(get_tweet_metrics1)(timestamp,tweets)
-                                 
+        self.velocity.record(timestamp, tweets)
+        evicted = self.scheduler.evict_flat(tweetids)
+        results = self.velocity.top()
+        await sync_to_async(update_metrics)(timestamp, tweets)
+        await sync_to_async(set_metrics_per_update)(self.scheduler.rates(tweetids), self.group)
+        if evicted:
+            print(f'Stopped tracking {len(evicted)} tweets without engagement')
+        MT_data = await get_tweet_metrics1(client, tweets, self.budget)
+        if not MT_data:
+            print('No tweet metrics sent, none were fetched')
+            return
+        message = {
+            "type": "tweetmetrics",
+            "results": results,
+            "MT_data": MT_data,
+        }
         channel_layer = get_channel_layer()
-        await channel_layer.group_send(
-            'tweet',
-            {
-                "type": "tweetmetrics",
-                "results": results,
-                "MT_data": MT_data,
-                
-            }
-        )
+        await channel_layer.group_send(self.group, frame_event(message))
+        await get_state_cache().set_latest(self.group, message)
 
     async def periodic_update(self, __seconds: float, func, *args, **kwargs):
         """
-        Function to periodically update the tweet metrics.
+        Function to periodically update the tweet metrics, on fixed deadlines so the snapshots stay evenly spaced.
+        A failed update is counted and printed, and the next one goes ahead. The loop ends when its task is cancelled
+        or the tracking is turned off, and the client pool is closed when it does.
         :param __seconds: Int of how often we want the metrics to update
         :param func: The function to call
         :param args: Arguments for the function
         :param kwargs: Keyword arguments for the function
         """
-        while True:
-            if not self.tracking:
-                break
-            await asyncio.gather(
-                asyncio.sleep(__seconds),
-                func(*args, **kwargs)
-            )
-
-
-def get_tweet_metrics(timestamp, tweetids):
-    """
-    Function to collect metric statistics of the tweets.
-
-    It first deletes the metrics older than (currently) 4 minutes
-    It then grabs all stored metrics sorted by tweetid and time
+        self.schedule = Periodic(lambda: func(*args, **kwargs), __seconds, name='Engagement update',
+                                 condition=lambda: self.tracking)
+        try:
+            await self.schedule.run()
+        finally:
+            await self.close()
 
-    It then goes through the results and adds the metrics for our tracked tweets to a dictionary, before checking
-    if we have enough updates for our tracked tweets to gather stats. If there are, the relevant statistics is added
-    to the dictionary.
+    async def close(self):
+        """
+        Closes the connections of the client pool. Called when the tracking stops.
+        """
+        await self.clients.close()
 
-    Upon adding stats to any tracked tweets, we add the metrics to our result dictionary.
-    We then sort the metrics for each interval, before we finally add the 5 top results to a sorted list for each
-    interval in the res_sorted dictionary.
 
-    :param timestamp: datetime object of the time the EngagementTracker.engagement_update method was called
-    :param tweetids: The tweetids that are being tracked.
-    :return: Dictionary of lists for each interval
+async def get_tweet_metrics1(client, tweets, budget=None):
     """
-    old = TweetMetrics.objects.filter(time__lte=timestamp-timedelta(minutes=4))
-    old.delete()
-    metrics = TweetMetrics.objects.all().order_by('tweetid', '-time')
-    tweetdict = defaultdict(list)
-    res = dict()
-    res_sorted = dict()
-    res['30'] = dict()
-    res['60'] = dict()
-    res['180'] = dict()
-    tweetmetrics = dict()
-    for metric in metrics:
-        if metric.tweetid.id not in tweetids:
-            continue
-        tweetdict[metric.tweetid.id].append(metric)
-    for tweet in tweetdict:
-        tweetmetric = dict()
-        if len(tweetdict[tweet]) < 2:
-            continue
-        if len(tweetdict[tweet]) >= 2:
-            tweetmetric['30'] = metric_count(tweetdict[tweet][0])-metric_count(tweetdict[tweet][1])
-        if len(tweetdict[tweet]) >= 3:
-            tweetmetric['60'] = metric_count(tweetdict[tweet][0])-metric_count(tweetdict[tweet][2])
-        if len(tweetdict[tweet]) >= 7:
-            tweetmetric['180'] = metric_count(tweetdict[tweet][0])-metric_count(tweetdict[tweet][6])
-        if len(tweetmetric) > 0:
-            tweetmetrics[tweet] = tweetmetric
-    for tweet in tweetmetrics:
-        if tweetmetrics[tweet]['30'] > 0:
-            res['30'][tweet] = tweetmetrics[tweet]['30']
-        if '60' in tweetmetrics[tweet].keys():
-            if tweetmetrics[tweet]['60'] > 0:
-                res['60'][tweet] = tweetmetrics[tweet]['60']
-        if '180' in tweetmetrics[tweet].keys():
-            if tweetmetrics[tweet]['180'] > 0:
-                res['180'][tweet] = tweetmetrics[tweet]['180']
-    for interval in res:
-        res_sorted[interval] = list()
-        r = ({k: v for k, v in sorted(res[interval].items(), key=lambda item: item[1], reverse=True)})
-        i = 0
-        for kp in r:
-            if i >= 5:
-                break
-            res_sorted[interval].append({'id': kp, 'count': r[kp]})
-            i += 1
-
-    return res_sorted
-
-def get_tweet_metrics1(timestamp,tweets):
-    old = TweetMetrics.objects.filter(time__lte=timestamp-timedelta(minutes=10))
-    old.delete()
-    #metrics = set(TweetMetrics.objects.all().order_by('tweetid', '-time'))
-    res_sorted = list()
-    bearer_token = 'AAAAAAAAAAAAAAAAAAAAAGpAgwEAAAAAzJ17mQTLrcP7BqXybuutvbf%2Bh4g%3DywJ6jdRCuT8PjsOL2a3CiI6eKUjaKMYeu25Cj5jdsMRXniitMv'
-    client1 = tweepy.Client(bearer_token = bearer_token)
-    for tweet in tweets.data:
-        if(tweet.referenced_tweets):
-            rt_id = tweet['referenced_tweets'][0].id
+    Gets the current metrics and author of the tweets, or of the tweet they reference (e.g. the retweeted tweet).
+    The tweets are looked up with one get_tweets call per 100 ids, expanding the authors, so no call is made per
+    tweet or per user.
+    :param client: The AsyncClient to use
+    :param tweets: list of the tracked Tweepy Tweet objects, with referenced_tweets
+    :param budget: Optional RequestBudget to take the requests from. The tweets left when it runs out are skipped
+    :return: list of dictionaries with the id, author username and metrics of each tweet
+    """
+    rt_ids = list()
+    for tweet in tweets:
+        if tweet.referenced_tweets:
+            rt_ids.append(tweet.referenced_tweets[0].id)
         else:
-            rt_id = tweet.id
-        #print('Tweet_id:', tweet.id)
-        #print('Referenced_tweet_ID:',rt_id)
-        
-        tweets_new = client1.get_tweet(rt_id, tweet_fields=['public_metrics','author_id','entities'])
-        auth_id = tweets_new.data['author_id']
-        user = client1.get_user(id=auth_id)
-        name = user.data
-        print(name)
-        print('Tweet_id:', tweet.id)
-        print('Referenced_tweet_ID:',rt_id)
-        res_sorted.append({'id': str(rt_id),'name':str(name),'Retweet_count': tweets_new.data['public_metrics']['retweet_count'], 'Like_count':tweets_new.data['public_metrics']['like_count'], 'Quote_count': tweets_new.data['public_metrics']['quote_count'], 'Reply_count': tweets_new.data['public_metrics']['reply_count']})
-        
-   
+            rt_ids.append(tweet.id)
+    unique = list(dict.fromkeys(rt_ids))
+    found = dict()
+    users = dict()
+    for i in range(0, len(unique), 100):
+        if budget is not None and not budget.take():
+            break
+        try:
+            response = await client.get_tweets(unique[i:i + 100],
+                                               tweet_fields=['public_metrics', 'author_id', 'entities'],
+                                               expansions=['author_id'])
+        except TooManyRequests:
+            break
+        for user in response.includes.get('users', []):
+            users[user.id] = user
+        for tweet in response.data or []:
+            found[tweet.id] = tweet
+    res_sorted = list()
+    for rt_id in rt_ids:
+        if rt_id not in found:
+            continue
+        tweet = found[rt_id]
+        metrics = tweet.public_metrics
+        res_sorted.append({'id': str(rt_id), 'name': str(users.get(tweet.author_id, tweet.author_id)),
+                           'Retweet_count': metrics['retweet_count'], 'Like_count': metrics['like_count'],
+                           'Quote_count': metrics['quote_count'], 'Reply_count': metrics['reply_count']})
     return res_sorted
-
-def metric_count(count):
-    """
-    Method to sum the engagement metrics collected from twitter
-    :param count: TweetMetrics instance
-    :return: Summed metric counts.
-    """
-    return count.retweet_count+count.reply_count+count.like_count+count.quote_count
-
-
-
-
-
@@ -0,0 +1,34 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+from interface.benchmark import run_broadcast_benchmark, synthetic_broadcasts
+from interface.consumers import TweetConsumer
+from interface.protocol import MSGPACK_PROTOCOL
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the CPU time per group broadcast against the number of subscribed consumers, with the frames '
+            'encoded once per worker and protocol and with every consumer encoding the message')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', default='1,10,50,200',
+                            help='Comma separated numbers of consumers (default 1,10,50,200)')
+        parser.add_argument('--rounds', type=int, default=20, help='Broadcasts of each message per run')
+        parser.add_argument('--tracked', type=int, default=100, help='Number of tweets in the tweet metrics')
+        parser.add_argument('--msgpack', action='store_true', help='Consumers use the MessagePack protocol')
+        parser.add_argument('--output', help='Write the result as JSON to this file')
+
+    def handle(self, *args, **options):
+        messages = synthetic_broadcasts(tracked=options['tracked'])
+        protocol = MSGPACK_PROTOCOL if options['msgpack'] else None
+        runs = list()
+        for subscribers in [int(n) for n in options['subscribers'].split(',') if n.strip()]:
+            runs.append(asyncio.run(run_broadcast_benchmark(TweetConsumer, subscribers, messages,
+                                                            options['rounds'], protocol)))
+        result = {'protocol': protocol or 'json', 'tracked': options['tracked'], 'runs': runs}
+        self.stdout.write(json.dumps(result, indent=2))
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(result, file, indent=2)
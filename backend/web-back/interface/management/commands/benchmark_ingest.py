@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from interface.benchmark import SyntheticStream, compare_results, run_ingest_benchmark
+from interface.livetweets import LiveStream
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks tweet ingestion with synthetic stream payloads, in a throwaway test database of the '
+            'configured database engine')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tweets', type=int, default=5000, help='Number of synthetic tweets')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic stream')
+        parser.add_argument('--output', help='Write the result as JSON to this file')
+        parser.add_argument('--compare', help='Compare the result to a JSON result from an earlier run')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='Relative change allowed before a metric counts as a regression (default 0.1)')
+        parser.add_argument('--write-ndjson', help='Also write the synthetic payloads to this file, for replay_stream')
+
+    def handle(self, *args, **options):
+        lines = SyntheticStream(seed=options['seed']).lines(options['tweets'])
+        if options['write_ndjson']:
+            with open(options['write_ndjson'], 'wb') as file:
+                file.write(b'\n'.join(lines) + b'\n')
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+                stream = LiveStream(bearer_token='benchmark')
+                result = asyncio.run(run_ingest_benchmark(stream, lines))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        result['database'] = connection.vendor
+        result['seed'] = options['seed']
+        self.stdout.write(json.dumps(result, indent=2))
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(result, file, indent=2)
+        if options['compare']:
+            with open(options['compare']) as file:
+                baseline = json.load(file)
+            regressions = list()
+            for name, old, new, change, regressed in compare_results(baseline, result, options['tolerance']):
+                self.stdout.write(f'{name}: {old} -> {new} ({change:+.1%}){" REGRESSION" if regressed else ""}')
+                if regressed:
+                    regressions.append(name)
+            if regressions:
+                raise CommandError(f'Regressed: {", ".join(regressions)}')
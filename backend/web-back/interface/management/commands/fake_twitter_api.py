@@ -0,0 +1,18 @@
+from aiohttp import web
+from django.core.management.base import BaseCommand
+from interface.fakeapi import FakeTwitterAPI
+
+
+class Command(BaseCommand):
+    help = ('Serves a local stand-in for the Twitter API tweet lookup, with rate limit headers. '
+            'Point the engagement tracker at it with LIVETWEETS_API_URL=http://HOST:PORT')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--limit', type=int, default=300, help='Requests per rate limit window')
+        parser.add_argument('--window', type=int, default=900, help='Seconds per rate limit window')
+
+    def handle(self, *args, **options):
+        api = FakeTwitterAPI(limit=options['limit'], window=options['window'])
+        web.run_app(api.app(), host=options['host'], port=options['port'])
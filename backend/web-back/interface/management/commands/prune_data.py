@@ -0,0 +1,20 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+from interface.retention import RetentionWorker
+
+
+class Command(BaseCommand):
+    help = 'Deletes the tweets and metrics older than their LIVETWEETS_RETENTION_* ttl, rolling the metrics up first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running every LIVETWEETS_RETENTION_INTERVAL seconds instead of once')
+
+    def handle(self, *args, **options):
+        worker = RetentionWorker()
+        if options['loop']:
+            asyncio.run(worker.run())
+        else:
+            self.stdout.write(json.dumps(asyncio.run(worker.prune_all())))
@@ -0,0 +1,21 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+from interface.livetweets import LiveStream
+from interface.replay import ReplaySource
+
+
+class Command(BaseCommand):
+    help = 'Replays recorded filtered stream payloads (NDJSON, optionally gzipped) through LiveStream.on_response'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='NDJSON files with one stream payload per line')
+        parser.add_argument('--speed', type=float, default=0,
+                            help='1 for real time, N for N times as fast, 0 (default) for as fast as possible')
+
+    def handle(self, *args, **options):
+        stream = LiveStream(bearer_token='replay')
+        replay = ReplaySource(stream, options['paths'], speed=options['speed'])
+        stats = asyncio.run(replay.run())
+        self.stdout.write(json.dumps(stats))
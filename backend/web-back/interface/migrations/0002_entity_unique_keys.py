@@ -0,0 +1,90 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:23
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def use_binary_collation(apps, schema_editor):
+    """
+    Compares the hashtags and mentions byte for byte on MySQL, as they are in Python. With the case and accent
+    insensitive default collation, '#Python' and '#python' would be one row to the unique key, but two keys to the
+    entity counters and the ingestion. Context ids are digits, so they are left as they are.
+    """
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    for model_name, field in [('Hashtag', 'hashtag'), ('Mention', 'mention')]:
+        model = apps.get_model('interface', model_name)
+        column = model._meta.get_field(field)
+        schema_editor.execute(
+            f'ALTER TABLE {schema_editor.quote_name(model._meta.db_table)} MODIFY {schema_editor.quote_name(column.column)} '
+            f'varchar({column.max_length}) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL'
+        )
+
+
+def merge_duplicate_entities(apps, schema_editor):
+    """
+    Merges the Hashtags, Mentions and ContextEntities stored more than once into the oldest row.
+    The counts are summed, and the tweets linked to the duplicates are linked to the kept row instead.
+    """
+    Tweet = apps.get_model('interface', 'Tweet')
+    for model_name, field, m2m, column in [('Hashtag', 'hashtag', 'hashtags', 'hashtag_id'),
+                                           ('Mention', 'mention', 'mentions', 'mention_id'),
+                                           ('ContextEntity', 'ent_id', 'context', 'contextentity_id')]:
+        model = apps.get_model('interface', model_name)
+        through = getattr(Tweet, m2m).through
+        dupes = model.objects.values(field).annotate(n=Count('pk'), keep=Min('pk'), total=Sum('count')).filter(n__gt=1)
+        for dupe in dupes:
+            rest = list(model.objects.filter(**{field: dupe[field]}).exclude(pk=dupe['keep']).values_list('pk', flat=True))
+            tweetids = set(through.objects.filter(**{f'{column}__in': rest}).values_list('tweet_id', flat=True))
+            through.objects.filter(**{f'{column}__in': rest}).delete()
+            through.objects.bulk_create([through(tweet_id=tweetid, **{column: dupe['keep']}) for tweetid in tweetids],
+                                        ignore_conflicts=True)
+            model.objects.filter(pk=dupe['keep']).update(count=dupe['total'])
+            model.objects.filter(pk__in=rest).delete()
+
+
+def merge_duplicate_domains(apps, schema_editor):
+    """
+    Merges the ContextDomains stored more than once into the oldest row, and points their entities to it.
+    """
+    ContextDomain = apps.get_model('interface', 'ContextDomain')
+    ContextEntity = apps.get_model('interface', 'ContextEntity')
+    dupes = ContextDomain.objects.values('dom_id').annotate(n=Count('pk'), keep=Min('pk')).filter(n__gt=1)
+    for dupe in dupes:
+        rest = list(ContextDomain.objects.filter(dom_id=dupe['dom_id']).exclude(pk=dupe['keep'])
+                    .values_list('pk', flat=True))
+        ContextEntity.objects.filter(domain_id__in=rest).update(domain_id=dupe['keep'])
+        ContextDomain.objects.filter(pk__in=rest).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(use_binary_collation, migrations.RunPython.noop),
+        migrations.RunPython(merge_duplicate_domains, migrations.RunPython.noop),
+        migrations.RunPython(merge_duplicate_entities, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='contextdomain',
+            name='dom_id',
+            field=models.CharField(default='', max_length=3, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='contextentity',
+            name='ent_id',
+            field=models.CharField(default='', max_length=30, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='hashtag',
+            name='hashtag',
+            field=models.CharField(max_length=280, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='mention',
+            name='mention',
+            field=models.CharField(max_length=280, unique=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0002_entity_unique_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackerLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('holder', models.CharField(default='', max_length=255)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0003_trackerlease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trackedtweet',
+            name='created_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='tweet',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, default=None),
+        ),
+        migrations.AlterField(
+            model_name='tweetmetrics',
+            name='time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.CreateModel(
+            name='TweetMetricsRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(db_index=True)),
+                ('retweet_count', models.IntegerField()),
+                ('reply_count', models.IntegerField()),
+                ('like_count', models.IntegerField()),
+                ('quote_count', models.IntegerField()),
+                ('samples', models.IntegerField(default=0)),
+                ('tweetid', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='interface.tweet')),
+            ],
+            options={
+                'unique_together': {('tweetid', 'bucket')},
+            },
+        ),
+    ]
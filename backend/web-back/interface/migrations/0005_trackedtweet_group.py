@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 22:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0004_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackedtweet',
+            name='group',
+            field=models.CharField(db_index=True, default='tweet', max_length=100),
+        ),
+    ]
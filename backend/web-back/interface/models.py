@@ -9,7 +9,7 @@ class StreamRules(models.Model):
 
 
 class Hashtag(models.Model):
-    hashtag = models.CharField(max_length=280)
+    hashtag = models.CharField(max_length=280, unique=True)
     count = models.IntegerField(default=0)
 
     def __str__(self):
@@ -17,7 +17,7 @@ class Hashtag(models.Model):
 
 
 class Mention(models.Model):
-    mention = models.CharField(max_length=280)
+    mention = models.CharField(max_length=280, unique=True)
     count = models.IntegerField(default=0)
 
     def __str__(self):
@@ -25,7 +25,7 @@ class Mention(models.Model):
 
 
 class ContextDomain(models.Model):
-    dom_id = models.CharField(max_length=3, default='')
+    dom_id = models.CharField(max_length=3, default='', unique=True)
     name = models.CharField(max_length=100)
 
     def __str__(self):
@@ -33,7 +33,7 @@ class ContextDomain(models.Model):
 
 
 class ContextEntity(models.Model):
-    ent_id = models.CharField(max_length=30, default='')
+    ent_id = models.CharField(max_length=30, default='', unique=True)
     name = models.CharField(max_length=200)
     domain = models.ForeignKey(ContextDomain, on_delete=models.SET_NULL, null=True)
     count = models.IntegerField(default=0)
@@ -49,7 +49,7 @@ class Tweet(models.Model):
     author_id = models.CharField(default=None, max_length=255)
     # context_annotations = list # Moved to the context field
     conversation_id = models.CharField(default=None, max_length=255)
-    created_at = models.DateTimeField(default=None)
+    created_at = models.DateTimeField(default=None, db_index=True)
     # entities = dict | None # Split into the hashtags and mention fields
     # geo = dict | None
     in_reply_to_user_id = models.CharField(default=None, max_length=255)
@@ -73,12 +73,25 @@ class Tweet(models.Model):
 
 class TweetMetrics(models.Model):
     tweetid = models.ForeignKey(Tweet, on_delete=models.CASCADE)
-    time = models.DateTimeField()
+    time = models.DateTimeField(db_index=True)
     retweet_count = models.IntegerField()
     reply_count = models.IntegerField()
     like_count = models.IntegerField()
     quote_count = models.IntegerField()
-    
+
+
+class TweetMetricsRollup(models.Model):
+    # The latest metrics of the tweet within each bucket, kept after the raw TweetMetrics are pruned
+    tweetid = models.ForeignKey(Tweet, on_delete=models.CASCADE)
+    bucket = models.DateTimeField(db_index=True)
+    retweet_count = models.IntegerField()
+    reply_count = models.IntegerField()
+    like_count = models.IntegerField()
+    quote_count = models.IntegerField()
+    samples = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('tweetid', 'bucket')
 
 
 class ReferencedTweet(models.Model):
@@ -139,9 +152,20 @@ class MediaMetrics(models.Model):
 
 class TrackedTweet(models.Model):
     tweetid = models.ForeignKey(Tweet, on_delete=models.CASCADE)
-    created_at = models.DateTimeField()
+    created_at = models.DateTimeField(db_index=True)
     metrics_per_update = models.IntegerField()
+    # The channel group of the stream that received the tweet
+    group = models.CharField(max_length=100, default='tweet', db_index=True)
+
+
 
 
 
 
+class TrackerLease(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.CharField(max_length=255, default='')
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,121 @@
+import asyncio
+from collections import Counter, deque
+
+from django.conf import settings
+
+
+""" What a full outbox does with each type of message """
+KEEP = 'keep'
+DROP_OLDEST = 'drop_oldest'
+LATEST = 'latest'
+POLICIES = {
+    'status': KEEP,
+    'rulestatus': KEEP,
+    'rule': KEEP,
+    'tweet': DROP_OLDEST,
+    'hmc': LATEST,
+    'tweetmetrics': LATEST,
+}
+
+
+""" Bounded queue of the messages waiting to be sent over one websocket """
+class Outbox:
+    def __init__(self, send, capacity=None, name='outbox'):
+        """
+        Decouples the consumer's handlers from the speed of its client: the handlers queue their messages and return,
+        and a writer task sends them in order, one at a time. When the client reads slower than messages arrive, the
+        queue is kept to its capacity by a policy per message type:
+        status, rulestatus and rule messages are always delivered,
+        tweet messages are dropped oldest first,
+        hmc and tweetmetrics messages replace the one of their type still waiting, so only the latest is sent.
+        Messages that are always delivered, and the latest of each type, go past the capacity when there are no tweets
+        left to drop. Types without a policy are always delivered. Drops are counted per message type.
+        :param send: Coroutine function sending one queued payload
+        :param capacity: Max messages waiting. Defaults to LIVETWEETS_OUTBOX_CAPACITY
+        :param name: The name of the outbox, for the printed errors
+        """
+        self.send = send
+        self.capacity = capacity or settings.LIVETWEETS_OUTBOX_CAPACITY
+        self.name = name
+        self.queue = deque()
+        self.latest = dict()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.sent = 0
+        self.dropped = Counter()
+        self.max_queued = 0
+
+    def put(self, kind, payload):
+        """
+        Queues a message, and starts the writer task if it is not running.
+        :param kind: The type of the message
+        :param payload: What to send, passed to the send function
+        """
+        policy = POLICIES.get(kind, KEEP)
+        if policy == LATEST and kind in self.latest:
+            self.latest[kind][1] = payload
+            self.dropped[kind] += 1
+            return
+        if len(self.queue) >= self.capacity and not self.drop_oldest_tweet():
+            if policy == DROP_OLDEST:
+                self.dropped[kind] += 1
+                return
+        entry = [kind, payload]
+        self.queue.append(entry)
+        if policy == LATEST:
+            self.latest[kind] = entry
+        self.max_queued = max(self.max_queued, len(self.queue))
+        self.ready.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def drop_oldest_tweet(self):
+        """
+        Drops the oldest queued message of the types dropped oldest first.
+        :return: True if a message was dropped
+        """
+        for entry in self.queue:
+            if POLICIES.get(entry[0]) == DROP_OLDEST:
+                self.queue.remove(entry)
+                self.dropped[entry[0]] += 1
+                return True
+        return False
+
+    async def run(self):
+        """
+        Sends the queued messages in order until stopped. A failed send is printed, and the next one goes ahead.
+        """
+        while True:
+            if not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+            entry = self.queue.popleft()
+            kind, payload = entry
+            if self.latest.get(kind) is entry:
+                del self.latest[kind]
+            try:
+                await self.send(payload)
+                self.sent += 1
+            except Exception as e:
+                print(f'{self.name} failed to send {kind}: {e!r}')
+
+    def stop(self):
+        """
+        Stops the writer task. Messages still queued are discarded.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.queue.clear()
+        self.latest.clear()
+
+    def stats(self):
+        """
+        :return: Dictionary of the messages sent, waiting and most waiting at once, and the drops per message type
+        """
+        return {
+            'sent': self.sent,
+            'queued': len(self.queue),
+            'max_queued': self.max_queued,
+            'dropped': dict(self.dropped),
+        }
@@ -0,0 +1,74 @@
+import asyncio
+import math
+
+
+""" Periodic jobs on absolute deadlines """
+class Periodic:
+    def __init__(self, func, interval, name='periodic', condition=None):
+        """
+        Calls a coroutine function on a fixed cadence. Ticks are due at start + n * interval, so the time a cycle
+        takes does not shift the ticks after it, and cycles never overlap: the next one starts when the current one
+        is done. Ticks missed while a cycle ran too long are skipped, so the job catches up with a single cycle
+        instead of running the missed ones back to back. An exception in a cycle is counted and printed, and does not
+        end the loop. The loop ends when the task running it is cancelled, or when the condition turns false.
+        :param func: Coroutine function called without arguments every tick
+        :param interval: Seconds between ticks
+        :param name: The name of the job, for the printed errors
+        :param condition: Optional function, the loop ends before the next cycle if it returns False
+        """
+        self.func = func
+        self.interval = interval
+        self.name = name
+        self.condition = condition
+        self.cycles = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lateness = None
+        self.max_lateness = 0.0
+
+    async def run(self):
+        """
+        Runs the job, the first cycle right away.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time()
+        while self.condition is None or self.condition():
+            start = loop.time()
+            lateness = start - deadline
+            if lateness >= self.interval:
+                missed = math.floor(lateness / self.interval)
+                self.skipped += missed
+                deadline += missed * self.interval
+                lateness = start - deadline
+            try:
+                await self.func()
+            except Exception as e:
+                self.failures += 1
+                print(f'{self.name} cycle failed: {e!r}')
+            duration = loop.time() - start
+            self.cycles += 1
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+            self.total_duration += duration
+            self.last_lateness = lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            deadline += self.interval
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    def stats(self):
+        """
+        :return: Dictionary of the cycles run, failed and skipped, and their duration and lateness in seconds
+        """
+        return {
+            'cycles': self.cycles,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_duration': round(self.last_duration, 3) if self.last_duration is not None else None,
+            'mean_duration': round(self.total_duration / self.cycles, 3) if self.cycles else None,
+            'max_duration': round(self.max_duration, 3),
+            'last_lateness': round(self.last_lateness, 3) if self.last_lateness is not None else None,
+            'max_lateness': round(self.max_lateness, 3),
+        }
@@ -0,0 +1,135 @@
+import math
+
+from django.conf import settings
+from django.utils import timezone
+from .models import TrackedTweet
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def get_tracking_candidates(starttime, limit, group='tweet'):
+    """
+    Gets the tweets that may be checked for engagement, most recent first.
+    :param starttime: Datetime object of when the tracking was started
+    :param limit: The max number of candidates
+    :param group: The channel group the tweets are tracked for
+    :return: list of (tweet id, created_at) tuples
+    """
+    tweets = TrackedTweet.objects.filter(group=group, created_at__gte=starttime).order_by('-created_at')[:limit]
+    return list(tweets.values_list('tweetid', 'created_at'))
+
+
+def set_metrics_per_update(rates, group='tweet'):
+    """
+    Stores the engagement the tracked tweets of a group gain per update, in one bulk update.
+    :param rates: Dictionary of tweet id -> engagement per update
+    :param group: The channel group the tweets are tracked for
+    """
+    if not rates:
+        return
+    tracked = list(TrackedTweet.objects.filter(group=group, tweetid__in=list(rates)).only('pk', 'tweetid'))
+    for tracked_tweet in tracked:
+        tracked_tweet.metrics_per_update = rates[tracked_tweet.tweetid_id]
+    TrackedTweet.objects.bulk_update(tracked, ['metrics_per_update'])
+
+
+""" Choice of the tweets to poll in each engagement update """
+class PriorityScheduler:
+    def __init__(self, velocity, budget=None, batch_size=100, candidates=None, hot_share=None, cold_every=None,
+                 flat_polls=None, gravity=None):
+        """
+        Ranks the candidate tweets by their engagement velocity, damped by their age, and picks the ones to poll
+        within a budget of API requests per update. The hottest tweets are polled every update, the others once
+        every few updates, and tweets whose engagement stays flat over several polls are evicted for good.
+        Tweets without a velocity yet are polled right after the hottest ones, newest first, so they get one.
+        :param velocity: The VelocityEngine holding the engagement snapshots of the tweets
+        :param budget: get_tweets requests per update. Defaults to LIVETWEETS_TRACKER_REQUEST_BUDGET
+        :param batch_size: Tweet ids per request, 100 is the max of the API
+        :param candidates: Max candidate tweets looked at. Defaults to LIVETWEETS_TRACKER_CANDIDATES
+        :param hot_share: Share of the polled ids reserved for the tweets polled every update.
+        Defaults to LIVETWEETS_TRACKER_HOT_SHARE
+        :param cold_every: Updates between the polls of the other tweets. Defaults to LIVETWEETS_TRACKER_COLD_EVERY
+        :param flat_polls: Polls without any engagement gained before a tweet is evicted.
+        Defaults to LIVETWEETS_TRACKER_FLAT_POLLS
+        :param gravity: How fast the score of a tweet drops with its age. Defaults to LIVETWEETS_TRACKER_GRAVITY
+        """
+        self.velocity = velocity
+        self.budget = budget or settings.LIVETWEETS_TRACKER_REQUEST_BUDGET
+        self.batch_size = batch_size
+        self.candidates = candidates or settings.LIVETWEETS_TRACKER_CANDIDATES
+        self.hot_share = hot_share if hot_share is not None else settings.LIVETWEETS_TRACKER_HOT_SHARE
+        self.cold_every = cold_every or settings.LIVETWEETS_TRACKER_COLD_EVERY
+        self.flat_polls = flat_polls or settings.LIVETWEETS_TRACKER_FLAT_POLLS
+        self.gravity = gravity if gravity is not None else settings.LIVETWEETS_TRACKER_GRAVITY
+        self.update = 0
+        self.last_polled = dict()
+        self.evicted = set()
+
+    def score(self, rate, created_at, now):
+        """
+        :return: The engagement per second of the tweet divided by (age in hours + 2) ** gravity
+        """
+        hours = max(0.0, (now - created_at).total_seconds() / 3600)
+        return rate / math.pow(hours + 2, self.gravity)
+
+    def select(self, candidates, requests=None):
+        """
+        Picks the tweets to poll in this update, and drops the history of the tweets that are no longer candidates.
+        :param candidates: list of (tweet id, created_at) tuples, most recent first
+        :param requests: Optional number of requests allowed in this update, when it is below the budget. The
+        capacity shrinks with it, keeping the highest priority tweets
+        :return: list of the tweet ids to poll: the hottest ones, the new ones, then the others that are due
+        """
+        self.update += 1
+        now = timezone.now()
+        tweetids = {str(tweetid) for tweetid, _ in candidates}
+        self.evicted &= tweetids
+        self.last_polled = {tweetid: update for tweetid, update in self.last_polled.items() if tweetid in tweetids}
+        self.velocity.retain(tweetids - self.evicted)
+        rates = self.velocity.rates()
+
+        new = list()
+        scored = list()
+        for tweetid, created_at in candidates:
+            tweetid = str(tweetid)
+            if tweetid in self.evicted:
+                continue
+            if tweetid in rates:
+                scored.append((self.score(rates[tweetid], created_at, now), tweetid))
+            else:
+                new.append(tweetid)
+        scored.sort(reverse=True)
+        ranked = [tweetid for _, tweetid in scored]
+
+        capacity = min(self.budget, requests or self.budget) * self.batch_size
+        hot = math.ceil(capacity * self.hot_share)
+        selected = ranked[:hot] + new[:capacity - min(hot, len(ranked))]
+        for tweetid in ranked[hot:]:
+            if len(selected) >= capacity:
+                break
+            if self.update - self.last_polled.get(tweetid, 0) >= self.cold_every:
+                selected.append(tweetid)
+        for tweetid in selected:
+            self.last_polled[tweetid] = self.update
+        return selected
+
+    def evict_flat(self, tweetids):
+        """
+        Evicts the polled tweets whose engagement did not change over the last polls.
+        Called after the snapshot of the update was recorded.
+        :param tweetids: The ids of the polled tweets
+        :return: list of the evicted tweet ids
+        """
+        evicted = self.velocity.flat(tweetids, self.flat_polls)
+        self.evicted.update(evicted)
+        self.velocity.retain(set(self.velocity.rows) - self.evicted)
+        return evicted
+
+    def rates(self, tweetids, interval=None):
+        """
+        :param tweetids: The ids of the polled tweets
+        :param interval: Seconds between updates. Defaults to LIVETWEETS_ENGAGEMENT_INTERVAL
+        :return: Dictionary of tweet id -> engagement gained per update, for the tweets that have a velocity
+        """
+        interval = interval or settings.LIVETWEETS_ENGAGEMENT_INTERVAL
+        rates = self.velocity.rates()
+        return {tweetid: round(rates[tweetid] * interval) for tweetid in tweetids if tweetid in rates}
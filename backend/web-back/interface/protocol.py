@@ -0,0 +1,155 @@
+import json
+import uuid
+from collections import OrderedDict
+
+import msgpack
+
+
+""" The websocket subprotocols a dashboard can ask for when it connects """
+JSON_PROTOCOL = 'livetweets.json'
+MSGPACK_PROTOCOL = 'livetweets.msgpack'
+PROTOCOLS = (MSGPACK_PROTOCOL, JSON_PROTOCOL)
+
+""" Short keys and message type codes of the binary protocol, mirrored by the decoder in static/main.js """
+SHORT_KEYS = {
+    'type': 't',
+    'id': 'i',
+    'filters': 'f',
+    'filter': 'fr',
+    'tag': 'g',
+    'stream': 's',
+    'hashtags': 'H',
+    'mentions': 'M',
+    'contexts': 'C',
+    'hashtag': 'h',
+    'mention': 'm',
+    'name': 'n',
+    'count': 'c',
+    'results': 'r',
+    'MT_data': 'd',
+    'Retweet_count': 'rt',
+    'Like_count': 'lk',
+    'Quote_count': 'qt',
+    'Reply_count': 'rp',
+    'rules': 'R',
+    'tweets': 'T',
+    'hmc': 'hm',
+    'tweetmetrics': 'tm',
+}
+TYPE_CODES = {
+    'tweet': 1,
+    'status': 2,
+    'rule': 3,
+    'rulestatus': 4,
+    'hmc': 5,
+    'tweetmetrics': 6,
+    'snapshot': 7,
+}
+
+""" The messages and frames of the latest broadcasts, per event key, shared by the consumers of this worker """
+MESSAGES = OrderedDict()
+FRAMES = OrderedDict()
+KEPT = 256
+
+
+def choose_protocol(scope):
+    """
+    Picks the subprotocol of a websocket connection, the first one the client asked for that we speak.
+    :param scope: The scope of the websocket connection
+    :return: The subprotocol, or None if the client asked for none we speak, in which case JSON is used
+    """
+    for protocol in scope.get('subprotocols') or []:
+        if protocol in PROTOCOLS:
+            return protocol
+    return None
+
+
+def shorten(value):
+    """
+    :return: The value with the keys of its dictionaries, at any depth, replaced by their short keys
+    """
+    if isinstance(value, dict):
+        return {SHORT_KEYS.get(key, key): shorten(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [shorten(item) for item in value]
+    return value
+
+
+def encode_msgpack(message):
+    """
+    Encodes a message for the binary protocol: short keys, the type as a number, packed with MessagePack.
+    :param message: Dictionary with a 'type'
+    :return: The bytes of the frame
+    """
+    message = dict(message, type=TYPE_CODES.get(message['type'], message['type']))
+    return msgpack.packb(shorten(message))
+
+
+def encode_json(message):
+    """
+    :return: The message as the text of a JSON frame
+    """
+    return json.dumps(message)
+
+
+def encode_frame(message, protocol):
+    """
+    :param message: Dictionary with a 'type'
+    :param protocol: The subprotocol of the connection, None for JSON
+    :return: The message as MessagePack bytes for the binary protocol, else as JSON text
+    """
+    if protocol == MSGPACK_PROTOCOL:
+        return encode_msgpack(message)
+    return encode_json(message)
+
+
+def frame_event(message, **fields):
+    """
+    Builds a channel layer event carrying a message for the websocket clients, packed with MessagePack, and a key
+    identifying it. The channel layer copies the packed bytes to every consumer without walking the message, and the
+    consumers of a worker unpack it and encode it for each protocol they speak once, see event_frame.
+    :param message: Dictionary with a 'type', the type of the event as well
+    :param fields: Other fields of the event, for the consumers' own use
+    :return: The event
+    """
+    return dict(fields, type=message['type'], key=uuid.uuid4().hex, packed=msgpack.packb(message))
+
+
+def remember(cache, key, value):
+    """
+    Adds a value to a cache of this worker, dropping the oldest one when there are more than KEPT.
+    :return: The value
+    """
+    cache[key] = value
+    if len(cache) > KEPT:
+        cache.popitem(last=False)
+    return value
+
+
+def event_message(event):
+    """
+    Gets the message of a broadcast, unpacked once for all the consumers of this worker. Do not modify it.
+    :param event: An event built by frame_event, or any event with a unique 'key' and its 'message'
+    :return: The message, a dictionary with a 'type'
+    """
+    if 'message' in event:
+        return event['message']
+    message = MESSAGES.get(event['key'])
+    if message is None:
+        message = remember(MESSAGES, event['key'], msgpack.unpackb(event['packed']))
+    return message
+
+
+def event_frame(event, protocol):
+    """
+    Gets the frame of a broadcast for a protocol. The first consumer of this worker to forward the event in that
+    protocol encodes it, and the other consumers reuse its frame. Only the frames of the latest events are kept.
+    :param event: An event built by frame_event, or any event with a unique 'key' and its 'message'
+    :param protocol: The subprotocol of the connection, None for JSON
+    :return: The frame, bytes for the binary protocol, else text
+    """
+    key = (event['key'], protocol == MSGPACK_PROTOCOL)
+    frame = FRAMES.get(key)
+    if frame is None:
+        frame = remember(FRAMES, key, encode_frame(event_message(event), protocol))
+    return frame
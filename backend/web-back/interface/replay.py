@@ -0,0 +1,91 @@
+import asyncio
+import gzip
+import json
+
+from tweepy.utils import parse_datetime
+
+
+""" Offline replay of recorded stream payloads through a LiveStream """
+def read_payloads(paths):
+    """
+    Reads recorded stream payloads from NDJSON files, one payload per line as received from the filtered stream.
+    Files ending with .gz are decompressed. Empty lines, like the keep-alive newlines of the stream, are skipped.
+    :param paths: list of file paths
+    :return: Generator of raw payload lines
+    """
+    for path in paths:
+        opener = gzip.open if str(path).endswith('.gz') else open
+        with opener(path, 'rb') as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def payload_time(line):
+    """
+    :param line: A raw payload line
+    :return: The created_at datetime of the tweet in the payload, or None if it has none
+    """
+    created_at = json.loads(line).get('data', dict()).get('created_at')
+    if created_at is None:
+        return None
+    return parse_datetime(created_at)
+
+
+class ReplaySource:
+    def __init__(self, stream, paths, speed=None):
+        """
+        Feeds recorded payloads into a stream's on_data method, the same path taken by payloads from Twitter.
+        :param stream: The LiveStream to feed
+        :param paths: list of NDJSON file paths
+        :param speed: 1 to replay at the pace the tweets were created, N for N times as fast,
+        None or 0 to replay as fast as possible
+        """
+        self.stream = stream
+        self.paths = paths
+        self.speed = speed
+        self.payloads = 0
+        self.tweets = 0
+        self.seconds = 0
+
+    async def run(self):
+        """
+        Replays the payloads. When pacing, each tweet waits until its created_at time, relative to the first tweet
+        and scaled by the speed, has passed. Payloads are never delayed if the replay is behind.
+        Finally the stream's ingestion pipeline and hmc broadcaster are stopped, so everything is stored.
+        :return: Dictionary with the number of payloads and tweets, the seconds taken and the tweets per second
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        first = None
+        for line in read_payloads(self.paths):
+            if self.speed:
+                created_at = payload_time(line)
+                if created_at is not None:
+                    if first is None:
+                        first = created_at
+                    wait = start + (created_at - first).total_seconds() / self.speed - loop.time()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+            await self.stream.on_data(line)
+            self.payloads += 1
+            if b'"data":' in line:
+                self.tweets += 1
+        await self.stream.ingest.stop()
+        await self.stream.hmc.stop()
+        if self.stream.archive is not None:
+            await self.stream.archive.close()
+        self.seconds = loop.time() - start
+        return self.stats()
+
+    def stats(self):
+        """
+        :return: Dictionary with the number of payloads and tweets, the seconds taken and the tweets per second
+        """
+        return {
+            'payloads': self.payloads,
+            'tweets': self.tweets,
+            'seconds': round(self.seconds, 3),
+            'tweets_per_second': round(self.tweets / self.seconds, 1) if self.seconds else None
+        }
@@ -0,0 +1,182 @@
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Tweet, TweetMetrics, TweetMetricsRollup, TrackedTweet
+from .periodic import Periodic
+from .tracking import acquire_lease
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def delete_chunk(model, column, cutoff, chunk_size):
+    """
+    Deletes up to chunk_size of the oldest rows of a table, older than a cutoff. The rows are found on the indexed
+    time column and deleted by primary key, so each call is a bounded amount of work. Rows that refer to deleted
+    tweets, including the rows of the many-to-many tables, are deleted with them.
+    :param model: The model of the table
+    :param column: The name of the indexed time column
+    :param cutoff: Datetime object, rows older than this are deleted
+    :param chunk_size: The max number of rows deleted
+    :return: The number of rows deleted
+    """
+    pks = list(model.objects.filter(**{f'{column}__lt': cutoff}).order_by(column)
+               .values_list('pk', flat=True)[:chunk_size])
+    if pks:
+        model.objects.filter(pk__in=pks).delete()
+    return len(pks)
+
+
+def bucket_start(time, bucket_seconds):
+    """
+    :return: The start of the bucket holding the time, as an aware datetime
+    """
+    timestamp = time.timestamp()
+    return datetime.fromtimestamp(timestamp - timestamp % bucket_seconds, tz=dt_timezone.utc)
+
+
+def rollup_chunk(cutoff, bucket_seconds, chunk_size):
+    """
+    Rolls up to chunk_size of the oldest metrics older than a cutoff into TweetMetricsRollup buckets, and deletes
+    them. The metrics are running totals, so a bucket keeps the highest counts seen within it.
+    :param cutoff: Datetime object, metrics older than this are rolled up
+    :param bucket_seconds: The length of the buckets
+    :param chunk_size: The max number of metrics rolled up
+    :return: The number of metrics rolled up
+    """
+    with transaction.atomic():
+        metrics = list(TweetMetrics.objects.filter(time__lt=cutoff).order_by('time')
+                       .values_list('pk', 'tweetid_id', 'time', 'retweet_count', 'reply_count', 'like_count',
+                                    'quote_count')[:chunk_size])
+        if not metrics:
+            return 0
+        buckets = dict()
+        for _, tweetid, time, *counts in metrics:
+            key = (tweetid, bucket_start(time, bucket_seconds))
+            if key in buckets:
+                buckets[key] = [max(a, b) for a, b in zip(buckets[key], counts + [0])]
+                buckets[key][-1] += 1
+            else:
+                buckets[key] = counts + [1]
+        existing = TweetMetricsRollup.objects.filter(tweetid_id__in={tweetid for tweetid, _ in buckets},
+                                                     bucket__in={bucket for _, bucket in buckets})
+        updated = list()
+        for rollup in existing:
+            counts = buckets.pop((rollup.tweetid_id, rollup.bucket), None)
+            if counts is None:
+                continue
+            rollup.retweet_count = max(rollup.retweet_count, counts[0])
+            rollup.reply_count = max(rollup.reply_count, counts[1])
+            rollup.like_count = max(rollup.like_count, counts[2])
+            rollup.quote_count = max(rollup.quote_count, counts[3])
+            rollup.samples += counts[4]
+            updated.append(rollup)
+        TweetMetricsRollup.objects.bulk_update(
+            updated, ['retweet_count', 'reply_count', 'like_count', 'quote_count', 'samples'])
+        TweetMetricsRollup.objects.bulk_create([
+            TweetMetricsRollup(tweetid_id=tweetid, bucket=bucket, retweet_count=counts[0], reply_count=counts[1],
+                               like_count=counts[2], quote_count=counts[3], samples=counts[4])
+            for (tweetid, bucket), counts in buckets.items()
+        ])
+        TweetMetrics.objects.filter(pk__in=[metric[0] for metric in metrics]).delete()
+    return len(metrics)
+
+
+def retention_policies():
+    """
+    :return: list of (model, indexed time column, ttl in seconds) tuples from the settings, the tables with a ttl of
+    0 are kept forever. Tweets go last, as deleting them also deletes the rows referring to them.
+    """
+    policies = [
+        (TweetMetrics, 'time', settings.LIVETWEETS_RETENTION_METRICS_TTL),
+        (TweetMetricsRollup, 'bucket', settings.LIVETWEETS_RETENTION_ROLLUP_TTL),
+        (TrackedTweet, 'created_at', settings.LIVETWEETS_RETENTION_TRACKED_TTL),
+        (Tweet, 'created_at', settings.LIVETWEETS_RETENTION_TWEET_TTL),
+    ]
+    return [(model, column, ttl) for model, column, ttl in policies if ttl]
+
+
+""" Pruning of the stored tweets and metrics, outside of the stream and the engagement updates """
+class RetentionWorker:
+    lease_name = 'retention'
+
+    def __init__(self, policies=None, interval=None, chunk_size=None, rollup_bucket=None):
+        """
+        Periodically deletes the rows older than the ttl of their table, so the size of the database stays flat and
+        the stream and the engagement updates never pay for deletes. Rows are deleted in chunks, each its own short
+        query on the ORM thread, so the stream's writes get in between. Raw metrics are rolled up into coarser buckets
+        before they are deleted, unless the bucket length is 0.
+        Only the worker holding the retention lease prunes, the others skip their runs.
+        :param policies: list of (model, column, ttl) tuples. Defaults to retention_policies()
+        :param interval: Seconds between runs. Defaults to LIVETWEETS_RETENTION_INTERVAL
+        :param chunk_size: Max rows per delete. Defaults to LIVETWEETS_RETENTION_CHUNK_SIZE
+        :param rollup_bucket: Seconds per rollup bucket. Defaults to LIVETWEETS_RETENTION_ROLLUP_BUCKET
+        """
+        self.policies = policies if policies is not None else retention_policies()
+        self.interval = interval or settings.LIVETWEETS_RETENTION_INTERVAL
+        self.chunk_size = chunk_size or settings.LIVETWEETS_RETENTION_CHUNK_SIZE
+        self.rollup_bucket = rollup_bucket if rollup_bucket is not None else settings.LIVETWEETS_RETENTION_ROLLUP_BUCKET
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.schedule = None
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        """
+        Starts the retention loop of this worker if it is not already running.
+        """
+        if not self.running:
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        """
+        Runs prune_all every interval until stopped. A failed run is printed, and the next one goes ahead.
+        """
+        self.schedule = Periodic(self.tick, self.interval, name='Retention')
+        await self.schedule.run()
+
+    async def tick(self):
+        """
+        One retention run: takes or renews the lease, and prunes if we hold it.
+        """
+        if await sync_to_async(acquire_lease)(self.lease_name, self.holder, self.interval * 2):
+            deleted = await self.prune_all()
+            if any(deleted.values()):
+                print(f'Retention pruned {deleted}, timing: {self.schedule.stats()}')
+
+    async def prune_all(self):
+        """
+        Prunes every table down to its ttl, one chunk at a time.
+        :return: Dictionary of table name -> rows deleted
+        """
+        now = timezone.now()
+        deleted = dict()
+        for model, column, ttl in self.policies:
+            cutoff = now - timedelta(seconds=ttl)
+            total = 0
+            while True:
+                if model is TweetMetrics and self.rollup_bucket:
+                    count = await sync_to_async(rollup_chunk)(cutoff, self.rollup_bucket, self.chunk_size)
+                else:
+                    count = await sync_to_async(delete_chunk)(model, column, cutoff, self.chunk_size)
+                total += count
+                if count < self.chunk_size:
+                    break
+            deleted[model._meta.db_table] = total
+        return deleted
+
+    async def stop(self):
+        """
+        Stops the retention loop of this worker.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
@@ -1,9 +1,12 @@
-from django.urls import path
+from django.urls import path, re_path
 
 
 from . import consumers
 
 websocket_urlpatterns = [
     path(r'ws/tweets', consumers.TweetConsumer.as_asgi()),
+    # One channel group per session, the session id becomes part of the group name. It is limited to 64 letters,
+    # digits, - and _, the characters allowed in group names, so 'tweet.<session>' stays under their 100 characters
+    re_path(r'^ws/tweets/(?P<session>[A-Za-z0-9_-]{1,64})$', consumers.TweetConsumer.as_asgi()),
     
 ]
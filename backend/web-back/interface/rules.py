@@ -0,0 +1,96 @@
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .models import StreamRules
+
+
+# The channel group every consumer joins, whatever its session, to hear about changes to the shared stream rules
+RULES_GROUP = 'rules'
+
+
+""" Rules of the sessions, which share the rules of the filtered stream """
+def session_tag(group, tag):
+    """
+    The rules of the filtered stream are shared by the whole app, so the tag of a rule on Twitter is prefixed with
+    the channel group of the session it belongs to.
+    :param group: The channel group of the session
+    :param tag: The tag of the rule in the session, e.g. 'hashtagsfilter'
+    :return: The tag of the rule on Twitter, e.g. 'tweet.abc:hashtagsfilter'
+    """
+    return f'{group}:{tag}'
+
+
+def split_tag(tag):
+    """
+    :param tag: The tag of a rule on Twitter
+    :return: The channel group of the session of the rule, and the tag of the rule in the session. Rules without the
+    prefix of a session, e.g. added before the rules were tagged, belong to the 'tweet' group
+    """
+    group, separator, name = (tag or '').partition(':')
+    if separator and (group == 'tweet' or group.startswith('tweet.')):
+        return group, name
+    return 'tweet', tag
+
+
+""" Cached terms of the active stream rules, used to leave tracked terms out of the hmc lists """
+class TrackedTerms:
+    def __init__(self, hashtags, mentions, contexts):
+        """
+        :param hashtags: Set of hashtags in the active rules, without '#'
+        :param mentions: Set of usernames in the active rules, without '@'
+        :param contexts: Set of context entity ids in the active rules
+        """
+        self.hashtags = hashtags
+        self.mentions = mentions
+        self.contexts = contexts
+        self.built_at = time.monotonic()
+
+
+_tracked_terms = None
+
+
+def parse_rule_terms(values):
+    """
+    Parses the hashtags, mentions and context entities out of rule values.
+    :param values: Iterable of rule values, e.g. '(#python OR @django) context:131.1220701888179359745'
+    :return: TrackedTerms of the rules
+    """
+    parts = ' '.join(values).replace('(', '').replace(')', '').split()
+    hashtags = {part[1:] for part in parts if part.startswith('#')}
+    mentions = {part[1:] for part in parts if part.startswith('@')}
+    contexts = {part[8:].split('.')[-1] for part in parts if part.startswith('context:')}
+    return TrackedTerms(hashtags, mentions, contexts)
+
+
+def get_tracked_terms():
+    """
+    Gets the terms of the active rules. They are parsed from the database on first use and kept until the rules
+    change, or at most LIVETWEETS_RULES_CACHE_TTL seconds in case an invalidation was missed.
+    :return: TrackedTerms of the active rules
+    """
+    global _tracked_terms
+    terms = _tracked_terms
+    if terms is None or time.monotonic() - terms.built_at > settings.LIVETWEETS_RULES_CACHE_TTL:
+        values = StreamRules.objects.filter(active=True).values_list('value', flat=True)
+        terms = _tracked_terms = parse_rule_terms(values)
+    return terms
+
+
+def invalidate_tracked_terms():
+    """
+    Drops the cached terms of this process, so they are parsed again on next use.
+    """
+    global _tracked_terms
+    _tracked_terms = None
+
+
+async def broadcast_rules_changed(group=RULES_GROUP):
+    """
+    Drops the cached terms of this process, and tells the consumers of the other workers to do the same.
+    Called after the stored rules are changed.
+    :param group: The channel group to send to
+    """
+    invalidate_tracked_terms()
+    channel_layer = get_channel_layer()
+    await channel_layer.group_send(group, {"type": "rules.changed"})
@@ -0,0 +1,222 @@
+import asyncio
+import json
+from collections import deque
+
+import redis.asyncio
+from django.conf import settings
+
+
+""" The latest state of each session, sent to the dashboards as they connect """
+class StateCache:
+    def __init__(self, tweets=None):
+        """
+        Keeps what a dashboard that connects now would have been sent already: the active rules, the latest tweet
+        metrics and the last tweets of each channel group, and the latest hmc lists, which are shared by all groups. It
+        is written by the senders of the broadcasts, once per broadcast, and read by the consumers as they connect, so
+        a new dashboard is drawn right away, without waiting for the next broadcasts or reading the database.
+        It also keeps the groups whose stream is started, which the filtered stream sends tweets to.
+        This cache is held in the memory of the worker, so it only knows the broadcasts sent from this worker.
+        RedisStateCache shares it between the workers.
+        :param tweets: The number of tweets kept per group. Defaults to LIVETWEETS_SNAPSHOT_TWEETS
+        """
+        self.tweets = tweets or settings.LIVETWEETS_SNAPSHOT_TWEETS
+        self.groups = dict()
+        self.hmc = None
+        self.streaming_groups = set()
+
+    def state(self, group):
+        if group not in self.groups:
+            self.groups[group] = {'rules': list(), 'tweetmetrics': None, 'tweets': deque(maxlen=self.tweets)}
+        return self.groups[group]
+
+    async def set_rules(self, group, rules):
+        """
+        Replaces the rules of a group.
+        :param group: The channel group
+        :param rules: list of the rule messages, as the websocket clients get them
+        """
+        self.state(group)['rules'] = list(rules)
+
+    async def set_latest(self, group, message):
+        """
+        Replaces the tweetmetrics message of a group.
+        :param group: The channel group
+        :param message: The message, as the websocket clients get it
+        """
+        self.state(group)[message['type']] = message
+
+    async def set_hmc(self, message):
+        """
+        Replaces the hmc message, the same for every group.
+        :param message: The message, as the websocket clients get it, with the 'seq' and 'sender' of its broadcast
+        """
+        self.hmc = message
+
+    async def add_tweet(self, group, message):
+        """
+        Adds a tweet message to a group, dropping the oldest one when there are more than the number kept.
+        :param group: The channel group
+        :param message: The tweet message, as the websocket clients get it
+        """
+        self.state(group)['tweets'].append(message)
+
+    async def set_streaming(self, group, streaming):
+        """
+        Marks a group as streaming, when its stream is started, or as not streaming, when it is stopped.
+        :param group: The channel group
+        :param streaming: True if the group is streaming
+        """
+        if streaming:
+            self.streaming_groups.add(group)
+        else:
+            self.streaming_groups.discard(group)
+
+    async def streaming(self):
+        """
+        :return: Set of the channel groups that are streaming
+        """
+        return set(self.streaming_groups)
+
+    async def snapshot(self, group):
+        """
+        :param group: The channel group
+        :return: The snapshot message of a group: the rules and tweets as lists of messages, the tweets oldest
+        first, and the latest hmc and tweetmetrics messages, or None if there are none yet
+        """
+        state = self.state(group)
+        return {'type': 'snapshot', 'rules': list(state['rules']), 'hmc': self.hmc,
+                'tweetmetrics': state['tweetmetrics'], 'tweets': list(state['tweets'])}
+
+
+""" The latest state of each session, shared by the workers in Redis """
+class RedisStateCache(StateCache):
+    def __init__(self, url, tweets=None, timeout=None, flush_interval=None):
+        """
+        Keeps the state of each channel group in Redis as JSON, under keys prefixed by livetweets:snapshot:<group>,
+        so the dashboards get the same snapshot whichever worker they connect to. The tweets are a list trimmed to the
+        number kept, the rules and the tweetmetrics messages are strings, and so is the hmc message, under
+        livetweets:snapshot:hmc. The streaming groups are a set under livetweets:snapshot:streaming. Redis errors are
+        printed, and leave the state as it was, or give the empty snapshot.
+        The tweets are sent for every tweet of the stream, so they are buffered in memory and pushed by a background
+        task, all the groups in one round trip, instead of holding up the stream with a round trip per tweet. Every
+        command times out, so an unreachable Redis only costs the snapshots, not the stream.
+        :param url: The URL of the Redis database, e.g. redis://redis:6379/1
+        :param tweets: The number of tweets kept per group. Defaults to LIVETWEETS_SNAPSHOT_TWEETS
+        :param timeout: Seconds to connect and to wait for a reply. Defaults to LIVETWEETS_SNAPSHOT_REDIS_TIMEOUT
+        :param flush_interval: Max seconds a tweet is buffered. Defaults to LIVETWEETS_SNAPSHOT_FLUSH_INTERVAL
+        """
+        super().__init__(tweets)
+        timeout = timeout or settings.LIVETWEETS_SNAPSHOT_REDIS_TIMEOUT
+        self.redis = redis.asyncio.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.flush_interval = flush_interval or settings.LIVETWEETS_SNAPSHOT_FLUSH_INTERVAL
+        self.pending = dict()
+        self.task = None
+
+    HMC_KEY = 'livetweets:snapshot:hmc'
+    STREAMING_KEY = 'livetweets:snapshot:streaming'
+
+    @staticmethod
+    def key(group, name):
+        return f'livetweets:snapshot:{group}:{name}'
+
+    async def set_rules(self, group, rules):
+        try:
+            await self.redis.set(self.key(group, 'rules'), json.dumps(list(rules)))
+        except Exception as e:
+            print(f'Failed to store the rules of {group}: {e!r}')
+
+    async def set_latest(self, group, message):
+        try:
+            await self.redis.set(self.key(group, message['type']), json.dumps(message))
+        except Exception as e:
+            print(f'Failed to store the {message["type"]} of {group}: {e!r}')
+
+    async def set_hmc(self, message):
+        try:
+            await self.redis.set(self.HMC_KEY, json.dumps(message))
+        except Exception as e:
+            print(f'Failed to store the hmc: {e!r}')
+
+    async def add_tweet(self, group, message):
+        if group not in self.pending:
+            self.pending[group] = deque(maxlen=self.tweets)
+        self.pending[group].append(message)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        """
+        The flusher loop. Pushes the buffered tweets every flush interval, and ends when no tweets are buffered.
+        """
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """
+        Pushes the buffered tweets of all the groups, and trims the lists to the number kept, in one transaction.
+        The tweets are dropped if it fails.
+        """
+        pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                for group, messages in pending.items():
+                    key = self.key(group, 'tweets')
+                    pipe.rpush(key, *[json.dumps(message) for message in messages])
+                    pipe.ltrim(key, -self.tweets, -1)
+                await pipe.execute()
+        except Exception as e:
+            print(f'Failed to store the tweets of {len(pending)} groups: {e!r}')
+
+    async def set_streaming(self, group, streaming):
+        try:
+            if streaming:
+                await self.redis.sadd(self.STREAMING_KEY, group)
+            else:
+                await self.redis.srem(self.STREAMING_KEY, group)
+        except Exception as e:
+            print(f'Failed to store the streaming of {group}: {e!r}')
+
+    async def streaming(self):
+        try:
+            return {group.decode() for group in await self.redis.smembers(self.STREAMING_KEY)}
+        except Exception as e:
+            print(f'Failed to read the streaming groups: {e!r}')
+            return set()
+
+    async def snapshot(self, group):
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.get(self.key(group, 'rules'))
+                pipe.get(self.HMC_KEY)
+                pipe.get(self.key(group, 'tweetmetrics'))
+                pipe.lrange(self.key(group, 'tweets'), 0, -1)
+                rules, hmc, tweetmetrics, tweets = await pipe.execute()
+        except Exception as e:
+            print(f'Failed to read the snapshot of {group}: {e!r}')
+            rules, hmc, tweetmetrics, tweets = None, None, None, list()
+        tweets = [json.loads(tweet) for tweet in tweets] + list(self.pending.get(group, ()))
+        return {'type': 'snapshot',
+                'rules': json.loads(rules) if rules else list(),
+                'hmc': json.loads(hmc) if hmc else None,
+                'tweetmetrics': json.loads(tweetmetrics) if tweetmetrics else None,
+                'tweets': tweets[-self.tweets:]}
+
+
+STATE_CACHE = None
+
+
+def get_state_cache():
+    """
+    :return: The state cache of this worker, a RedisStateCache if LIVETWEETS_SNAPSHOT_REDIS_URL is set, else a
+    StateCache. Created on first use
+    """
+    global STATE_CACHE
+    if STATE_CACHE is None:
+        if settings.LIVETWEETS_SNAPSHOT_REDIS_URL:
+            STATE_CACHE = RedisStateCache(settings.LIVETWEETS_SNAPSHOT_REDIS_URL)
+        else:
+            STATE_CACHE = StateCache()
+    return STATE_CACHE
@@ -1,37 +1,136 @@
-const ctx = document.getElementById('myChart').getContext('2d');
-var graphData = {
-    type: 'line',
-    data: {
-        labels: ['Red', 'Blue', 'Yellow', 'Green', 'Purple', 'Orange'],
-        datasets: [{
-            label: '# of Votes',
-            data: [12, 19, 3, 5, 2, 3],
-            backgroundColor: [
-                'rgba(73, 198, 230, 0.5)',
-                            ],
-            
-            borderWidth: 1
-        }]
-    },
-    options: {
-        
+// Decoder of the binary websocket protocol (subprotocol 'livetweets.msgpack'), mirrors interface/protocol.py
+const LIVETWEETS_PROTOCOLS = ['livetweets.msgpack', 'livetweets.json'];
+const LIVETWEETS_KEYS = {
+    t: 'type', i: 'id', f: 'filters', fr: 'filter', g: 'tag', s: 'stream',
+    H: 'hashtags', M: 'mentions', C: 'contexts', h: 'hashtag', m: 'mention', n: 'name', c: 'count',
+    r: 'results', d: 'MT_data', rt: 'Retweet_count', lk: 'Like_count', qt: 'Quote_count', rp: 'Reply_count',
+    R: 'rules', T: 'tweets', hm: 'hmc', tm: 'tweetmetrics'
+};
+const LIVETWEETS_TYPES = {1: 'tweet', 2: 'status', 3: 'rule', 4: 'rulestatus', 5: 'hmc', 6: 'tweetmetrics', 7: 'snapshot'};
+const utf8 = new TextDecoder();
+
+// Decodes the MessagePack value at the start of an ArrayBuffer or Uint8Array
+function unpack(buffer) {
+    const bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let pos = 0;
+
+    function str(length) {
+        const value = utf8.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return value;
+    }
+    function bin(length) {
+        const value = bytes.slice(pos, pos + length);
+        pos += length;
+        return value;
+    }
+    function array(length) {
+        const value = new Array(length);
+        for (let i = 0; i < length; i++) value[i] = read();
+        return value;
+    }
+    function map(length) {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+    function read() {
+        const byte = bytes[pos++];
+        if (byte < 0x80) return byte;
+        if (byte < 0x90) return map(byte & 0x0f);
+        if (byte < 0xa0) return array(byte & 0x0f);
+        if (byte < 0xc0) return str(byte & 0x1f);
+        if (byte >= 0xe0) return byte - 0x100;
+        let value;
+        switch (byte) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return bin(bytes[pos++]);
+            case 0xc5: value = view.getUint16(pos); pos += 2; return bin(value);
+            case 0xc6: value = view.getUint32(pos); pos += 4; return bin(value);
+            case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+            case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+            case 0xcc: return bytes[pos++];
+            case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+            case 0xce: value = view.getUint32(pos); pos += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+            case 0xd0: return view.getInt8(pos++);
+            case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+            case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+            case 0xd9: return str(bytes[pos++]);
+            case 0xda: value = view.getUint16(pos); pos += 2; return str(value);
+            case 0xdb: value = view.getUint32(pos); pos += 4; return str(value);
+            case 0xdc: value = view.getUint16(pos); pos += 2; return array(value);
+            case 0xdd: value = view.getUint32(pos); pos += 4; return array(value);
+            case 0xde: value = view.getUint16(pos); pos += 2; return map(value);
+            case 0xdf: value = view.getUint32(pos); pos += 4; return map(value);
+        }
+        throw new Error('Unsupported MessagePack byte 0x' + byte.toString(16));
+    }
+    return read();
+}
+
+// Puts the long keys back in a decoded message, at any depth
+function expandKeys(value) {
+    if (Array.isArray(value)) return value.map(expandKeys);
+    if (value === null || typeof value !== 'object' || value instanceof Uint8Array) return value;
+    const expanded = {};
+    for (const key in value) expanded[LIVETWEETS_KEYS[key] || key] = expandKeys(value[key]);
+    return expanded;
+}
+
+// Decodes a websocket message in either framing: binary MessagePack frames or JSON text frames
+function decodeMessage(data) {
+    if (typeof data === 'string') return JSON.parse(data);
+    const message = expandKeys(unpack(data));
+    message.type = LIVETWEETS_TYPES[message.type] || message.type;
+    return message;
+}
+
+const chart = document.getElementById('myChart');
+if (chart) {
+    const ctx = chart.getContext('2d');
+    var graphData = {
+        type: 'line',
+        data: {
+            labels: ['Red', 'Blue', 'Yellow', 'Green', 'Purple', 'Orange'],
+            datasets: [{
+                label: '# of Votes',
+                data: [12, 19, 3, 5, 2, 3],
+                backgroundColor: [
+                    'rgba(73, 198, 230, 0.5)',
+                                ],
+
+                borderWidth: 1
+            }]
+        },
+        options: {
+
+        }
+    }
+    const myChart = new Chart(ctx,graphData );
+
+    var socket = new WebSocket('ws://'
+    + window.location.host
+    + '/ws/tweets', LIVETWEETS_PROTOCOLS);
+    socket.binaryType = 'arraybuffer';
+
+
+    socket.onmessage = function(e){
+        var djangoData = decodeMessage(e.data);
+        console.log(djangoData);
+        var newGraphData = graphData.data.datasets[0].data;
+        newGraphData.shift();
+        newGraphData.push(djangoData.value);
+        graphData.data.datasets[0].data= newGraphData;
+        myChart.update();
+
+
     }
 }
-const myChart = new Chart(ctx,graphData );
-
-var socket = new WebSocket('ws://'
-+ window.location.host
-+ '/ws/tweets');
-
-
-socket.onmessage = function(e){
-    var djangoData = JSON.parse(e.data);
-    console.log(djangoData);
-    var newGraphData = graphData.data.datasets[0].data;
-    newGraphData.shift();
-    newGraphData.push(djangoData.value);
-    graphData.data.datasets[0].data= newGraphData;
-    myChart.update();
-    
-    
-}
\ No newline at end of file
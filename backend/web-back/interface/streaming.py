@@ -0,0 +1,97 @@
+import asyncio
+import os
+import socket
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .periodic import Periodic
+from .snapshot import get_state_cache
+from .tracking import acquire_lease, release_lease
+
+
+# The channel group every consumer joins, whatever its session, to hear the status of the filtered stream they share,
+# and when a session starts or stops streaming
+STREAM_GROUP = 'stream'
+
+
+""" The filtered stream of the deployment, shared by all sessions """
+class StreamService:
+    def __init__(self, stream_factory, sessions, lease_ttl=None):
+        """
+        Twitter allows one filtered stream connection per app, and the rules of the stream are shared by the whole
+        app, so one stream serves all the sessions: the rules of a session are tagged with its channel group, and the
+        stream sends each tweet to the groups of the rules it matched, see interface.livetweets.LiveStream.
+        Every worker with consumers runs the loop of the service, but only the worker holding the lease connects to
+        Twitter, and only while a session with consumers in that worker is streaming. The streaming sessions are kept
+        in the state cache, so every worker sees them. If the holder goes away, the lease expires and another worker
+        takes over on its next tick.
+        :param stream_factory: Function returning the LiveStream to use
+        :param sessions: Function returning the channel groups of the sessions with consumers in this worker
+        :param lease_ttl: Seconds the lease is held without renewing, it is renewed every third of it.
+        Defaults to LIVETWEETS_TRACKER_LEASE_TTL
+        """
+        self.stream_factory = stream_factory
+        self.sessions = sessions
+        self.lease_name = 'filtered-stream'
+        self.lease_ttl = lease_ttl or settings.LIVETWEETS_TRACKER_LEASE_TTL
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.stream = None
+        self.streaming = set()
+        self.leader = False
+        self.schedule = None
+        self.task = None
+        self.refreshing = None
+
+    @property
+    def connected(self):
+        return self.stream is not None and self.stream.task is not None and not self.stream.task.done()
+
+    def get_stream(self):
+        """
+        :return: The LiveStream of this worker, created on first use. The consumers also use it to manage the rules
+        """
+        if self.stream is None:
+            self.stream = self.stream_factory()
+        return self.stream
+
+    def start(self):
+        """
+        Starts the loop of this worker if it is not already running.
+        """
+        if self.task is None or self.task.done():
+            self.schedule = Periodic(self.tick, self.lease_ttl / 3, name='Filtered stream')
+            self.task = asyncio.get_event_loop().create_task(self.schedule.run())
+
+    def refresh(self):
+        """
+        Runs a tick now, instead of waiting for the next one. Consumers call it when the streaming sessions change,
+        and the consumers of this worker asking for it while a tick is running share that tick.
+        """
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.get_event_loop().create_task(self.tick())
+
+    async def tick(self):
+        """
+        One cycle: reads the streaming sessions, takes or renews the lease if any of them has consumers in this
+        worker, and connects the stream if we hold the lease, or disconnects it if we do not. The lease is given up
+        when this worker no longer needs the stream, so another worker can take over right away.
+        """
+        self.streaming = await get_state_cache().streaming()
+        wanted = bool(self.streaming & set(self.sessions()))
+        leader = False
+        if wanted:
+            try:
+                leader = await sync_to_async(acquire_lease)(self.lease_name, self.holder, self.lease_ttl)
+            except Exception as e:
+                print(f'Failed to take the filtered stream lease: {e!r}')
+        elif self.leader:
+            await sync_to_async(release_lease)(self.lease_name, self.holder)
+        self.leader = leader
+        if leader:
+            stream = self.get_stream()
+            stream.sessions = self.streaming
+            if not self.connected:
+                stream.start()
+        elif self.connected:
+            self.stream.disconnect()
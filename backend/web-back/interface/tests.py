@@ -1,3 +1,548 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+import msgpack
+from aiohttp.test_utils import TestServer
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from tweepy import Response, StreamRule
+from .archive import StreamArchive, read_index, read_range, read_tweet
+from .broadcast import HMC_LISTS, HmcBroadcaster, apply_hmc_event, hmc_event, hmc_message, hmc_state
+from .counters import entity_counters
+from .fakeapi import FakeTwitterAPI
+from .leaderboard import Leaderboard
+from .livetweets import EngagementTracker, LiveStream
+from .models import Hashtag, Mention, StreamRules, Tweet, TrackedTweet, TweetMetrics
+from .outbox import Outbox
+from .priority import set_metrics_per_update
+from .protocol import MSGPACK_PROTOCOL, event_frame, event_message, frame_event
+from .replay import ReplaySource
+from .rules import session_tag, split_tag
+from . import snapshot
+from .streaming import StreamService
+from .velocity import VelocityEngine
+
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def channel_layer_copy(event):
+    """
+    :return: The event after a trip through the channel layer, serialized with MessagePack as channels_redis does
+    """
+    return msgpack.unpackb(msgpack.packb(event, use_bin_type=True), raw=False)
+
+
+def recorded_payload(tweetid, hashtags, mentions, tags=('tweet.replay:rule',)):
+    """
+    :param tags: The tags of the rules the tweet matched
+    :return: A filtered stream payload line, as recorded from the stream
+    """
+    return json.dumps({
+        'data': {
+            'id': str(tweetid), 'text': 't', 'edit_history_tweet_ids': [str(tweetid)], 'author_id': '1',
+            'conversation_id': '1', 'created_at': '2022-07-17T10:00:00.000Z', 'lang': 'en',
+            'possibly_sensitive': False, 'reply_settings': 'everyone', 'source': 's',
+            'entities': {'hashtags': [{'tag': tag} for tag in hashtags],
+                         'mentions': [{'username': name} for name in mentions]},
+        },
+        'includes': {'users': [{'id': '1', 'name': 'n', 'username': 'u'}]},
+        'matching_rules': [{'id': str(n), 'tag': tag} for n, tag in enumerate(tags)],
+    })
+
+
+class LeaderboardTests(SimpleTestCase):
+    def test_top_follows_increments(self):
+        board = Leaderboard()
+        for key, delta in [('a', 3), ('b', 1), ('c', 2), ('b', 4), ('a', 0)]:
+            board.increment(key, delta)
+        self.assertEqual(board.top(2), [('b', 5), ('a', 3)])
+        self.assertEqual(board.top(10, exclude={'b'}), [('a', 3), ('c', 2)])
+        self.assertEqual(board.top(3), [('b', 5), ('a', 3), ('c', 2)])
+
+    def test_reset_replaces_counts(self):
+        board = Leaderboard()
+        board.increment('a', 10)
+        board.reset({'b': 2, 'c': 5}, labels={'c': 'C'})
+        self.assertEqual(board.top(), [('c', 5), ('b', 2)])
+        self.assertEqual(board.labels, {'c': 'C'})
+
+    def test_outdated_entries_are_compacted(self):
+        board = Leaderboard()
+        for _ in range(500):
+            board.increment('a')
+        board.increment('b', 1000)
+        self.assertLessEqual(len(board.heap), 2 * len(board) + 64)
+        self.assertEqual(board.top(), [('b', 1000), ('a', 500)])
+
+
+class VelocityEngineTests(SimpleTestCase):
+    def engine(self, capacity=10):
+        engine = VelocityEngine(capacity=capacity, slack=5, windows={'30': 30.0, '60': 60.0})
+        engine.append(0, {'a': 0, 'b': 0})
+        engine.append(30, {'a': 10, 'b': 40})
+        engine.append(60, {'a': 20, 'b': 100})
+        return engine
+
+    def test_top_per_window(self):
+        top = self.engine().top(n=5)
+        self.assertEqual(top['30'], [{'id': 'b', 'count': 60}, {'id': 'a', 'count': 10}])
+        self.assertEqual(top['60'], [{'id': 'b', 'count': 100}, {'id': 'a', 'count': 20}])
+
+    def test_rates_and_flat_tweets(self):
+        engine = self.engine()
+        rates = engine.rates()
+        self.assertAlmostEqual(rates['a'], 20 / 60)
+        self.assertAlmostEqual(rates['b'], 100 / 60)
+        engine.append(90, {'a': 20, 'b': 110})
+        self.assertEqual(engine.flat(['a', 'b'], 2), ['a'])
+
+    def test_ring_drops_the_oldest_update(self):
+        engine = self.engine(capacity=2)
+        self.assertEqual(engine.top()['60'], list())
+        self.assertEqual(engine.top()['30'][0], {'id': 'b', 'count': 60})
+
+    def test_retain_frees_rows(self):
+        engine = self.engine()
+        engine.retain(['a'])
+        self.assertNotIn('b', engine)
+        self.assertEqual(list(engine.rates()), ['a'])
+
+
+class OutboxTests(SimpleTestCase):
+    async def test_policies_when_full(self):
+        sent = list()
+
+        async def send(payload):
+            sent.append(payload)
+
+        outbox = Outbox(send, capacity=2)
+        for payload in ('t1', 't2', 't3'):
+            outbox.put('tweet', payload)
+        outbox.put('hmc', 'h1')
+        outbox.put('hmc', 'h2')
+        outbox.put('status', 's1')
+        outbox.put('status', 's2')
+        for _ in range(10):
+            await asyncio.sleep(0)
+        outbox.stop()
+        self.assertEqual(sent, ['h2', 's1', 's2'])
+        self.assertEqual(outbox.stats()['dropped'], {'tweet': 3, 'hmc': 1})
+
+    async def test_failed_send_does_not_stop_the_writer(self):
+        sent = list()
+
+        async def send(payload):
+            if payload == 'bad':
+                raise ConnectionError(payload)
+            sent.append(payload)
+
+        outbox = Outbox(send, capacity=10)
+        for payload in ('a', 'bad', 'b'):
+            outbox.put('tweet', payload)
+        for _ in range(10):
+            await asyncio.sleep(0)
+        outbox.stop()
+        self.assertEqual(sent, ['a', 'b'])
+
+
+class HmcDeltaTests(SimpleTestCase):
+    LISTS = [
+        ([{'hashtag': 'a', 'count': 3}], [], []),
+        ([{'hashtag': 'a', 'count': 4}, {'hashtag': 'b', 'count': 1}], [{'mention': 'x', 'count': 1}], []),
+        ([{'hashtag': 'b', 'count': 5}], [{'mention': 'x', 'count': 1}], [{'name': 'd: e', 'id': '1.2', 'count': 1}]),
+    ]
+
+    def events(self, broadcaster):
+        for now, (hashtags, mentions, contexts) in enumerate(self.LISTS):
+            lists = {'hashtags': hashtags, 'mentions': mentions, 'contexts': contexts}
+            yield lists, channel_layer_copy(broadcaster.build_event(lists, now))
+
+    def test_deltas_rebuild_the_lists(self):
+        broadcaster = HmcBroadcaster(None, deltas=True, keyframe_interval=3600)
+        state = None
+        deltas = list()
+        for lists, event in self.events(broadcaster):
+            deltas.append(bool(event.get('delta')))
+            state = apply_hmc_event(state, event)
+            self.assertEqual({name: state[name] for name in HMC_LISTS}, lists)
+        self.assertEqual(deltas, [False, True, True])
+        self.assertIsNone(broadcaster.build_event(dict(lists), 10))
+
+    def test_deltas_of_another_sender_are_skipped(self):
+        first = HmcBroadcaster(None, deltas=True, keyframe_interval=3600)
+        second = HmcBroadcaster(None, deltas=True, keyframe_interval=3600)
+        events = [event for _, event in self.events(first)]
+        state = apply_hmc_event(None, events[0])
+        other = [event for _, event in self.events(second)]
+        self.assertTrue(other[1].get('delta'))
+        self.assertIsNone(apply_hmc_event(state, other[1]))
+        self.assertIsNone(apply_hmc_event(state, events[2]))
+        self.assertIsNotNone(apply_hmc_event(state, events[1]))
+
+    def test_snapshot_seeds_the_state(self):
+        broadcaster = HmcBroadcaster(None, deltas=True, keyframe_interval=3600)
+        (first, keyframe), (second, delta) = list(self.events(broadcaster))[:2]
+        snapshot = {'type': 'hmc', 'seq': keyframe['seq'], 'sender': keyframe['sender'], **first}
+        state = apply_hmc_event(hmc_state(snapshot), delta)
+        self.assertEqual(hmc_message(state), {'type': 'hmc', **second})
+
+    def test_frames_are_encoded_once_per_protocol(self):
+        broadcaster = HmcBroadcaster(None, deltas=True, keyframe_interval=3600)
+        (lists, keyframe), (_, delta) = list(self.events(broadcaster))[:2]
+        self.assertNotIn('hashtags', keyframe)
+        self.assertEqual(json.loads(event_frame(keyframe, None)), {'type': 'hmc', **lists})
+        self.assertIs(event_frame(channel_layer_copy(keyframe), None), event_frame(keyframe, None))
+        state = apply_hmc_event(apply_hmc_event(None, keyframe), delta)
+        frame = event_frame(hmc_event(state), MSGPACK_PROTOCOL)
+        self.assertIs(event_frame(hmc_event(dict(state)), MSGPACK_PROTOCOL), frame)
+        self.assertEqual(msgpack.unpackb(frame)['t'], 5)
+
+    def test_frame_event_round_trip(self):
+        event = channel_layer_copy(frame_event({'type': 'status', 'stream': 'up'}, id='1'))
+        self.assertEqual(event_message(event), {'type': 'status', 'stream': 'up'})
+        self.assertEqual(msgpack.unpackb(event_frame(event, MSGPACK_PROTOCOL)), {'t': 2, 's': 'up'})
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    async def test_refresh_runs_once_per_keyframe_interval(self):
+        refreshed = list()
+        broadcaster = HmcBroadcaster(lambda: self.LISTS[len(refreshed) % 3], keyframe_interval=3600,
+                                     refresh=lambda: refreshed.append(True))
+        await broadcaster.send()
+        await broadcaster.send()
+        self.assertEqual(len(refreshed), 1)
+        broadcaster.last_refresh -= 3600
+        await broadcaster.send()
+        self.assertEqual(len(refreshed), 2)
+
+
+class StreamArchiveTests(SimpleTestCase):
+    async def test_archives_sharing_a_directory_write_their_own_segments(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archives = [StreamArchive(directory, block_size=5) for _ in range(2)]
+            self.assertNotEqual(archives[0].open_segment(), archives[1].open_segment())
+            for i in range(20):
+                archives[i % 2].append(recorded_payload(7200000 + i, ['a'], []))
+            for archive in archives:
+                await archive.close()
+            self.assertEqual(len({segment for segment, _ in read_index(directory)}), 2)
+            self.assertEqual(len(list(read_range(directory))), 20)
+            self.assertEqual(json.loads(read_tweet(directory, 7200013))['data']['id'], '7200013')
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, LIVETWEETS_ARCHIVE_DIR=None)
+class ReplayTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'stream.ndjson')
+        with open(self.path, 'w') as file:
+            for i in range(50):
+                file.write(recorded_payload(7000000 + i, ['even' if i % 2 == 0 else 'odd', 'all'], ['bob']) + '\n')
+                if i % 10 == 0:
+                    file.write('\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def replay(self):
+        stream = LiveStream(bearer_token='replay')
+        stats = await ReplaySource(stream, [self.path]).run()
+        await sync_to_async(entity_counters.flush)()
+        return stats
+
+    def counts(self):
+        return (Tweet.objects.count(), TrackedTweet.objects.filter(group='tweet.replay').count(),
+                dict(Hashtag.objects.values_list('hashtag', 'count')),
+                dict(Mention.objects.values_list('mention', 'count')))
+
+    async def test_replay_stores_tweets_and_counts_entities(self):
+        stats = await self.replay()
+        self.assertEqual((stats['payloads'], stats['tweets']), (50, 50))
+        tweets, tracked, hashtags, mentions = await sync_to_async(self.counts)()
+        self.assertEqual((tweets, tracked), (50, 50))
+        self.assertEqual(hashtags, {'even': 25, 'odd': 25, 'all': 50})
+        self.assertEqual(mentions, {'bob': 50})
+        links = await sync_to_async(Tweet.hashtags.through.objects.count)()
+        self.assertEqual(links, 100)
+
+    async def test_replaying_twice_changes_nothing(self):
+        await self.replay()
+        first = await sync_to_async(self.counts)()
+        await self.replay()
+        self.assertEqual(await sync_to_async(self.counts)(), first)
+
+    async def test_keys_differing_in_case_are_kept_apart(self):
+        with open(self.path, 'w') as file:
+            for i in range(4):
+                file.write(recorded_payload(7100000 + i, ['Python' if i % 2 else 'python'], ['Bob', 'bob']) + '\n')
+        await self.replay()
+        tweets, _, hashtags, mentions = await sync_to_async(self.counts)()
+        self.assertEqual(tweets, 4)
+        self.assertEqual(hashtags, {'Python': 2, 'python': 2})
+        self.assertEqual(mentions, {'Bob': 4, 'bob': 4})
+
+
+class RulesStream(LiveStream):
+    """
+    A LiveStream whose rules on Twitter are a list, instead of requests to the API
+    """
+    def __init__(self, rules):
+        super().__init__(bearer_token='test')
+        self.rules = rules
+
+    async def get_rules(self, **params):
+        return Response(list(self.rules) or None, {}, [], {})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, LIVETWEETS_ARCHIVE_DIR=None)
+class SessionTests(TestCase):
+    def setUp(self):
+        snapshot.STATE_CACHE = None
+
+    async def listen(self, *groups):
+        channel_layer = get_channel_layer()
+        channels = dict()
+        for group in groups:
+            channels[group] = await channel_layer.new_channel()
+            await channel_layer.group_add(group, channels[group])
+        return channel_layer, channels
+
+    async def received(self, channel_layer, channel):
+        messages = list()
+        while True:
+            try:
+                event = await asyncio.wait_for(channel_layer.receive(channel), 0.05)
+            except asyncio.TimeoutError:
+                return messages
+            messages.append(event_message(event))
+
+    def test_tags_carry_the_session(self):
+        self.assertEqual(split_tag(session_tag('tweet.a', 'hashtagsfilter')), ('tweet.a', 'hashtagsfilter'))
+        self.assertEqual(split_tag('hashtagsfilter'), ('tweet', 'hashtagsfilter'))
+        self.assertEqual(split_tag('other:tag'), ('tweet', 'other:tag'))
+
+    async def test_tweets_are_sent_to_the_streaming_sessions_of_their_rules(self):
+        channel_layer, channels = await self.listen('tweet.a', 'tweet.b')
+        stream = LiveStream(bearer_token='test')
+        stream.sessions = {'tweet.a', 'tweet.b'}
+        await stream.on_data(recorded_payload(7300000, ['a'], [], tags=['tweet.a:x', 'tweet.b:y', 'tweet.a:z']))
+        stream.sessions = {'tweet.a'}
+        await stream.on_data(recorded_payload(7300001, ['a'], [], tags=['tweet.a:x', 'tweet.b:y']))
+        await stream.ingest.stop()
+        await stream.hmc.stop()
+        received = await self.received(channel_layer, channels['tweet.a'])
+        self.assertEqual([(m['id'], m['filters']) for m in received], [('7300000', 'x, z'), ('7300001', 'x')])
+        received = await self.received(channel_layer, channels['tweet.b'])
+        self.assertEqual([(m['id'], m['filters']) for m in received], [('7300000', 'y')])
+        tracked = await sync_to_async(lambda: sorted(TrackedTweet.objects.values_list('tweetid_id', 'group')))()
+        self.assertEqual(tracked, [('7300000', 'tweet.a'), ('7300000', 'tweet.b'), ('7300001', 'tweet.a')])
+        self.assertEqual(len((await snapshot.get_state_cache().snapshot('tweet.b'))['tweets']), 1)
+
+    async def test_rules_are_sent_to_their_sessions(self):
+        channel_layer, channels = await self.listen('tweet.a', 'tweet.b')
+        stream = RulesStream([StreamRule('#a', session_tag('tweet.a', 'hashtagsfilter'), '1'),
+                              StreamRule('#b', session_tag('tweet.b', 'hashtagsfilter'), '2')])
+        messages = await stream.update_rules_from_twitter(['tweet.c'])
+        self.assertEqual(set(messages), {'tweet.a', 'tweet.b', 'tweet.c'})
+        received = await self.received(channel_layer, channels['tweet.a'])
+        self.assertEqual([(m['filter'], m['tag']) for m in received], [('#a', 'hashtagsfilter')])
+        self.assertEqual(messages['tweet.b'][0]['filter'], '#b')
+        self.assertEqual(messages['tweet.c'], list())
+        self.assertEqual((await snapshot.get_state_cache().snapshot('tweet.b'))['rules'][0]['filter'], '#b')
+        self.assertEqual((await snapshot.get_state_cache().snapshot('tweet.c'))['rules'], list())
+        tags = await sync_to_async(lambda: sorted(StreamRules.objects.values_list('tag', flat=True)))()
+        self.assertEqual(tags, ['tweet.a:hashtagsfilter', 'tweet.b:hashtagsfilter'])
+
+
+class FakeStream:
+    """
+    The parts of a LiveStream the StreamService uses, connecting to nothing
+    """
+    def __init__(self):
+        self.task = None
+        self.sessions = None
+        self.connects = 0
+
+    def start(self):
+        self.connects += 1
+        self.task = asyncio.get_event_loop().create_future()
+
+    def disconnect(self):
+        self.task.cancel()
+
+
+class RecordingRedis:
+    """
+    Records the commands of the pipelines of a RedisStateCache, and answers the reads of its snapshots with nothing
+    """
+    def __init__(self):
+        self.executed = list()
+
+    def pipeline(self, transaction=True):
+        return RecordingPipeline(self)
+
+
+class RecordingPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = list()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    async def execute(self):
+        if self.commands[0][0] == 'get':
+            return None, None, None, list()
+        self.redis.executed.append(self.commands)
+        return [True] * len(self.commands)
+
+
+class RedisStateCacheTests(SimpleTestCase):
+    async def test_tweets_are_pushed_in_one_round_trip(self):
+        cache = snapshot.RedisStateCache('redis://localhost:1/0', tweets=2, timeout=0.5, flush_interval=0.01)
+        self.assertEqual(cache.redis.connection_pool.connection_kwargs['socket_timeout'], 0.5)
+        self.assertEqual(cache.redis.connection_pool.connection_kwargs['socket_connect_timeout'], 0.5)
+        cache.redis = RecordingRedis()
+        for n in range(3):
+            await cache.add_tweet('tweet.a', {'type': 'tweet', 'id': str(n)})
+        await cache.add_tweet('tweet.b', {'type': 'tweet', 'id': '9'})
+        self.assertEqual(cache.redis.executed, list())
+        self.assertEqual([m['id'] for m in (await cache.snapshot('tweet.a'))['tweets']], ['1', '2'])
+        await cache.task
+        self.assertEqual(len(cache.redis.executed), 1)
+        a, b = cache.key('tweet.a', 'tweets'), cache.key('tweet.b', 'tweets')
+        self.assertEqual([(name, args[0]) for name, args in cache.redis.executed[0]],
+                         [('rpush', a), ('ltrim', a), ('rpush', b), ('ltrim', b)])
+        self.assertEqual(len(cache.redis.executed[0][0][1]), 3)
+        self.assertEqual(cache.pending, dict())
+
+
+class StreamServiceTests(TestCase):
+    def setUp(self):
+        snapshot.STATE_CACHE = None
+
+    async def test_one_worker_holds_the_stream(self):
+        first = StreamService(FakeStream, lambda: {'tweet.a'})
+        second = StreamService(FakeStream, lambda: {'tweet.a', 'tweet.b'})
+        await first.tick()
+        self.assertFalse(first.connected)
+        await snapshot.get_state_cache().set_streaming('tweet.a', True)
+        await first.tick()
+        await second.tick()
+        self.assertTrue(first.connected)
+        self.assertEqual(first.stream.sessions, {'tweet.a'})
+        self.assertFalse(second.connected)
+        await snapshot.get_state_cache().set_streaming('tweet.b', True)
+        await first.tick()
+        self.assertEqual(first.stream.sessions, {'tweet.a', 'tweet.b'})
+        self.assertEqual(first.stream.connects, 1)
+        await snapshot.get_state_cache().set_streaming('tweet.a', False)
+        await first.tick()
+        self.assertFalse(first.connected)
+        await second.tick()
+        self.assertTrue(second.connected)
+        self.assertEqual(second.stream.sessions, {'tweet.b'})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class EngagementTrackerTests(TestCase):
+    GROUP = 'tweet.tracked'
+
+    def setUp(self):
+        snapshot.STATE_CACHE = None
+        self.starttime = timezone.now() - timedelta(minutes=5)
+        Tweet.objects.bulk_create([
+            Tweet(id=str(8000000 + i), text='t', author_id='1', conversation_id='1', created_at=self.starttime,
+                  in_reply_to_user_id='None', lang='en', possibly_sensitive=False, reply_settings='everyone',
+                  source='s') for i in range(20)
+        ])
+        TrackedTweet.objects.bulk_create([
+            TrackedTweet(tweetid_id=str(8000000 + i), created_at=self.starttime, metrics_per_update=0,
+                         group=self.GROUP) for i in range(20)
+        ])
+
+    async def track(self, api, updates, starved=False):
+        """
+        Runs engagement updates of a tracker pointed at the fake API.
+        :param starved: Start the tracker with an empty request budget that does not refill
+        :return: The tracker, closed, and the messages it sent to the channel group
+        """
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(self.GROUP, channel)
+        server = TestServer(api.app())
+        await server.start_server()
+        try:
+            with override_settings(LIVETWEETS_API_URL=str(server.make_url(''))):
+                tracker = EngagementTracker('test', group=self.GROUP)
+                if starved:
+                    tracker.budget.tokens = tracker.budget.rate = 0
+                for _ in range(updates):
+                    await tracker.engagement_update(self.starttime)
+                await tracker.close()
+        finally:
+            await server.close()
+        messages = list()
+        while True:
+            try:
+                messages.append(await asyncio.wait_for(channel_layer.receive(channel), 0.05))
+            except asyncio.TimeoutError:
+                return tracker, messages
+
+    async def test_update_stores_metrics(self):
+        api = FakeTwitterAPI(start=self.starttime.timestamp())
+        tracker, messages = await self.track(api, 2)
+        metrics = await sync_to_async(TweetMetrics.objects.count)()
+        self.assertEqual(metrics, 40)
+        self.assertEqual(api.requests, 4)
+        self.assertEqual(tracker.budget.remaining, 296)
+        self.assertEqual(tracker.clients.stats()['requests'], 4)
+        self.assertEqual(len(event_message(messages[-1])['MT_data']), 20)
+        latest = (await snapshot.get_state_cache().snapshot(self.GROUP))['tweetmetrics']
+        self.assertEqual(latest, event_message(messages[-1]))
+
+    async def test_budget_stops_at_the_remaining_requests(self):
+        api = FakeTwitterAPI(limit=1, start=self.starttime.timestamp())
+        tracker, messages = await self.track(api, 2)
+        self.assertEqual(api.requests, 1)
+        self.assertEqual(tracker.budget.throttled, 0)
+        self.assertEqual(tracker.budget.allowance(), 0)
+        self.assertEqual(await sync_to_async(TweetMetrics.objects.count)(), 20)
+        self.assertEqual(messages, list())
+        self.assertIsNone((await snapshot.get_state_cache().snapshot(self.GROUP))['tweetmetrics'])
+
+    async def test_rate_limited_update_empties_the_budget(self):
+        api = FakeTwitterAPI(limit=1, start=self.starttime.timestamp())
+        api.remaining = 0
+        tracker, _ = await self.track(api, 2)
+        self.assertEqual(api.requests, 1)
+        self.assertEqual(tracker.budget.throttled, 1)
+        self.assertEqual(tracker.budget.allowance(), 0)
+        self.assertEqual(await sync_to_async(TweetMetrics.objects.count)(), 0)
+
+    async def test_update_is_skipped_without_budget(self):
+        api = FakeTwitterAPI(start=self.starttime.timestamp())
+        await self.track(api, 1, starved=True)
+        self.assertEqual(api.requests, 0)
+        self.assertEqual(await sync_to_async(TweetMetrics.objects.count)(), 0)
+
+    def test_metrics_per_update_is_scoped_to_the_group(self):
+        TrackedTweet.objects.create(tweetid_id='8000000', created_at=self.starttime, metrics_per_update=0,
+                                    group='tweet.other')
+        with self.assertNumQueries(2):
+            set_metrics_per_update({'8000000': 7, '8000001': 3}, self.GROUP)
+        rates = dict(TrackedTweet.objects.filter(group=self.GROUP, tweetid_id__in=['8000000', '8000001'])
+                     .values_list('tweetid_id', 'metrics_per_update'))
+        self.assertEqual(rates, {'8000000': 7, '8000001': 3})
+        self.assertEqual(TrackedTweet.objects.get(group='tweet.other').metrics_per_update, 0)
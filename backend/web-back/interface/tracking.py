@@ -0,0 +1,130 @@
+import asyncio
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import TrackerLease
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def acquire_lease(name, holder, ttl):
+    """
+    Takes or renews a lease. The lease is taken in a single update, which only matches if we hold the lease
+    already or it has expired, so only one holder can win it.
+    :param name: The name of the lease
+    :param holder: The id of the process asking for it
+    :param ttl: Seconds until the lease expires unless renewed
+    :return: True if we hold the lease
+    """
+    now = timezone.now()
+    leases = TrackerLease.objects.filter(name=name)
+    expires_at = now + timedelta(seconds=ttl)
+    if leases.filter(Q(holder=holder) | Q(expires_at__lt=now)).update(holder=holder, expires_at=expires_at):
+        return True
+    TrackerLease.objects.bulk_create([TrackerLease(name=name, holder=holder, expires_at=expires_at)],
+                                     ignore_conflicts=True)
+    return leases.filter(holder=holder).exists()
+
+
+def release_lease(name, holder):
+    """
+    Gives up a lease we hold, so another process can take it on its next try.
+    :param name: The name of the lease
+    :param holder: The id of the process holding it
+    """
+    TrackerLease.objects.filter(name=name, holder=holder).update(holder='', expires_at=timezone.now())
+
+
+""" The engagement tracking of a session, shared by all its consumers in the deployment """
+class TrackerService:
+    def __init__(self, tracker_factory, group='tweet', interval=None, lease_ttl=None):
+        """
+        Runs one engagement tracker per session and deployment, instead of one per consumer. Every worker with
+        subscribed consumers runs the loop, but only the worker holding the lease of the session polls Twitter and
+        sends the results to the channel group of the session, where the consumers of all workers receive them.
+        If the holder goes away, the lease expires and another worker takes over on its next tick.
+        :param tracker_factory: Function returning the EngagementTracker to use
+        :param group: The channel group of the session
+        :param interval: Seconds between engagement updates. Defaults to LIVETWEETS_ENGAGEMENT_INTERVAL
+        :param lease_ttl: Seconds the lease is held without renewing. Defaults to LIVETWEETS_TRACKER_LEASE_TTL
+        """
+        self.tracker_factory = tracker_factory
+        self.group = group
+        self.lease_name = f'engagement-tracker:{group}'
+        self.tracker = None
+        self.interval = interval or settings.LIVETWEETS_ENGAGEMENT_INTERVAL
+        self.lease_ttl = lease_ttl or settings.LIVETWEETS_TRACKER_LEASE_TTL
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.subscribers = set()
+        self.starttime = None
+        self.leader = False
+        self.task = None
+
+    @property
+    def tracking(self):
+        return self.task is not None and not self.task.done()
+
+    def subscribe(self, channel_name):
+        """
+        Registers a consumer of this worker.
+        :param channel_name: The channel name of the consumer
+        """
+        self.subscribers.add(channel_name)
+
+    async def unsubscribe(self, channel_name):
+        """
+        Unregisters a consumer of this worker. The tracking in this worker stops when its last consumer is gone.
+        :param channel_name: The channel name of the consumer
+        """
+        self.subscribers.discard(channel_name)
+        if not self.subscribers:
+            await self.stop()
+
+    def start(self, starttime):
+        """
+        Starts the tracking loop of this worker if it is not already running.
+        :param starttime: Datetime object of when the tracking was started, the earliest one is kept
+        """
+        if self.starttime is None or starttime < self.starttime:
+            self.starttime = starttime
+        if self.tracking:
+            return
+        if self.tracker is None:
+            self.tracker = self.tracker_factory()
+        self.tracker.tracking = True
+        self.task = asyncio.get_event_loop().create_task(
+            self.tracker.periodic_update(self.interval, self.tick))
+
+    async def tick(self):
+        """
+        One tracking cycle: takes or renews the lease, and runs the engagement update if we hold it.
+        """
+        try:
+            self.leader = await sync_to_async(acquire_lease)(self.lease_name, self.holder, self.lease_ttl)
+        except Exception as e:
+            print(f'Failed to take the engagement tracker lease: {e!r}')
+            self.leader = False
+        if self.leader:
+            await self.tracker.engagement_update(self.starttime)
+
+    async def stop(self):
+        """
+        Stops the tracking loop of this worker, closes the API connections of the tracker, and gives up the lease
+        if we hold it.
+        """
+        if self.tracker is not None:
+            self.tracker.tracking = False
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.tracker is not None:
+            await self.tracker.close()
+        self.starttime = None
+        if self.leader:
+            self.leader = False
+            await sync_to_async(release_lease)(self.lease_name, self.holder)
@@ -0,0 +1,221 @@
+import numpy as np
+
+from django.conf import settings
+from .models import TweetMetrics
+
+
+def parse_windows(value):
+    """
+    :param value: Comma separated window lengths in seconds, e.g. '30,60,180'
+    :return: Dictionary of window name -> seconds, named by their length as the consumers expect
+    """
+    return {window.strip(): float(window) for window in value.split(',') if window.strip()}
+
+
+""" In-memory engagement history of the tracked tweets """
+class VelocityEngine:
+    def __init__(self, capacity=None, slack=None, windows=None):
+        """
+        Keeps the engagement history of all the tracked tweets in one 2-D array, one row per tweet and one column per
+        engagement update, used as a ring: once full, each update overwrites the oldest column. Tweets not polled in
+        an update have no value (NaN) in its column. The deltas, rates and acceleration of all the tweets are computed
+        for every window in one vectorized pass over the array, and the top tweets of each window are picked by
+        argpartition, so the cost stays low with thousands of tweets tracked.
+        The windows are measured on the update times, as tweets polled less often than every update have fewer
+        snapshots in them. The database only serves as durable backing: it is read once, to warm the history after a
+        restart or when another worker takes over the tracking.
+        :param capacity: Updates kept. Defaults to LIVETWEETS_VELOCITY_CAPACITY
+        :param slack: Seconds a snapshot may be off from the start of a window and still count for it.
+        Defaults to half of LIVETWEETS_ENGAGEMENT_INTERVAL
+        :param windows: Dictionary of window name -> seconds. Defaults to LIVETWEETS_VELOCITY_WINDOWS
+        """
+        self.capacity = capacity or settings.LIVETWEETS_VELOCITY_CAPACITY
+        self.slack = slack or settings.LIVETWEETS_ENGAGEMENT_INTERVAL / 2
+        self.windows = windows or parse_windows(settings.LIVETWEETS_VELOCITY_WINDOWS)
+        self.counts = np.full((64, self.capacity), np.nan)
+        self.times = np.full(self.capacity, np.nan)
+        self.head = -1
+        self.rows = dict()
+        self.ids = [None] * len(self.counts)
+        self.free = list(range(len(self.counts) - 1, -1, -1))
+        self.loaded = False
+
+    def __contains__(self, tweetid):
+        return tweetid in self.rows
+
+    def load(self, tweetids, since):
+        """
+        Fills the history of the tracked tweets with their snapshots stored since a time. Only done once.
+        :param tweetids: The ids of the tracked tweets
+        :param since: Datetime object, the oldest snapshot to load
+        """
+        self.loaded = True
+        metrics = (TweetMetrics.objects.filter(tweetid_id__in=[str(id) for id in tweetids], time__gte=since)
+                   .order_by('time')
+                   .values_list('tweetid_id', 'time', 'retweet_count', 'reply_count', 'like_count', 'quote_count'))
+        updates = dict()
+        for tweetid, time, retweets, replies, likes, quotes in metrics:
+            updates.setdefault(time, dict())[tweetid] = retweets + replies + likes + quotes
+        for time, counts in updates.items():
+            self.append(time.timestamp(), counts)
+
+    def row(self, tweetid):
+        """
+        :return: The row of a tweet, taken from the free rows if it has none. The array doubles when none are free.
+        """
+        row = self.rows.get(tweetid)
+        if row is not None:
+            return row
+        if not self.free:
+            size = len(self.counts)
+            self.counts = np.vstack([self.counts, np.full((size, self.capacity), np.nan)])
+            self.ids.extend([None] * size)
+            self.free = list(range(2 * size - 1, size - 1, -1))
+        row = self.free.pop()
+        self.rows[tweetid] = row
+        self.ids[row] = tweetid
+        return row
+
+    def append(self, timestamp, counts):
+        """
+        Adds the column of an update, replacing the oldest one once the ring is full.
+        :param timestamp: POSIX timestamp of the update
+        :param counts: Dictionary of tweet id -> summed engagement of the tweets polled in the update
+        """
+        self.head = (self.head + 1) % self.capacity
+        self.times[self.head] = timestamp
+        self.counts[:, self.head] = np.nan
+        for tweetid, count in counts.items():
+            row = self.row(tweetid)
+            self.counts[row, self.head] = count
+
+    def record(self, timestamp, tweets):
+        """
+        Adds a snapshot of the polled tweets to the history.
+        :param timestamp: Datetime object of when the tweets were checked
+        :param tweets: list of Tweepy Tweet objects with public_metrics
+        """
+        counts = dict()
+        for tweet in tweets:
+            m = tweet.public_metrics
+            counts[str(tweet.id)] = m['retweet_count'] + m['reply_count'] + m['like_count'] + m['quote_count']
+        self.append(timestamp.timestamp(), counts)
+
+    def retain(self, tweetids):
+        """
+        Frees the rows of the tweets that are no longer tracked.
+        :param tweetids: The ids of the tracked tweets
+        """
+        tracked = {str(id) for id in tweetids}
+        for tweetid in [tweetid for tweetid in self.rows if tweetid not in tracked]:
+            row = self.rows.pop(tweetid)
+            self.counts[row] = np.nan
+            self.ids[row] = None
+            self.free.append(row)
+
+    def history(self):
+        """
+        :return: The tweet ids with at least one snapshot, their counts with the columns ordered newest first, the
+        update times in the same order, the mask of the snapshots taken, and the column of the latest snapshot of
+        each tweet
+        """
+        order = (self.head - np.arange(self.capacity)) % self.capacity
+        rows = np.fromiter(self.rows.values(), dtype=np.intp, count=len(self.rows))
+        counts = self.counts[rows][:, order]
+        valid = ~np.isnan(counts)
+        taken = valid.any(axis=1)
+        rows, counts, valid = rows[taken], counts[taken], valid[taken]
+        return [self.ids[row] for row in rows], counts, self.times[order], valid, valid.argmax(axis=1)
+
+    def value_at(self, counts, times, valid, latest, seconds):
+        """
+        Finds the snapshot of each tweet taken a number of seconds before its latest one, give or take the slack.
+        :return: The counts of the snapshots, their times, and the mask of the tweets that have one
+        """
+        target = times[latest] - seconds
+        mask = valid & (np.abs(times[None, :] - target[:, None]) <= self.slack)
+        mask &= np.arange(self.capacity)[None, :] > latest[:, None]
+        column = mask.argmax(axis=1)
+        return counts[np.arange(len(counts)), column], times[column], mask.any(axis=1)
+
+    def scores(self, windows=None):
+        """
+        Computes the engagement gained by every tweet within each window, the rate it was gained at, and its
+        acceleration: the change in rate from the first to the second half of the window, per second.
+        :param windows: Dictionary of window name -> seconds. Defaults to the windows of the engine
+        :return: list of the tweet ids, and a dictionary of window name -> dictionary of 'delta', 'rate',
+        'acceleration' and 'found' arrays, in the order of the ids. Tweets without a snapshot at the start of a
+        window are not found in it, and tweets without one at its middle have a NaN acceleration
+        """
+        windows = windows or self.windows
+        if not self.rows:
+            return list(), {name: None for name in windows}
+        ids, counts, times, valid, latest = self.history()
+        now = counts[np.arange(len(counts)), latest]
+        results = dict()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name, seconds in windows.items():
+                start, start_time, found = self.value_at(counts, times, valid, latest, seconds)
+                middle, middle_time, halfway = self.value_at(counts, times, valid, latest, seconds / 2)
+                delta = now - start
+                rate = delta / (times[latest] - start_time)
+                acceleration = ((now - middle) / (times[latest] - middle_time)
+                                - (middle - start) / (middle_time - start_time)) / (seconds / 2)
+                acceleration[~(found & halfway)] = np.nan
+                results[name] = {'delta': delta, 'rate': rate, 'acceleration': acceleration, 'found': found}
+        return ids, results
+
+    def top(self, n=5, windows=None):
+        """
+        Gets the tweets that gained the most engagement within each window. Only tweets that gained engagement
+        are included.
+        :param n: The number of tweets per window
+        :param windows: Dictionary of window name -> seconds. Defaults to the windows of the engine
+        :return: Dictionary of window name -> list of {'id', 'count'} dictionaries, highest count first
+        """
+        ids, scores = self.scores(windows)
+        top = dict()
+        for name, score in scores.items():
+            top[name] = list()
+            if score is None:
+                continue
+            gained = np.flatnonzero(score['found'] & (score['delta'] > 0))
+            if len(gained) > n:
+                gained = gained[np.argpartition(-score['delta'][gained], n - 1)[:n]]
+            gained = gained[np.argsort(-score['delta'][gained], kind='stable')]
+            top[name] = [{'id': ids[i], 'count': int(score['delta'][i])} for i in gained]
+        return top
+
+    def rates(self):
+        """
+        :return: Dictionary of tweet id -> engagement gained per second over the whole history, for the tweets with
+        at least two snapshots
+        """
+        if not self.rows:
+            return dict()
+        ids, counts, times, valid, latest = self.history()
+        index = np.arange(len(counts))
+        oldest = self.capacity - 1 - valid[:, ::-1].argmax(axis=1)
+        seconds = times[latest] - times[oldest]
+        gained = counts[index, latest] - counts[index, oldest]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(seconds > 0, gained / seconds, 0.0)
+        return {ids[i]: float(rates[i]) for i in np.flatnonzero(valid.sum(axis=1) >= 2)}
+
+    def flat(self, tweetids, snapshots):
+        """
+        :param tweetids: The tweet ids to check
+        :param snapshots: The number of latest snapshots to look at
+        :return: list of the tweet ids that have that many snapshots, and whose engagement did not change over them
+        """
+        rows = [self.rows[tweetid] for tweetid in tweetids if tweetid in self.rows]
+        if not rows:
+            return list()
+        order = (self.head - np.arange(self.capacity)) % self.capacity
+        counts = self.counts[rows][:, order]
+        taken = np.cumsum(~np.isnan(counts), axis=1)
+        index = np.arange(len(rows))
+        latest = (taken >= 1).argmax(axis=1)
+        first = (taken >= snapshots).argmax(axis=1)
+        flat = (taken[:, -1] >= snapshots) & (counts[index, latest] == counts[index, first])
+        return [self.ids[rows[i]] for i in np.flatnonzero(flat)]